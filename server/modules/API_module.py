@@ -1,13 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Query, WebSocket, WebSocketDisconnect, Request, Header
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Dict, List
 import jwt
 import time
-import json, os, platform
+import json, os, platform, threading, collections
 from pathlib import Path
 import secrets
 import encryption_module
+import event_stream_module
+import snapshot_module
+import mosaic_module
+import metrics_module
+import server_preferences
 
 # Constants
 SERVER_JWT_KEY = secrets.token_hex(32)
@@ -22,12 +30,19 @@ if is_linux:
     USER_DATABASE_JSON_PATH = API_MODULE_PATH.parent.parent.parent.parent / "safety_AI_volume" / "static_database.json"
 else:
     USER_DATABASE_JSON_PATH = API_MODULE_PATH.parent.parent / "configs" / "static_database.json"
-with open(USER_DATABASE_JSON_PATH, "r") as f:
-    USER_DB: Dict[str, Dict[str, str]] = json.load(f)["user_db"]
 
 # FastAPI instance
 app = FastAPI()
 
+# Evaluation results are published here by the evaluation pipeline when the API runs in the same process (see safety_ai_main.py)
+EVENT_BROADCASTER = event_stream_module.EventBroadcaster()
+# Latest frames of the cameras, encoded once and shared by all viewers. The stream manager is attached by safety_ai_main.py
+JPEG_SNAPSHOT_CACHE = snapshot_module.JPEGSnapshotCache()
+# Mosaic of all cameras, rendered in the background by safety_ai_main.py if MOSAIC_RENDER_WITH_API is set
+MOSAIC_RENDERER = mosaic_module.MosaicRenderer(is_headless=True)
+# Set by safety_ai_main.py when this server is the coordinator of a cluster, the workers then send their heartbeats and results to the /cluster endpoints
+CLUSTER_COORDINATOR = None
+
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -50,15 +65,91 @@ class MessageResponse(BaseModel):
 class ListResponse(BaseModel):
     list_ : List
 
+class UserStore:
+    # Users of the static database, reloaded when the file's mtime changes (checked at most every API_USER_STORE_CHECK_INTERVAL_SECONDS)
+    # When a user is changed or removed, the tokens issued to the user before the change are invalidated
+    def __init__(self, database_json_path: Path = None):
+        self.database_json_path = database_json_path
+        self.users: Dict[str, User] = {}
+        self.user_dicts: Dict[str, Dict] = {}
+        self.database_mtime = None
+        self.last_check_time = 0
+        self.tokens_valid_after: Dict[str, float] = {} # username -> tokens issued before this timestamp are rejected
+        self.lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    def return_user(self, username: str):
+        self.reload_if_changed()
+        return self.users.get(username)
+
+    def is_token_issue_time_valid(self, username: str, issued_at: float) -> bool:
+        return issued_at is not None and issued_at >= self.tokens_valid_after.get(username, 0)
+
+    def invalidate_user_tokens(self, username: str):
+        with self.lock:
+            self.tokens_valid_after[username] = time.time()
+        TOKEN_CACHE.remove_user(username)
+
+    def reload_if_changed(self, force: bool = False):
+        if not force and time.time() - self.last_check_time < server_preferences.API_USER_STORE_CHECK_INTERVAL_SECONDS: return
+        with self.lock:
+            self.last_check_time = time.time()
+            try:
+                database_mtime = os.stat(self.database_json_path).st_mtime_ns
+            except FileNotFoundError: # The file is being replaced, try again at the next check
+                return
+            if database_mtime == self.database_mtime: return
+            try:
+                with open(self.database_json_path, "r") as f:
+                    user_dicts: Dict[str, Dict] = json.load(f)["user_db"]
+            except (json.JSONDecodeError, KeyError): # The file is being written, try again at the next check
+                return
+            changed_usernames = [username for username in self.user_dicts if self.user_dicts[username] != user_dicts.get(username)] if self.database_mtime is not None else []
+            self.users = {username: User(**user_dict) for username, user_dict in user_dicts.items()}
+            self.user_dicts = user_dicts
+            self.database_mtime = database_mtime
+        for username in changed_usernames:
+            self.invalidate_user_tokens(username)
+
+class TokenCache:
+    # Payloads of the verified tokens, so that repeated requests with the same token skip the signature verification
+    # Entries are dropped when their token expires. The cache is bounded, least recently used tokens are evicted first
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size if max_size is not None else server_preferences.API_TOKEN_CACHE_MAX_SIZE
+        self.payloads: collections.OrderedDict = collections.OrderedDict() # token -> payload
+        self.lock = threading.Lock()
+
+    def get(self, token: str):
+        with self.lock:
+            payload = self.payloads.get(token)
+            if payload is None: return None
+            if payload["exp"] <= time.time():
+                del self.payloads[token]
+                return None
+            self.payloads.move_to_end(token)
+            return payload
+
+    def put(self, token: str, payload: Dict):
+        with self.lock:
+            self.payloads[token] = payload
+            while len(self.payloads) > self.max_size:
+                self.payloads.popitem(last=False)
+
+    def remove_user(self, username: str):
+        with self.lock:
+            for token in [token for token, payload in self.payloads.items() if payload.get("sub") == username]:
+                del self.payloads[token]
+
+TOKEN_CACHE = TokenCache()
+USER_STORE = UserStore(USER_DATABASE_JSON_PATH)
+
 # Helper functions
 def verify_password(plain_password, hashed_password):
     hashed_password_candidate = encryption_module.hash_string(plain_text=plain_password) # uses SHA256 hashing
     return hashed_password == hashed_password_candidate
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return User(**user_dict)
+def get_user(user_store, username: str):
+    return user_store.return_user(username)
 
 def authenticate_user(user_db, username: str, password: str):
     user = get_user(user_db, username)
@@ -69,34 +160,42 @@ def authenticate_user(user_db, username: str, password: str):
 def create_access_token(data: dict, expires_delta: int = ACCESS_TOKEN_EXPIRE_MINUTES):
     to_encode = data.copy()
     expire = time.time() + expires_delta * 60
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": time.time()})
     encoded_jwt = jwt.encode(to_encode, SERVER_JWT_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-# Dependency
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def get_user_from_token(token: str):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SERVER_JWT_KEY, algorithms=[ALGORITHM])
-        print(payload)
-        username: str = payload.get("sub")
-        if username is None:
+    payload = TOKEN_CACHE.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SERVER_JWT_KEY, algorithms=[ALGORITHM])
+        except jwt.PyJWTError:
             raise credentials_exception
-    except jwt.PyJWTError:
+        if payload.get("sub") is None:
+            raise credentials_exception
+        TOKEN_CACHE.put(token, payload)
+    username: str = payload["sub"]
+    USER_STORE.reload_if_changed() # A changed user invalidates its tokens, this has to be known before the issue time is checked
+    if not USER_STORE.is_token_issue_time_valid(username, payload.get("iat")):
         raise credentials_exception
-    user = get_user(USER_DB, username)
+    user = get_user(USER_STORE, username)
     if user is None:
         raise credentials_exception
     return user
 
+# Dependency
+def get_current_user(token: str = Depends(oauth2_scheme)):
+    return get_user_from_token(token)
+
 # Routes
 @app.post("/get_token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(USER_DB, form_data.username, form_data.password)
+    user = authenticate_user(USER_STORE, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -114,6 +213,147 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 async def return_test_text(current_user: User = Depends(get_current_user)):
     return {"list_":current_user.allowed_tos}
 
+@app.get("/events/stream")
+async def stream_events(camera_uuid: List[str] = Query(None), camera_region: List[str] = Query(None), current_user: User = Depends(get_current_user)):
+    # Server-Sent Events. Optional filters: ?camera_uuid=...&camera_region=... (can be repeated)
+    subscriber = EVENT_BROADCASTER.subscribe(camera_uuids=camera_uuid, camera_regions=camera_region)
+
+    async def event_generator():
+        try:
+            while True:
+                events = await subscriber.get_events(timeout=server_preferences.EVENT_STREAM_KEEPALIVE_SECONDS)
+                if len(events) == 0:
+                    yield ": keepalive\n\n" # Keeps proxies from closing an idle connection
+                for event_json in events:
+                    yield f"data: {event_json}\n\n"
+        finally:
+            EVENT_BROADCASTER.unsubscribe(subscriber)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/events/ws")
+async def websocket_events(websocket: WebSocket, token: str = Query(...), camera_uuid: List[str] = Query(None), camera_region: List[str] = Query(None)):
+    # Browsers can not set the Authorization header of a WebSocket, so the token is passed as a query parameter
+    try:
+        get_user_from_token(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscriber = EVENT_BROADCASTER.subscribe(camera_uuids=camera_uuid, camera_regions=camera_region)
+    # The client never sends anything, but the disconnect message is only seen by receiving. Without it, an idle client that left would stay subscribed forever
+    receive_task = asyncio.ensure_future(websocket.receive())
+    try:
+        while True:
+            events_task = asyncio.ensure_future(subscriber.get_events(timeout=server_preferences.EVENT_STREAM_KEEPALIVE_SECONDS))
+            await asyncio.wait([events_task, receive_task], return_when=asyncio.FIRST_COMPLETED)
+            if receive_task.done():
+                events_task.cancel() # The queued events stay in the subscriber
+                if receive_task.result()["type"] == "websocket.disconnect": break
+                receive_task = asyncio.ensure_future(websocket.receive()) # Messages of the client are ignored
+                continue
+            for event_json in events_task.result():
+                await websocket.send_text(event_json)
+    except Exception: # WebSocketDisconnect, or a send on a connection that is already closed
+        pass
+    finally:
+        receive_task.cancel()
+        EVENT_BROADCASTER.unsubscribe(subscriber)
+
+def raise_if_camera_frames_are_on_a_worker(camera_uuid: str):
+    # The frames of a cluster stay on the workers, the coordinator only knows which worker API serves them. Tokens are issued per server, so a login is needed on the worker
+    if CLUSTER_COORDINATOR is None: return
+    api_url = CLUSTER_COORDINATOR.return_camera_api_url(camera_uuid)
+    detail = f"The frames of this camera are served by its worker at {api_url}" if api_url is not None else "This camera is not assigned to a worker serving an API"
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+@app.get("/cameras/{camera_uuid}/snapshot.jpg")
+async def camera_snapshot(camera_uuid: str, width: int = None, current_user: User = Depends(get_current_user)):
+    # Encoding runs in the thread pool so that the event loop keeps serving the other clients
+    raise_if_camera_frames_are_on_a_worker(camera_uuid)
+    frame_uuid, jpeg_bytes = await run_in_threadpool(JPEG_SNAPSHOT_CACHE.return_latest_jpeg, camera_uuid, width)
+    if jpeg_bytes is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No frame is available for this camera")
+    return Response(content=jpeg_bytes, media_type="image/jpeg", headers={"Cache-Control": "no-cache", "X-Frame-UUID": frame_uuid})
+
+@app.get("/cameras/{camera_uuid}/mjpeg")
+async def camera_mjpeg(camera_uuid: str, width: int = None, current_user: User = Depends(get_current_user)):
+    # multipart/x-mixed-replace stream, a part is sent only when the camera has a new frame
+    raise_if_camera_frames_are_on_a_worker(camera_uuid)
+    async def mjpeg_generator():
+        last_frame_uuid = None
+        while True:
+            if JPEG_SNAPSHOT_CACHE.return_latest_frame_uuid(camera_uuid) == last_frame_uuid:
+                await asyncio.sleep(server_preferences.SNAPSHOT_MJPEG_POLL_INTERVAL_SECONDS)
+                continue
+            frame_uuid, jpeg_bytes = await run_in_threadpool(JPEG_SNAPSHOT_CACHE.return_latest_jpeg, camera_uuid, width)
+            if jpeg_bytes is not None and frame_uuid != last_frame_uuid:
+                last_frame_uuid = frame_uuid
+                yield b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpeg_bytes)).encode() + b"\r\n\r\n" + jpeg_bytes + b"\r\n"
+            await asyncio.sleep(server_preferences.SNAPSHOT_MJPEG_POLL_INTERVAL_SECONDS)
+
+    return StreamingResponse(mjpeg_generator(), media_type="multipart/x-mixed-replace; boundary=frame", headers={"Cache-Control": "no-cache"})
+
+@app.get("/mosaic.jpg")
+async def camera_mosaic(current_user: User = Depends(get_current_user)):
+    if CLUSTER_COORDINATOR is not None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Each worker renders the mosaic of its own cameras, see the worker APIs in /cluster/status")
+    mosaic_version, jpeg_bytes = MOSAIC_RENDERER.return_mosaic_jpeg()
+    if jpeg_bytes is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The mosaic is not rendered")
+    return Response(content=jpeg_bytes, media_type="image/jpeg", headers={"Cache-Control": "no-cache", "X-Mosaic-Version": str(mosaic_version)})
+
+@app.get("/metrics")
+async def return_metrics(token: str = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))):
+    # Prometheus text format. Only the metrics of this process are exported, run the API with the evaluation (API_RUN_WITH_EVALUATION) to see the pipeline metrics
+    # On a cluster coordinator, the latest metrics of each worker are included with a worker_id label
+    if server_preferences.API_METRICS_REQUIRE_TOKEN:
+        if token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+        get_user_from_token(token)
+    return_prometheus_text = CLUSTER_COORDINATOR.return_metrics_text if CLUSTER_COORDINATOR is not None else metrics_module.METRICS.return_prometheus_text
+    return PlainTextResponse(content=await run_in_threadpool(return_prometheus_text), media_type="text/plain; version=0.0.4")
+
+# Cluster dependency
+def verify_cluster_worker(request: Request, x_cluster_secret: str = Header(None)):
+    # Workers authenticate with the shared secret. Without a secret, only workers on this machine are accepted
+    if CLUSTER_COORDINATOR is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This server is not a cluster coordinator")
+    if server_preferences.CLUSTER_SHARED_SECRET is None:
+        if request.client is None or request.client.host not in ["127.0.0.1", "::1", "localhost"]:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="CLUSTER_SHARED_SECRET is required for remote workers")
+    elif x_cluster_secret is None or not secrets.compare_digest(x_cluster_secret.encode("utf-8"), server_preferences.CLUSTER_SHARED_SECRET.encode("utf-8")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid cluster secret")
+
+@app.post("/cluster/heartbeat")
+async def cluster_heartbeat(request: Request, _: None = Depends(verify_cluster_worker)):
+    return CLUSTER_COORDINATOR.handle_heartbeat(await request.json())
+
+@app.post("/cluster/results")
+async def cluster_results(request: Request, _: None = Depends(verify_cluster_worker)):
+    # The results are passed to the event store and the event broadcaster like the results of a local pipeline
+    payload = await request.json()
+    await run_in_threadpool(CLUSTER_COORDINATOR.add_result_transfer_dicts, payload["results"])
+    return {"number_of_results": len(payload["results"])}
+
+@app.post("/cluster/leave")
+async def cluster_leave(request: Request, _: None = Depends(verify_cluster_worker)):
+    payload = await request.json()
+    CLUSTER_COORDINATOR.handle_leave(payload["worker_id"])
+    return {"message": f"Worker {payload['worker_id']} left the cluster"}
+
+@app.get("/cluster/status")
+async def cluster_status(request: Request, x_cluster_secret: str = Header(None), token: str = Depends(OAuth2PasswordBearer(tokenUrl="token", auto_error=False))):
+    # Users authenticate with their token, scripts and workers like the other cluster endpoints (see scripts/run_local_cluster.py)
+    if token is not None:
+        get_user_from_token(token)
+        if CLUSTER_COORDINATOR is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This server is not a cluster coordinator")
+    else:
+        verify_cluster_worker(request, x_cluster_secret)
+    return CLUSTER_COORDINATOR.return_status()
+
 #Run the application
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,133 @@
+import time, json, platform, os, datetime
+from typing import Dict, List, Tuple
+
+import camera_module
+import evaluation_module
+import pipeline_module
+import frame_source_module
+import server_preferences
+
+class PipelineBenchmark:
+    # Runs the whole pipeline (fetching, decoding, evaluation, result sinks) on synthetic cameras and measures its throughput and latencies
+    # Results are plain dictionaries so that they can be saved as JSON and compared between commits to catch regressions
+    BENCHMARK_FORMAT_VERSION = 1
+
+    def __init__(self, fps:float = None, frame_size:Tuple[int,int] = None, number_of_people:int = None, video_path:str = None, yolo_model_to_use:str = None, rule_polygon:List[List[float]] = None) -> None:
+        self.fps = fps
+        self.frame_size = frame_size
+        self.number_of_people = number_of_people
+        self.video_path = video_path
+        self.yolo_model_to_use = yolo_model_to_use if yolo_model_to_use is not None else server_preferences.BENCHMARK_YOLO_MODEL
+        self.rule_polygon = rule_polygon
+
+    def run(self, number_of_cameras:int = None, warmup_seconds:float = None, duration_seconds:float = None) -> Dict:
+        warmup_seconds = warmup_seconds if warmup_seconds is not None else server_preferences.BENCHMARK_WARMUP_SECONDS
+        duration_seconds = duration_seconds if duration_seconds is not None else server_preferences.BENCHMARK_DURATION_SECONDS
+
+        camera_configs = frame_source_module.return_synthetic_camera_configs(number_of_cameras = number_of_cameras, fps = self.fps, frame_size = self.frame_size, number_of_people = self.number_of_people, video_path = self.video_path, yolo_model_to_use = self.yolo_model_to_use, rule_polygon = self.rule_polygon)
+        stream_manager = camera_module.StreamManager(camera_configs = camera_configs)
+        evaluation_manager = evaluation_module.EvaluationManager(yolo_models_to_be_used = stream_manager.return_yolo_models_to_use())
+        evaluation_manager.model_registry.return_detector(model_name = self.yolo_model_to_use) # Loading the model is not part of the measurement
+        evaluation_pipeline = pipeline_module.EvaluationPipeline(stream_manager = stream_manager, evaluation_manager = evaluation_manager)
+        number_of_results = [0]
+        evaluation_pipeline.add_result_sink(result_sink = lambda evaluation_result: number_of_results.__setitem__(0, number_of_results[0] + 1))
+
+        try:
+            evaluation_pipeline.start()
+            stream_manager.start_cameras_by_uuid(camera_uuids = [])
+            time.sleep(warmup_seconds)
+
+            # Latency windows are cleared so that only the measurement period is reported
+            for latencies in [evaluation_pipeline.capture_to_evaluation_latencies, evaluation_pipeline.queue_wait_latencies, evaluation_pipeline.evaluation_call_latencies] + [camera.recent_decode_durations for camera in stream_manager.cameras]:
+                latencies.clear()
+            start_counters = self.__return_counters(stream_manager = stream_manager, evaluation_pipeline = evaluation_pipeline, number_of_results = number_of_results[0])
+            time.sleep(duration_seconds)
+            end_counters = self.__return_counters(stream_manager = stream_manager, evaluation_pipeline = evaluation_pipeline, number_of_results = number_of_results[0])
+            decode_durations = [decode_duration for camera in stream_manager.cameras for decode_duration in list(camera.recent_decode_durations)]
+        finally:
+            evaluation_pipeline.stop()
+            stream_manager.stop_supervisor()
+            stream_manager.stop_cameras_by_uuid(camera_uuids = [])
+
+        elapsed_seconds = end_counters["time"] - start_counters["time"]
+        counter_deltas = {counter_name: end_counters[counter_name] - start_counters[counter_name] for counter_name in ["frames_grabbed", "frames_decoded", "frames_evaluated", "frames_dropped", "evaluation_results", "cpu_seconds"]}
+        cpu_percent = 100*counter_deltas["cpu_seconds"]/elapsed_seconds
+        return {
+            "number_of_cameras": number_of_cameras,
+            "measured_seconds": elapsed_seconds,
+            "fetched_fps": counter_deltas["frames_grabbed"]/elapsed_seconds,
+            "decoded_fps": counter_deltas["frames_decoded"]/elapsed_seconds,
+            "evaluated_fps": counter_deltas["frames_evaluated"]/elapsed_seconds,
+            "evaluated_fps_per_camera": counter_deltas["frames_evaluated"]/elapsed_seconds/number_of_cameras,
+            "frames_dropped_in_queues": counter_deltas["frames_dropped"],
+            "evaluation_results": counter_deltas["evaluation_results"],
+            "evaluation_results_dropped": evaluation_pipeline.number_of_results_dropped,
+            "latency_ms": {
+                "decode": self.__return_percentiles_ms(samples = decode_durations),
+                "queue_wait": self.__return_percentiles_ms(samples = list(evaluation_pipeline.queue_wait_latencies)),
+                "evaluation_call": self.__return_percentiles_ms(samples = list(evaluation_pipeline.evaluation_call_latencies)),
+                "capture_to_evaluation": self.__return_percentiles_ms(samples = list(evaluation_pipeline.capture_to_evaluation_latencies)),
+            },
+            "model_inference_ms_per_frame": evaluation_manager.model_inference_ms_per_frame.get(self.yolo_model_to_use),
+            "cpu_percent": cpu_percent, # 100 means one fully used core
+            "cpu_percent_per_camera": cpu_percent/number_of_cameras,
+            "rss_start_bytes": start_counters["rss_bytes"],
+            "rss_end_bytes": end_counters["rss_bytes"],
+            "rss_growth_bytes": end_counters["rss_bytes"] - start_counters["rss_bytes"] if start_counters["rss_bytes"] is not None and end_counters["rss_bytes"] is not None else None,
+        }
+
+    def run_camera_sweep(self, camera_counts:List[int] = None, warmup_seconds:float = None, duration_seconds:float = None) -> Dict:
+        # Runs the benchmark once for each number of cameras, e.g. [1, 2, 4, 8]
+        runs = []
+        for number_of_cameras in camera_counts:
+            runs.append(self.run(number_of_cameras = number_of_cameras, warmup_seconds = warmup_seconds, duration_seconds = duration_seconds))
+            if server_preferences.CAMERA_VERBOSE or server_preferences.PIPELINE_VERBOSE: print(json.dumps(runs[-1], indent=4))
+        return {
+            "benchmark_format_version": PipelineBenchmark.BENCHMARK_FORMAT_VERSION,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "platform": {"system": platform.system(), "machine": platform.machine(), "python_version": platform.python_version(), "cpu_count": os.cpu_count()},
+            "settings": {
+                "fps": self.fps if self.fps is not None else server_preferences.SYNTHETIC_DEFAULT_FPS,
+                "frame_size": list(self.frame_size if self.frame_size is not None else server_preferences.SYNTHETIC_DEFAULT_FRAME_SIZE),
+                "number_of_people": self.number_of_people if self.number_of_people is not None else server_preferences.SYNTHETIC_DEFAULT_NUMBER_OF_PEOPLE,
+                "video_path": self.video_path,
+                "yolo_model_to_use": self.yolo_model_to_use,
+                "inference_backend": server_preferences.INFERENCE_BACKENDS.get(self.yolo_model_to_use, "pytorch"),
+                "evaluation_budget_mode": server_preferences.EVALUATION_BUDGET_MODE,
+                "camera_decoder_processes": server_preferences.CAMERA_DECODER_PROCESSES,
+            },
+            "runs": runs,
+        }
+
+    def __return_counters(self, stream_manager = None, evaluation_pipeline = None, number_of_results:int = None) -> Dict:
+        # In decoder process mode the frames are grabbed and decoded in the child processes, only the published frames are counted
+        return {
+            "time": time.time(),
+            "frames_grabbed": sum(camera.number_of_frames_grabbed for camera in stream_manager.cameras),
+            "frames_decoded": sum(camera.number_of_frames_fetched for camera in stream_manager.cameras),
+            "frames_evaluated": evaluation_pipeline.number_of_frames_evaluated,
+            "frames_dropped": evaluation_pipeline.frame_queues.number_of_frames_dropped,
+            "evaluation_results": number_of_results,
+            "cpu_seconds": time.process_time(), # All threads of this process
+            "rss_bytes": self.__return_rss_bytes(),
+        }
+
+    def __return_percentiles_ms(self, samples:List[float] = None) -> Dict:
+        samples = sorted(samples)
+        if len(samples) == 0:
+            return {"number_of_samples": 0, "p50": None, "p95": None, "p99": None, "max": None}
+        return {
+            "number_of_samples": len(samples),
+            "p50": 1000*samples[int(0.50*(len(samples)-1))],
+            "p95": 1000*samples[int(0.95*(len(samples)-1))],
+            "p99": 1000*samples[int(0.99*(len(samples)-1))],
+            "max": 1000*samples[-1],
+        }
+
+    def __return_rss_bytes(self) -> int:
+        # Resident memory of this process, None if it can not be read on this platform
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
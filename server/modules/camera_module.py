@@ -1,12 +1,26 @@
-import random, threading, time, json, math, uuid, platform
+import random, threading, time, json, uuid, platform, os, concurrent.futures, collections
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Set, Callable
 import cv2
 import numpy as np
 
 import server_preferences
+import decoder_process_module
+import mosaic_module
+import frame_source_module
+import metrics_module
+import inference_backend_module
+
+def return_camera_configs_json_path() -> Path:
+    # The static database, shared with the API (users) and the cluster coordinator
+    CAMERA_MODULE_PATH = Path(__file__).resolve()
+    if platform.system() == "Linux":
+        return CAMERA_MODULE_PATH.parent.parent.parent.parent / "safety_AI_volume" / "static_database.json"
+    return CAMERA_MODULE_PATH.parent.parent / "configs" / "camera_configs.json"
 
 class CameraStreamFetcher:
+    IN_PLACE_CONFIG_KEYS = ['camera_region', 'camera_description', 'active_rules'] # Config keys that can be changed without reopening the stream
+
     def __init__(self, **kwargs )->None:         
         for key in server_preferences.CAMERA_CONFIG_KEYS:
             if key not in kwargs.keys():
@@ -14,18 +28,48 @@ class CameraStreamFetcher:
               
         for key, value in kwargs.items():
             setattr(self, key, value)
-
-        self.camera_fetching_delay = random.uniform(server_preferences.CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE[0], server_preferences.CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE[1]) # Randomize the fetching delay a little bit so that the cameras are not synchronized which may cause a bottleneck
+        self.camera_config = dict(kwargs) # Kept to recreate the camera in another process (see decoder_process_module)
+        self.detection_stream_path = kwargs.get("detection_stream_path", None) # Optional low resolution stream (e.g. NVR sub-stream) that is decoded continuously for detection. If set, stream_path is only opened to fetch evidence frames
+        self.frame_source = kwargs.get("frame_source", None) # Optional frame_source_module.SyntheticFrameSource arguments (fps, frame_size, number_of_people, video_path, seed). If set, frames are read from it instead of the RTSP streams
+        self.record_clips = kwargs.get("record_clips", True) # Optional. If False, the frames of this camera are not buffered even if a clip recorder is attached
+
+        # Rate controller: a frame is retrieved and decoded only about as often as the evaluator consumes the frames of this camera
+        self.camera_fetching_delay = server_preferences.CAMERA_INITIAL_FETCHING_DELAY_SECONDS
+        self.fetching_delay_override = None # If set, used as the fetching delay instead of the controller's (e.g. the delay calculated by the evaluation process for a decoder process)
+        self.decode_duration_seconds = None # Moving average of the duration of cap.retrieve()
+        self.evaluation_interval_seconds = None # Moving average of the interval between the evaluations of the frames of this camera
+        self.last_evaluation_time = None
+        self.number_of_frames_overwritten_unevaluated = 0
         self.is_fetching_frames = False
         self.last_frame_info = None # keys -> frame, camera_uuid, frame_uuid, frame_timestamp, active_rules, is_evaluated
         self.number_of_frames_fetched = 0
+        self.number_of_frames_grabbed = 0
+        self.recent_decode_durations = collections.deque(maxlen=server_preferences.PIPELINE_LATENCY_WINDOW_SIZE) # seconds, used for the latency statistics
         self.camera_score = 0 #A positive real number that represent how 'useful' the camera is. The higher the score, the more source is allocated to the camera by the StreamManager
+        self.frame_queues = None # If set, every new frame is also pushed to these queues (see pipeline_module.CameraFrameQueues)
+        self.clip_recorder = None # If set, frames are also added to its buffers at CLIP_RECORDER_FPS (see clip_recorder_module.ClipRecorder)
+        self.last_clip_frame_timestamp = 0
+        self.thread = None
+        self.motion_background = None # Running average of the downscaled grayscale frames, used to calculate the motion score of the new frames
+
+        # Stream health, managed together with the StreamManager's supervisor
+        self.health_state = "stopped" # stopped, connecting, streaming, backing_off, failed
+        self.reconnect_attempts = 0 # Number of consecutive reconnect attempts without a successful grab
+        self.next_reconnect_time = 0 # The supervisor restarts a backing off camera after this timestamp
+        self.last_successful_grab_time = 0
+        self.is_stall_detected = False # Set by the supervisor if no frame is grabbed for CAMERA_GRAB_TIMEOUT_SECONDS, the fetching thread then reopens the stream
+
+        # The counters of the camera are exported by the StreamManager's metrics collector. In decoder process mode grab() runs in the decoder processes and is not measured here
+        self.grab_duration_histogram = metrics_module.METRICS.histogram(name = "safety_ai_camera_grab_seconds", help_text = "Duration of grab() on the detection stream", labels = {"camera_uuid": self.camera_uuid})
+        self.retrieve_duration_histogram = metrics_module.METRICS.histogram(name = "safety_ai_camera_retrieve_seconds", help_text = "Duration of retrieve() (decoding) on the detection stream", labels = {"camera_uuid": self.camera_uuid})
            
     def get_last_frame_info(self):
         return self.last_frame_info
     
     def start_fetching_frames(self):
         self.is_fetching_frames = True
+        self.is_stall_detected = False
+        self.health_state = "connecting"
         self.thread = threading.Thread(target=self.__IP_camera_frame_fetching_thread)
         self.thread.daemon = True # Set the thread as a daemon means that it will stop when the main program stops
         self.thread.start()   
@@ -33,34 +77,102 @@ class CameraStreamFetcher:
 
     def stop_fetching_frames(self):
         self.is_fetching_frames = False  
-        self.thread.join()
+        if self.thread is not None: self.thread.join()
         self.thread = None
+        self.health_state = "stopped"
+        self.reconnect_attempts = 0
 
-    def update_camera_fetching_delay(self, new_delay:float = None):
-        if self.is_fetch_without_delay:
-            raise ValueError(f"Camera {self.camera_ip_address} is set to fetch frames without delay. Cannot change the fetching delay")
-        self.soon_camera_fetching_delay = new_delay
-
-    def set_last_frame_as_evaluated_if_frame_uuid_matches(self, frame_uuids:List[str]=[]):
-        if self.last_frame_info is not None and self.last_frame_info["frame_uuid"] in frame_uuids:
+    def fetch_evidence_frame(self) -> np.ndarray:
+        # Opens the high resolution stream just to decode a single frame. Returns None if no frame could be decoded in time
+        cap = self.__open_stream(stream_path = self.stream_path)
+        try:
+            start_time = time.time()
+            while cap.isOpened() and time.time() - start_time < server_preferences.CAMERA_EVIDENCE_FRAME_TIMEOUT_SECONDS:
+                ret, frame = cap.read() # The decoder starts from the first keyframe it receives
+                if ret: return frame
+            return None
+        finally:
+            cap.release()
+
+    def record_decode_duration(self, decode_duration_seconds:float = None):
+        self.recent_decode_durations.append(decode_duration_seconds)
+        self.retrieve_duration_histogram.observe(decode_duration_seconds)
+        self.decode_duration_seconds = self.__smooth(self.decode_duration_seconds, decode_duration_seconds)
+        self.__update_camera_fetching_delay()
+
+    def set_last_frame_as_evaluated_if_frame_uuid_matches(self, frame_uuids:Set[str]=()):
+        if self.last_frame_info is not None and self.last_frame_info["frame_uuid"] in frame_uuids and not self.last_frame_info["is_evaluated"]:
             self.last_frame_info["is_evaluated"] = True
 
+            now = time.time()
+            if self.last_evaluation_time is not None:
+                self.evaluation_interval_seconds = self.__smooth(self.evaluation_interval_seconds, now - self.last_evaluation_time)
+            self.last_evaluation_time = now
+            self.__update_camera_fetching_delay()
+
+    def __update_camera_fetching_delay(self):
+        if self.fetching_delay_override is not None:
+            self.camera_fetching_delay = self.fetching_delay_override
+            return
+
+        fetching_delay = server_preferences.CAMERA_INITIAL_FETCHING_DELAY_SECONDS if self.evaluation_interval_seconds is None else self.evaluation_interval_seconds*server_preferences.CAMERA_FETCH_TO_EVALUATION_INTERVAL_RATIO
+        if self.decode_duration_seconds is not None:
+            fetching_delay = max(fetching_delay, self.decode_duration_seconds/server_preferences.CAMERA_MAX_DECODE_DUTY_CYCLE)
+        fetching_delay = min(server_preferences.CAMERA_MAX_FETCHING_DELAY_SECONDS, max(server_preferences.CAMERA_MIN_FETCHING_DELAY_SECONDS, fetching_delay))
+        self.camera_fetching_delay = fetching_delay*random.uniform(1-server_preferences.CAMERA_FETCHING_DELAY_JITTER_RATIO, 1)
+
+    def __smooth(self, average:float = None, measurement:float = None) -> float:
+        if average is None: return measurement
+        return (1-server_preferences.CAMERA_RATE_CONTROLLER_SMOOTHING)*average + server_preferences.CAMERA_RATE_CONTROLLER_SMOOTHING*measurement
+
+    def __open_stream(self, stream_path:str = None) -> cv2.VideoCapture:
+        if self.frame_source is not None:
+            return frame_source_module.SyntheticFrameSource(**self.frame_source)
+        url = f'rtsp://{self.username}:{self.password}@{self.camera_ip_address}/{stream_path}'
+        timeout_msec = int(server_preferences.CAMERA_GRAB_TIMEOUT_SECONDS*1000) # Prevents grab() from blocking for a long time on a stalled stream
+        return cv2.VideoCapture(url, cv2.CAP_FFMPEG, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_msec, cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_msec])
+
     def __IP_camera_frame_fetching_thread(self):
+        cap = None
         try:
-            url = f'rtsp://{self.username}:{self.password}@{self.camera_ip_address}/{self.stream_path}'
-            cap = cv2.VideoCapture(url)
+            cap = self.__open_stream(stream_path = self.detection_stream_path if self.detection_stream_path is not None else self.stream_path)
+            if not cap.isOpened():
+                raise ConnectionError(f"Could not open the stream of {self.camera_ip_address}")
 
             buffer_size_in_frames = 1
             cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size_in_frames)
 
+            self.last_successful_grab_time = time.time()
+            consecutive_grab_failures = 0
             while self.is_fetching_frames:   
-                if not cap.grab():# Use grab() to capture the frame but not decode it yet for better performance
+                if self.is_stall_detected:
+                    raise ConnectionError(f"Stream of {self.camera_ip_address} is stalled")
+
+                grab_start_time = time.perf_counter()
+                is_grabbed = cap.grab() # Use grab() to capture the frame but not decode it yet for better performance
+                self.grab_duration_histogram.observe(time.perf_counter() - grab_start_time)
+                if not is_grabbed:
+                    consecutive_grab_failures += 1
+                    if consecutive_grab_failures >= server_preferences.CAMERA_MAX_CONSECUTIVE_GRAB_FAILURES or time.time() - self.last_successful_grab_time > server_preferences.CAMERA_GRAB_TIMEOUT_SECONDS:
+                        raise ConnectionError(f"Could not grab a frame from {self.camera_ip_address} {consecutive_grab_failures} times in a row")
+                    time.sleep(server_preferences.CAMERA_GRAB_RETRY_DELAY_SECONDS) # Do not spin while the stream is not providing frames
                     continue 
-                
 
+                consecutive_grab_failures = 0
+                self.number_of_frames_grabbed += 1
+                self.last_successful_grab_time = time.time()
+                if self.health_state != "streaming":
+                    self.health_state = "streaming"
+                    self.reconnect_attempts = 0
+
+                frame = None
                 if self.last_frame_info == None or (time.time() - self.last_frame_info["frame_timestamp"] > self.camera_fetching_delay): #NOTE: If frame is none,  
+                    retrieve_start_time = time.time()
                     ret, frame = cap.retrieve()
                     if ret:
+                        self.record_decode_duration(decode_duration_seconds = time.time() - retrieve_start_time)
+                        if self.last_frame_info is not None and not self.last_frame_info["is_evaluated"]:
+                            self.number_of_frames_overwritten_unevaluated += 1
                         self.last_frame_info = {}
                         self.last_frame_info["frame"] = frame
                         self.last_frame_info["camera_uuid"] = self.camera_uuid
@@ -68,75 +180,330 @@ class CameraStreamFetcher:
                         self.last_frame_info["frame_timestamp"] = time.time()
                         self.last_frame_info["active_rules"] = self.active_rules
                         self.last_frame_info["is_evaluated"] = False
+                        self.last_frame_info["motion_score"] = self.__calculate_motion_score(frame)
+                        self.last_frame_info["decode_duration_seconds"] = self.decode_duration_seconds
+                        if server_preferences.CAMERA_PREPARE_MODEL_INPUTS and self.last_frame_info["motion_score"] >= server_preferences.EVALUATION_MOTION_SCORE_THRESHOLD: # Static frames are most likely skipped by the evaluation
+                            self.last_frame_info["model_inputs"] = inference_backend_module.return_model_inputs(frame_info = self.last_frame_info, image_size = server_preferences.INFERENCE_IMAGE_SIZE)
+                        if self.frame_queues is not None: self.frame_queues.put(self.last_frame_info)
                         self.number_of_frames_fetched += 1
-                        self.camera_fetching_delay = random.uniform(server_preferences.CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE[0], server_preferences.CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE[1]) # Randomize the fetching delay a little bit so that the cameras are not synchronized which may cause a bottleneck
                         if server_preferences.CAMERA_VERBOSE: print(f'{self.number_of_frames_fetched:8d} |: Got a frame from {self.camera_ip_address} at {time.time()}')
                     else:
                         if server_preferences.CAMERA_VERBOSE: print(f'{self.number_of_frames_fetched:8d} |: Could not retrieve frame from {self.camera_ip_address} at {time.time()}')
                         continue
 
-            cap.release()           
+                # Clip frames are decoded at their own rate, the frame decoded for the evaluation is reused if there is one
+                if self.clip_recorder is not None and self.record_clips and time.time() - self.last_clip_frame_timestamp >= 1/server_preferences.CLIP_RECORDER_FPS:
+                    if frame is None:
+                        retrieve_start_time = time.perf_counter()
+                        ret, frame = cap.retrieve()
+                        self.retrieve_duration_histogram.observe(time.perf_counter() - retrieve_start_time)
+                    if frame is not None:
+                        self.last_clip_frame_timestamp = time.time()
+                        self.clip_recorder.add_frame(camera_uuid = self.camera_uuid, frame = frame, frame_timestamp = self.last_clip_frame_timestamp)
+
         except Exception as e:
             if server_preferences.CAMERA_VERBOSE: print(f'Error in fetching frames from {self.camera_ip_address}: {e}')
+            if self.is_fetching_frames: self.__schedule_reconnect() # The thread is not stopped on purpose, let the supervisor reopen the stream
+        finally:
+            if cap is not None: cap.release()
 
         self.is_fetching_frames = False
 
-class StreamManager:
-    def __init__(self) -> None:        
-        CAMERA_MODULE_PATH = Path(__file__).resolve()
+    def __schedule_reconnect(self):
+        # Exponential backoff with jitter so that the cameras of a restarted NVR do not reconnect all at once
+        self.reconnect_attempts += 1
+        if server_preferences.CAMERA_MAX_RECONNECT_ATTEMPTS is not None and self.reconnect_attempts > server_preferences.CAMERA_MAX_RECONNECT_ATTEMPTS:
+            self.health_state = "failed"
+            return
+
+        backoff_seconds = min(server_preferences.CAMERA_RECONNECT_MAX_BACKOFF_SECONDS, server_preferences.CAMERA_RECONNECT_BASE_BACKOFF_SECONDS * 2**(self.reconnect_attempts-1))
+        backoff_seconds *= random.uniform(1-server_preferences.CAMERA_RECONNECT_BACKOFF_JITTER_RATIO, 1)
+        self.next_reconnect_time = time.time() + backoff_seconds
+        self.health_state = "backing_off"
+        if server_preferences.CAMERA_VERBOSE: print(f'Reconnecting to {self.camera_ip_address} in {backoff_seconds:.1f} seconds (attempt {self.reconnect_attempts})')
+
+    def __calculate_motion_score(self, frame:np.ndarray = None) -> float:
+        # Returns the ratio of the pixels that differ from the running background on a heavily downscaled grayscale copy of the frame. 0.0 means a static scene
+        frame_height, frame_width = frame.shape[:2]
+        downscaled_width = server_preferences.CAMERA_MOTION_DOWNSCALED_WIDTH
+        downscaled_height = max(1, int(frame_height * downscaled_width / frame_width))
+        downscaled_gray = cv2.cvtColor(cv2.resize(frame, (downscaled_width, downscaled_height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+        if self.motion_background is None or self.motion_background.shape != downscaled_gray.shape:
+            self.motion_background = downscaled_gray
+            return 1.0 # Nothing to compare with, consider the frame as moving so that it is not skipped
 
-        is_linux = platform.system() == "Linux"
-        if is_linux:
-            CAMERA_CONFIGS_JSON_PATH = CAMERA_MODULE_PATH.parent.parent.parent.parent / "safety_AI_volume" / "static_database.json"
+        changed_pixels = cv2.absdiff(downscaled_gray, self.motion_background) > server_preferences.CAMERA_MOTION_PIXEL_DIFFERENCE_THRESHOLD
+        cv2.accumulateWeighted(downscaled_gray, self.motion_background, server_preferences.CAMERA_MOTION_BACKGROUND_LEARNING_RATE)
+        return float(np.count_nonzero(changed_pixels)) / changed_pixels.size
+
+class StreamManager:
+    def __init__(self, camera_configs:List[Dict] = None) -> None:        
+        # If camera_configs is not provided, the cameras are loaded from the static database
+        self.camera_configs_json_path = None
+        self.camera_configs_json_mtime = None
+        if camera_configs is not None:
+            self.CAMERA_CONFIGS = camera_configs
         else:
-            CAMERA_CONFIGS_JSON_PATH = CAMERA_MODULE_PATH.parent.parent / "configs" / "camera_configs.json"
-        print(CAMERA_CONFIGS_JSON_PATH)
-        with open(CAMERA_CONFIGS_JSON_PATH, "r") as f:
-            self.CAMERA_CONFIGS= json.load(f)["cameras"]
+            self.camera_configs_json_path = return_camera_configs_json_path()
+            print(self.camera_configs_json_path)
+            self.camera_configs_json_mtime = os.stat(self.camera_configs_json_path).st_mtime_ns
+            with open(self.camera_configs_json_path, "r") as f:
+                self.CAMERA_CONFIGS= json.load(f)["cameras"]
         
         # Create camera objects for alive cameras
-        self.cameras = []
+        self.cameras = [] # Replaced as a whole when the configs are reconciled, so that other threads can iterate over it without locking
         for camera_config in self.CAMERA_CONFIGS:
             if not camera_config["is_alive"]: continue
 
             camera = CameraStreamFetcher(**camera_config)
             self.cameras.append(camera)
+        self.__check_ip_collisions(cameras = self.cameras)
+
+        # The supervisor detects stalled or dead streams and restarts them with backoff
+        self.cameras_lock = threading.Lock()
+        self.supervisor_stop_event = threading.Event()
+        self.supervisor_thread = None
 
-        # Check for IP collisions (Consider only the initialized cameras)
+        # Evidence frames are fetched from the high resolution streams in the background, at most one at a time per camera
+        self.evidence_executor = concurrent.futures.ThreadPoolExecutor(max_workers=server_preferences.CAMERA_EVIDENCE_WORKERS)
+        self.evidence_lock = threading.Lock()
+        self.cameras_fetching_evidence = set()
+
+        # If CAMERA_DECODER_PROCESSES > 0, the streams are decoded in separate processes instead of the fetching threads of this process
+        self.decoder_process_pool = None
+
+        self.mosaic_renderer = None # Created by show_all_frames
+
+        self.frame_queues = None # Attached to the cameras created while reconciling the configs
+        self.clip_recorder = None # Attached to the cameras created while reconciling the configs
+        self.config_watcher_stop_event = threading.Event()
+        self.config_watcher_thread = None
+
+        metrics_module.METRICS.register_collector(collector_name = "stream_manager", collector = self.return_metrics)
+
+    def __check_ip_collisions(self, cameras:List[CameraStreamFetcher] = None):
+        # Consider only the initialized cameras
         assigned_ips = []
-        for camera in self.cameras:
+        for camera in cameras:
             if camera.camera_ip_address in assigned_ips:
                 raise ValueError(f"IP address {camera.camera_ip_address} is already assigned to another camera")
             assigned_ips.append(camera.camera_ip_address)
 
+    def reconcile_camera_configs(self, camera_configs:List[Dict] = None) -> Dict[str, List[str]]:
+        # Applies a new camera list without restarting the cameras that did not change
+        # - Cameras whose stream settings changed are recreated, the others keep their stream and state
+        # - Changes of the rules, region or description are applied in place and take effect from the next frame
+        # In decoder process mode the decoder processes are restarted if any stream is added, removed or changed
+        # Returns the uuids of the "added", "removed", "restarted" and "updated" cameras
+        new_camera_configs = {camera_config["camera_uuid"]: camera_config for camera_config in camera_configs if camera_config["is_alive"]}
+        changes = {"added": [], "removed": [], "restarted": [], "updated": []}
+
+        with self.cameras_lock:
+            current_cameras = {camera.camera_uuid: camera for camera in self.cameras}
+            cameras_to_stop, cameras_to_start, new_cameras = [], [], []
+            for camera_uuid, camera in current_cameras.items():
+                if camera_uuid not in new_camera_configs:
+                    cameras_to_stop.append(camera)
+                    changes["removed"].append(camera_uuid)
+
+            for camera_uuid, camera_config in new_camera_configs.items():
+                camera = current_cameras.get(camera_uuid)
+                if camera is None:
+                    camera = CameraStreamFetcher(**camera_config)
+                    cameras_to_start.append(camera)
+                    changes["added"].append(camera_uuid)
+                elif self.__return_stream_config(camera.camera_config) != self.__return_stream_config(camera_config):
+                    cameras_to_stop.append(camera)
+                    camera = CameraStreamFetcher(**camera_config)
+                    cameras_to_start.append(camera)
+                    changes["restarted"].append(camera_uuid)
+                elif camera.camera_config != camera_config:
+                    for key in CameraStreamFetcher.IN_PLACE_CONFIG_KEYS:
+                        setattr(camera, key, camera_config.get(key))
+                    camera.camera_config = dict(camera_config)
+                    changes["updated"].append(camera_uuid)
+                new_cameras.append(camera)
+            self.__check_ip_collisions(cameras = new_cameras)
+
+            is_using_decoder_processes = self.decoder_process_pool is not None
+            if is_using_decoder_processes and len(cameras_to_stop) + len(cameras_to_start) > 0:
+                self.decoder_process_pool.stop()
+                self.decoder_process_pool = None
+            else:
+                for camera in cameras_to_stop:
+                    camera.stop_fetching_frames()
+
+            for camera_uuid in changes["removed"]:
+                metrics_module.METRICS.remove_metrics(labels = {"camera_uuid": camera_uuid})
+                if self.clip_recorder is not None: self.clip_recorder.remove_camera(camera_uuid = camera_uuid)
+            for camera in cameras_to_start:
+                camera.frame_queues = self.frame_queues
+                camera.clip_recorder = self.clip_recorder
+            self.cameras = new_cameras
+            self.CAMERA_CONFIGS = camera_configs
+
+            if not is_using_decoder_processes:
+                for camera in cameras_to_start:
+                    camera.start_fetching_frames()
+
+        if is_using_decoder_processes and self.decoder_process_pool is None:
+            self.start_cameras_by_uuid(camera_uuids = [])
+
+        if server_preferences.CAMERA_VERBOSE: print(f'Camera configs are reconciled at {time.time()}: {changes}')
+        return changes
+
+    def __return_stream_config(self, camera_config:Dict = None) -> Dict:
+        return {key: value for key, value in camera_config.items() if key not in CameraStreamFetcher.IN_PLACE_CONFIG_KEYS}
+
+    def start_config_watcher(self, on_camera_configs_reconciled:Callable = None):
+        # Reconciles the cameras whenever the static database changes on disk. on_camera_configs_reconciled is called with the changes (see reconcile_camera_configs)
+        if self.config_watcher_thread is not None or self.camera_configs_json_path is None: return
+        self.config_watcher_stop_event.clear()
+        self.config_watcher_thread = threading.Thread(target=self.__config_watcher_thread, args=(on_camera_configs_reconciled,))
+        self.config_watcher_thread.daemon = True
+        self.config_watcher_thread.start()
+
+    def stop_config_watcher(self):
+        if self.config_watcher_thread is None: return
+        self.config_watcher_stop_event.set()
+        self.config_watcher_thread.join()
+        self.config_watcher_thread = None
+
+    def __config_watcher_thread(self, on_camera_configs_reconciled:Callable = None):
+        while not self.config_watcher_stop_event.wait(timeout=server_preferences.CAMERA_CONFIG_CHECK_INTERVAL_SECONDS):
+            try:
+                camera_configs_json_mtime = os.stat(self.camera_configs_json_path).st_mtime_ns
+                if camera_configs_json_mtime == self.camera_configs_json_mtime: continue
+                with open(self.camera_configs_json_path, "r") as f:
+                    camera_configs = json.load(f)["cameras"]
+                for camera_config in camera_configs:
+                    for key in server_preferences.CAMERA_CONFIG_KEYS:
+                        if key not in camera_config: raise ValueError(f"Missing camera config argument. Required: {key}")
+                self.camera_configs_json_mtime = camera_configs_json_mtime
+
+                changes = self.reconcile_camera_configs(camera_configs = camera_configs)
+                if on_camera_configs_reconciled is not None: on_camera_configs_reconciled(changes)
+            except Exception as e: # Invalid or partially written file, the running cameras are kept until a valid file is saved
+                if server_preferences.CAMERA_VERBOSE: print(f'Could not reconcile the camera configs at {time.time()}: {e}')
+
+    def start_supervisor(self):
+        if self.supervisor_thread is not None: return
+        self.supervisor_stop_event.clear()
+        self.supervisor_thread = threading.Thread(target=self.__supervisor_thread)
+        self.supervisor_thread.daemon = True
+        self.supervisor_thread.start()
+
+    def stop_supervisor(self):
+        if self.supervisor_thread is None: return
+        self.supervisor_stop_event.set()
+        self.supervisor_thread.join()
+        self.supervisor_thread = None
+
+    def return_camera_health_states(self) -> Dict[str, Dict]:
+        camera_health_states = {}
+        for camera in self.cameras:
+            camera_health_states[camera.camera_uuid] = {"health_state": camera.health_state, "reconnect_attempts": camera.reconnect_attempts, "last_successful_grab_time": camera.last_successful_grab_time}
+        return camera_health_states
+
+    def return_metrics(self) -> List[tuple]:
+        # Metrics collector, called at scrape time: (name, type, help, labels, value) of each camera
+        metrics = []
+        for camera in self.cameras:
+            labels = {"camera_uuid": camera.camera_uuid}
+            metrics.append(("safety_ai_camera_frames_grabbed_total", "counter", "Frames grabbed from the detection stream", labels, camera.number_of_frames_grabbed))
+            metrics.append(("safety_ai_camera_frames_fetched_total", "counter", "Frames decoded and published to the evaluation", labels, camera.number_of_frames_fetched))
+            metrics.append(("safety_ai_camera_frames_dropped_unevaluated_total", "counter", "Published frames that were replaced by a newer frame before being evaluated", labels, camera.number_of_frames_overwritten_unevaluated))
+            metrics.append(("safety_ai_camera_fetching_delay_seconds", "gauge", "Minimum interval between two decoded frames, set by the rate controller", labels, camera.camera_fetching_delay))
+            metrics.append(("safety_ai_camera_reconnect_attempts", "gauge", "Consecutive reconnect attempts without a successful grab", labels, camera.reconnect_attempts))
+            for health_state in ["stopped", "connecting", "streaming", "backing_off", "failed"]:
+                metrics.append(("safety_ai_camera_health_state", "gauge", "1 for the current health state of the stream", {**labels, "health_state": health_state}, int(camera.health_state == health_state)))
+        return metrics
+
+    def __supervisor_thread(self):
+        while not self.supervisor_stop_event.wait(timeout=server_preferences.CAMERA_SUPERVISOR_PERIOD_SECONDS):
+            with self.cameras_lock:
+                for camera in self.cameras:
+                    if camera.health_state == "streaming" and time.time() - camera.last_successful_grab_time > server_preferences.CAMERA_GRAB_TIMEOUT_SECONDS:
+                        camera.is_stall_detected = True # The fetching thread reopens the stream as soon as the blocked grab() returns
+                    elif camera.health_state == "backing_off" and time.time() >= camera.next_reconnect_time:
+                        if camera.thread is not None and camera.thread.is_alive(): continue
+                        if server_preferences.CAMERA_VERBOSE: print(f'Supervisor is restarting {camera.camera_ip_address} at {time.time()}')
+                        camera.start_fetching_frames()
+
     def start_cameras_by_uuid(self, camera_uuids:List[str] = []):    
         # Start fetching frames from the cameras. If camera_uuids is empty, start all cameras, otherwise start only the cameras with the specified uuids    
         # If camera is not alive, skip it. Alive means that the camera is reachable and the stream is available
 
-        for camera in self.cameras:  
-            if not camera.is_alive:
-                continue
-
-            if (camera.camera_uuid in camera_uuids or len(camera_uuids) == 0) and not camera.is_fetching_frames:              
-                camera.start_fetching_frames()
+        if server_preferences.CAMERA_DECODER_PROCESSES > 0:
+            # The decoder processes run their own supervisors. The selected cameras are started and stopped all together
+            if self.decoder_process_pool is None:
+                cameras_to_start = [camera for camera in self.cameras if camera.is_alive and (camera.camera_uuid in camera_uuids or len(camera_uuids) == 0)]
+                if len(cameras_to_start) > 0:
+                    self.decoder_process_pool = decoder_process_module.DecoderProcessPool(cameras = cameras_to_start, number_of_processes = server_preferences.CAMERA_DECODER_PROCESSES)
+                    self.decoder_process_pool.start()
+        else:
+            with self.cameras_lock:
+                for camera in self.cameras:  
+                    if not camera.is_alive:
+                        continue
 
-        self.optimize_camera_fetching_delays() # One my use this externally. Yet since its rarely used and not computationally intensive, It is also put here
+                    if (camera.camera_uuid in camera_uuids or len(camera_uuids) == 0) and not camera.is_fetching_frames:              
+                        camera.start_fetching_frames()
 
-    def optimize_camera_fetching_delays(self):        
-        number_of_fetching_cameras = 0
-        for camera in self.cameras:
-            if camera.is_fetching_frames and camera.is_alive:
-                number_of_fetching_cameras += 1
-        
-        server_preferences.PREF_optimize_camera_fetching_delay_randomization_range(number_of_cameras=number_of_fetching_cameras)
+            self.start_supervisor()
 
     def stop_cameras_by_uuid(self, camera_uuids:List[str]):
         # Stop fetching frames from the cameras. If camera_uuids is empty, stop all cameras, otherwise stop only the cameras with the specified uuids
+        # In decoder process mode the cameras are started and stopped all together, use reconcile_camera_configs to remove some of them
+        if self.decoder_process_pool is not None:
+            if len(camera_uuids) > 0 and set(camera_uuids) != set(self.decoder_process_pool.cameras_by_uuid.keys()):
+                raise ValueError("Some cameras of the decoder processes can not be stopped alone, stop all cameras or reconcile the camera configs")
+            self.decoder_process_pool.stop()
+            self.decoder_process_pool = None
+
+        with self.cameras_lock:
+            for camera in self.cameras:
+                if camera.camera_uuid in camera_uuids or len(camera_uuids) == 0:
+                    camera.stop_fetching_frames()        
+
+    def request_evidence(self, evaluation_result = None, on_evidence_ready:Callable = None):
+        # Calls on_evidence_ready with the detections mapped to a high resolution evidence frame. If the camera has no separate detection stream, the detection frame is already the evidence
+        camera = next((camera for camera in self.cameras if camera.camera_uuid == evaluation_result.camera_uuid), None)
+        if camera is None or camera.detection_stream_path is None:
+            on_evidence_ready(evaluation_result)
+            return
+
+        with self.evidence_lock:
+            if camera.camera_uuid in self.cameras_fetching_evidence: return # The evidence that is being fetched already covers this violation
+            self.cameras_fetching_evidence.add(camera.camera_uuid)
+        self.evidence_executor.submit(self.__fetch_evidence, camera, evaluation_result, on_evidence_ready)
+
+    def __fetch_evidence(self, camera:CameraStreamFetcher = None, evaluation_result = None, on_evidence_ready:Callable = None):
+        try:
+            evidence_frame = camera.fetch_evidence_frame()
+            if evidence_frame is None:
+                if server_preferences.CAMERA_VERBOSE: print(f'Could not fetch an evidence frame from {camera.camera_ip_address}, using the detection frame')
+                on_evidence_ready(evaluation_result)
+            else:
+                on_evidence_ready(evaluation_result.map_to_frame(frame = evidence_frame))
+        except Exception as e:
+            if server_preferences.CAMERA_VERBOSE: print(f'Error in fetching evidence from {camera.camera_ip_address}: {e}')
+        finally:
+            with self.evidence_lock:
+                self.cameras_fetching_evidence.discard(camera.camera_uuid)
+
+    def attach_frame_queues(self, frame_queues = None):
+        # New frames of all cameras are pushed to the given queues. Pass None to detach
+        self.frame_queues = frame_queues
         for camera in self.cameras:
-            if camera.camera_uuid in camera_uuids or len(camera_uuids) == 0:
-                camera.stop_fetching_frames()        
+            camera.frame_queues = frame_queues
 
-        self.optimize_camera_fetching_delays() # One my use this externally. Yet since its rarely used and not computationally intensive, It is also put here
+    def attach_clip_recorder(self, clip_recorder = None):
+        # Frames of all cameras are added to the buffers of the given clip recorder. Pass None to detach. In decoder process mode the frames are decoded in the child processes and are not recorded
+        self.clip_recorder = clip_recorder
+        for camera in self.cameras:
+            camera.clip_recorder = clip_recorder
 
     def return_all_not_evaluated_frames_info(self) -> List[Dict]:
         not_evaluated_frames_info = []
@@ -147,44 +514,24 @@ class StreamManager:
 
         return not_evaluated_frames_info
 
-    def update_frame_evaluations(self, evaluated_frame_uuids:List[str]):
+    def return_last_frame_info(self, camera_uuid:str = None) -> Dict:
+        camera = next((camera for camera in self.cameras if camera.camera_uuid == camera_uuid), None)
+        return camera.get_last_frame_info() if camera is not None else None
+
+    def is_frame_valid(self, frame_info:Dict = None) -> bool:
+        # Frames of the decoder processes are views of shared memory slots which are reused. Check this after reading a frame outside the evaluation
+        if "shared_memory_name" not in frame_info: return True
+        return self.decoder_process_pool is not None and self.decoder_process_pool.is_shared_frame_valid(frame_info = frame_info)
+
+    def update_frame_evaluations(self, evaluated_frame_uuids:Set[str]):
         for camera in self.cameras:
             camera.set_last_frame_as_evaluated_if_frame_uuid_matches(evaluated_frame_uuids)
     
-    def test_show_all_frames(self, window_size=(1280, 720)):
-        frames_to_show = []
-    
-        for camera in self.cameras:
-            frame = camera.get_last_frame_info()["frame"] if camera.get_last_frame_info() is not None else None
-            if frame is not None:
-                frames_to_show.append(frame)            
-
-        num_frames = len(frames_to_show)
-
-        if num_frames == 0:
-            return
-        
-        # Determine the optimal grid size (rows x cols)
-        grid_cols = math.ceil(math.sqrt(num_frames))
-        grid_rows = math.ceil(num_frames / grid_cols)
-
-        # Determine the size of each frame to fit in the grid within the window size
-        frame_width = window_size[0] // grid_cols
-        frame_height = window_size[1] // grid_rows
-
-        # Create an empty canvas to place the frames
-        canvas = np.zeros((window_size[1], window_size[0], 3), dtype=np.uint8)
-
-        for i, frame in enumerate(frames_to_show):
-            row = i // grid_cols
-            col = i % grid_cols
-
-            # Resize frame to fit in the grid
-            resized_frame = cv2.resize(frame, (frame_width, frame_height))
-            canvas[row * frame_height:(row + 1) * frame_height, col * frame_width:(col + 1) * frame_width] = resized_frame
-
-        cv2.imshow('Fetched CCTV Frames', canvas)
-        cv2.waitKey(1)
+    def show_all_frames(self, window_size=(1280, 720)):
+        # Shows the latest frames of all cameras in a grid (or publishes it as a JPEG buffer in headless mode). Only the tiles of the new frames are redrawn
+        if self.mosaic_renderer is None or self.mosaic_renderer.window_size != tuple(window_size):
+            self.mosaic_renderer = mosaic_module.MosaicRenderer(window_size = window_size)
+        self.mosaic_renderer.render(camera_frames_info = {camera.camera_uuid: camera.get_last_frame_info() for camera in self.cameras})
 
     def return_yolo_models_to_use(self)->List[str]:
         yolo_model_to_use = []
@@ -202,7 +549,6 @@ if __name__ == "__main__":
     stream_manager.start_cameras_by_uuid(camera_uuids = []) # Start all cameras
 
     while True:
-        stream_manager.optimize_camera_fetching_delays()        
-        stream_manager.test_show_all_frames(window_size=(1280, 720))
+        stream_manager.show_all_frames(window_size=(1280, 720))
 
 
@@ -0,0 +1,187 @@
+import threading, time, json, platform, collections
+from pathlib import Path
+from typing import Dict, List, Tuple
+import cv2
+import numpy as np
+
+import metrics_module
+import server_preferences
+
+CLIP_RECORDER_MODULE_PATH = Path(__file__).resolve()
+if platform.system() == "Linux":
+    DEFAULT_CLIP_DIRECTORY = CLIP_RECORDER_MODULE_PATH.parent.parent.parent.parent / "safety_AI_volume" / "violation_clips"
+else:
+    DEFAULT_CLIP_DIRECTORY = CLIP_RECORDER_MODULE_PATH.parent.parent / "configs" / "violation_clips"
+
+class ClipRecorder:
+    # Keeps the last seconds of each camera as JPEG frames in memory, and writes a clip around each violation to disk
+    # - The fetcher threads add frames at CLIP_RECORDER_FPS, encoded at CLIP_RECORDER_FRAME_WIDTH, independently of how often the frames are evaluated
+    # - The buffer of a camera is bounded in seconds and bytes, all buffers together by CLIP_RECORDER_MAX_TOTAL_BYTES. Under pressure the oldest frames of any camera are evicted first
+    # - The writer thread also applies the time bound, so the buffer of a camera that stopped adding frames is emptied too
+    # - A violation opens a clip from CLIP_RECORDER_PRE_EVENT_SECONDS before to CLIP_RECORDER_POST_EVENT_SECONDS after it, further violations of the camera extend the open clip
+    # - Clips are decoded and written by a background writer thread once their last frame is buffered, the fetching and evaluation threads never wait for the disk
+    def __init__(self, clip_directory:str = None, max_total_bytes:int = None) -> None:
+        self.clip_directory = Path(clip_directory if clip_directory is not None else DEFAULT_CLIP_DIRECTORY)
+        self.max_total_bytes = max_total_bytes if max_total_bytes is not None else server_preferences.CLIP_RECORDER_MAX_TOTAL_BYTES
+        self.buffer_seconds = server_preferences.CLIP_RECORDER_PRE_EVENT_SECONDS + server_preferences.CLIP_RECORDER_POST_EVENT_SECONDS + server_preferences.CLIP_RECORDER_WRITE_CHECK_INTERVAL_SECONDS + 1 # A clip is written before its first frame leaves the buffer
+
+        self.camera_buffers:Dict[str, collections.deque] = {} # camera_uuid -> (frame_timestamp, jpeg bytes) of the frames in arrival order
+        self.camera_buffer_bytes:Dict[str, int] = {}
+        self.total_bytes = 0
+        self.open_clips:Dict[str, Dict] = {} # camera_uuid -> {"start_timestamp", "end_timestamp", "trigger_timestamp", "rule_names", "frame_uuids"}
+        self.buffer_lock = threading.Lock()
+
+        self.number_of_frames_added = 0
+        self.number_of_frames_evicted_under_pressure = 0 # Evicted by the total memory cap before their time, a clip may then miss its oldest frames
+        self.number_of_clips_written = 0
+        self.number_of_clips_failed = 0
+
+        self.writer_stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.__writer_thread)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        metrics_module.METRICS.register_collector(collector_name = "clip_recorder", collector = self.return_metrics)
+
+    def add_frame(self, camera_uuid:str = None, frame:np.ndarray = None, frame_timestamp:float = None) -> None:
+        # Called by the fetcher thread of the camera. The frame is encoded here so that only compressed frames are kept
+        frame_height, frame_width = frame.shape[:2]
+        clip_frame_width = server_preferences.CLIP_RECORDER_FRAME_WIDTH
+        if clip_frame_width is not None and frame_width > clip_frame_width:
+            frame = cv2.resize(frame, (clip_frame_width, max(1, int(frame_height * clip_frame_width / frame_width))), interpolation=cv2.INTER_AREA)
+        is_encoded, jpeg_array = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, server_preferences.CLIP_RECORDER_JPEG_QUALITY])
+        if not is_encoded: return
+        jpeg_bytes = jpeg_array.tobytes()
+
+        with self.buffer_lock:
+            camera_buffer = self.camera_buffers.setdefault(camera_uuid, collections.deque())
+            camera_buffer.append((frame_timestamp, jpeg_bytes))
+            self.camera_buffer_bytes[camera_uuid] = self.camera_buffer_bytes.get(camera_uuid, 0) + len(jpeg_bytes)
+            self.total_bytes += len(jpeg_bytes)
+            self.number_of_frames_added += 1
+
+            # Per camera bounds: the buffered seconds, except for the frames of the open clip, and the bytes. The newest frame is always kept
+            self.__evict_expired_frames(camera_uuid = camera_uuid, current_timestamp = frame_timestamp, number_of_kept_frames = 1)
+            while len(camera_buffer) > 1 and self.camera_buffer_bytes[camera_uuid] > server_preferences.CLIP_RECORDER_MAX_BYTES_PER_CAMERA:
+                self.__evict_oldest_frame(camera_uuid = camera_uuid)
+
+            # Total bound: the oldest frames of all cameras. The frames of a camera arrive in order, so the oldest frame is the first frame of one of the buffers
+            while self.total_bytes > self.max_total_bytes:
+                _, oldest_camera_uuid = min((buffer[0][0], buffer_camera_uuid) for buffer_camera_uuid, buffer in self.camera_buffers.items() if len(buffer) > 0)
+                self.__evict_oldest_frame(camera_uuid = oldest_camera_uuid)
+                self.number_of_frames_evicted_under_pressure += 1
+
+    def add_evaluation_result(self, evaluation_result = None) -> None:
+        # Can be used as a result sink of the EvaluationPipeline. Opens a clip for the camera, or extends its open clip up to CLIP_RECORDER_MAX_CLIP_SECONDS
+        if len(evaluation_result) == 0: return
+        with self.buffer_lock:
+            if evaluation_result.camera_uuid not in self.camera_buffers: return # Clips are not recorded for this camera
+            open_clip = self.open_clips.get(evaluation_result.camera_uuid)
+            if open_clip is None:
+                self.open_clips[evaluation_result.camera_uuid] = {
+                    "start_timestamp": evaluation_result.frame_timestamp - server_preferences.CLIP_RECORDER_PRE_EVENT_SECONDS,
+                    "end_timestamp": evaluation_result.frame_timestamp + server_preferences.CLIP_RECORDER_POST_EVENT_SECONDS,
+                    "trigger_timestamp": evaluation_result.frame_timestamp,
+                    "rule_names": [evaluation_result.rule_name],
+                    "frame_uuids": [evaluation_result.frame_uuid],
+                }
+                return
+            open_clip["end_timestamp"] = min(open_clip["start_timestamp"] + server_preferences.CLIP_RECORDER_MAX_CLIP_SECONDS, max(open_clip["end_timestamp"], evaluation_result.frame_timestamp + server_preferences.CLIP_RECORDER_POST_EVENT_SECONDS))
+            if evaluation_result.rule_name not in open_clip["rule_names"]: open_clip["rule_names"].append(evaluation_result.rule_name)
+            open_clip["frame_uuids"].append(evaluation_result.frame_uuid)
+
+    def remove_camera(self, camera_uuid:str = None) -> None:
+        # Frees the buffer of a removed camera, its open clip is dropped
+        with self.buffer_lock:
+            self.total_bytes -= self.camera_buffer_bytes.pop(camera_uuid, 0)
+            self.camera_buffers.pop(camera_uuid, None)
+            self.open_clips.pop(camera_uuid, None)
+
+    def close(self) -> None:
+        # Writes the open clips with the frames buffered so far before returning
+        self.writer_stop_event.set()
+        self.writer_thread.join()
+        metrics_module.METRICS.unregister_collector(collector_name = "clip_recorder")
+
+    def return_metrics(self) -> List[tuple]:
+        # Metrics collector, called at scrape time
+        with self.buffer_lock:
+            camera_buffer_bytes = dict(self.camera_buffer_bytes)
+        metrics = [
+            ("safety_ai_clip_recorder_total_buffered_bytes", "gauge", "JPEG bytes buffered for all cameras", {}, self.total_bytes),
+            ("safety_ai_clip_recorder_frames_added_total", "counter", "Frames encoded and added to the clip buffers", {}, self.number_of_frames_added),
+            ("safety_ai_clip_recorder_frames_evicted_under_pressure_total", "counter", "Frames evicted by the total memory cap before their time", {}, self.number_of_frames_evicted_under_pressure),
+            ("safety_ai_clip_recorder_clips_written_total", "counter", "Violation clips written to disk", {}, self.number_of_clips_written),
+            ("safety_ai_clip_recorder_clips_failed_total", "counter", "Violation clips that could not be written", {}, self.number_of_clips_failed),
+        ]
+        for camera_uuid, buffer_bytes in camera_buffer_bytes.items():
+            metrics.append(("safety_ai_clip_recorder_buffered_bytes", "gauge", "JPEG bytes buffered for the camera", {"camera_uuid": camera_uuid}, buffer_bytes))
+        return metrics
+
+    def __evict_oldest_frame(self, camera_uuid:str = None) -> None:
+        # Must be called with buffer_lock held
+        _, jpeg_bytes = self.camera_buffers[camera_uuid].popleft()
+        self.camera_buffer_bytes[camera_uuid] -= len(jpeg_bytes)
+        self.total_bytes -= len(jpeg_bytes)
+
+    def __evict_expired_frames(self, camera_uuid:str = None, current_timestamp:float = None, number_of_kept_frames:int = 0) -> None:
+        # Must be called with buffer_lock held. Evicts the frames older than buffer_seconds, except for the frames of the open clip of the camera
+        camera_buffer = self.camera_buffers[camera_uuid]
+        open_clip = self.open_clips.get(camera_uuid)
+        oldest_kept_timestamp = current_timestamp - self.buffer_seconds if open_clip is None else min(current_timestamp - self.buffer_seconds, open_clip["start_timestamp"])
+        while len(camera_buffer) > number_of_kept_frames and camera_buffer[0][0] < oldest_kept_timestamp:
+            self.__evict_oldest_frame(camera_uuid = camera_uuid)
+
+    def __writer_thread(self) -> None:
+        is_stopping = False
+        while not is_stopping:
+            is_stopping = self.writer_stop_event.wait(timeout=server_preferences.CLIP_RECORDER_WRITE_CHECK_INTERVAL_SECONDS)
+            clips_to_write:List[Tuple[str, Dict, List]] = []
+            with self.buffer_lock:
+                for camera_uuid in self.camera_buffers: # add_frame only bounds the buffer of the camera adding a frame
+                    self.__evict_expired_frames(camera_uuid = camera_uuid, current_timestamp = time.time())
+                for camera_uuid, open_clip in list(self.open_clips.items()):
+                    if not is_stopping and time.time() < open_clip["end_timestamp"]: continue
+                    # The bytes are immutable, so the frames are written outside of the lock while the buffer keeps changing
+                    clip_frames = [(frame_timestamp, jpeg_bytes) for frame_timestamp, jpeg_bytes in self.camera_buffers.get(camera_uuid, []) if open_clip["start_timestamp"] <= frame_timestamp <= open_clip["end_timestamp"]]
+                    clips_to_write.append((camera_uuid, open_clip, clip_frames))
+                    del self.open_clips[camera_uuid]
+
+            for camera_uuid, open_clip, clip_frames in clips_to_write:
+                try:
+                    self.__write_clip(camera_uuid = camera_uuid, open_clip = open_clip, clip_frames = clip_frames)
+                    self.number_of_clips_written += 1
+                except Exception as e:
+                    self.number_of_clips_failed += 1
+                    if server_preferences.CLIP_RECORDER_VERBOSE: print(f"Could not write the clip of {camera_uuid} at {time.time()}: {e}")
+
+    def __write_clip(self, camera_uuid:str = None, open_clip:Dict = None, clip_frames:List[Tuple[float, bytes]] = None) -> None:
+        # Writes <camera_uuid>_<trigger time in ms>.mp4 and a .json file with the violations and the timestamp of each frame
+        if len(clip_frames) == 0: raise ValueError("No frame is buffered for the clip")
+        self.clip_directory.mkdir(parents=True, exist_ok=True)
+        clip_name = f"{camera_uuid}_{int(open_clip['trigger_timestamp']*1000)}"
+        clip_duration = clip_frames[-1][0] - clip_frames[0][0]
+        clip_fps = (len(clip_frames)-1)/clip_duration if clip_duration > 0 else server_preferences.CLIP_RECORDER_FPS # Actual rate, the frames are not always added at CLIP_RECORDER_FPS
+
+        video_writer, clip_frame_size = None, None
+        try:
+            for frame_timestamp, jpeg_bytes in clip_frames:
+                frame = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if video_writer is None:
+                    clip_frame_size = (frame.shape[1], frame.shape[0])
+                    video_writer = cv2.VideoWriter(str(self.clip_directory / f"{clip_name}.mp4"), cv2.VideoWriter_fourcc(*server_preferences.CLIP_RECORDER_FOURCC), clip_fps, clip_frame_size)
+                    if not video_writer.isOpened(): raise IOError(f"Could not open the video writer for {clip_name}")
+                if (frame.shape[1], frame.shape[0]) != clip_frame_size: # The stream was reopened with another resolution during the clip
+                    frame = cv2.resize(frame, clip_frame_size, interpolation=cv2.INTER_AREA)
+                video_writer.write(frame)
+        finally:
+            if video_writer is not None: video_writer.release()
+
+        with open(self.clip_directory / f"{clip_name}.json", "w") as f:
+            json.dump({
+                "camera_uuid": camera_uuid,
+                "trigger_timestamp": open_clip["trigger_timestamp"],
+                "rule_names": open_clip["rule_names"],
+                "frame_uuids": open_clip["frame_uuids"],
+                "frame_timestamps": [frame_timestamp for frame_timestamp, _ in clip_frames],
+            }, f)
+        if server_preferences.CLIP_RECORDER_VERBOSE: print(f"Clip {clip_name} is written with {len(clip_frames)} frames at {time.time()}")
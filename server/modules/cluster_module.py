@@ -0,0 +1,393 @@
+import threading, time, json, hashlib, bisect, queue, os, collections, urllib.request, urllib.error
+from pathlib import Path
+from typing import List, Dict, Callable, Tuple
+import numpy as np
+
+import detectors_module
+import metrics_module
+import server_preferences
+
+# Cluster mode: a coordinator owns the camera list and assigns the cameras to worker nodes, each worker runs the fetching and evaluation pipeline of its cameras
+# - Workers connect to the coordinator, never the other way around: the heartbeat carries the capacity, saturation and metrics of the worker, and its response the assigned cameras
+# - Evaluation results are forwarded to the coordinator, which persists and streams them like a single server would (see safety_ai_main.py --cluster-role)
+# - The frames stay on the workers: each worker serves the snapshots, MJPEG streams and mosaic of its cameras from its own API, whose address is listed in the cluster status
+# - A camera may be evaluated by two workers for up to one heartbeat interval while it moves between them
+
+class ConsistentHashRing:
+    # Bounded-load consistent hashing: each worker owns a number of virtual nodes proportional to its capacity, and a camera goes to the first worker clockwise from its hash that is not full
+    # Adding or removing a worker moves only the cameras of the affected ring segments, so the other workers keep their streams and state
+    def __init__(self, worker_capacities:Dict[str, int] = None) -> None:
+        self.ring:List[Tuple[int, str]] = []
+        for worker_id, capacity in worker_capacities.items():
+            for virtual_node_index in range(max(1, capacity)*server_preferences.CLUSTER_VIRTUAL_NODES_PER_CAPACITY):
+                self.ring.append((self.__hash(f"{worker_id}#{virtual_node_index}"), worker_id))
+        self.ring.sort()
+        self.ring_hashes = [ring_hash for ring_hash, _ in self.ring]
+
+    def assign(self, camera_uuids:List[str] = None, worker_capacities:Dict[str, int] = None) -> Tuple[Dict[str, List[str]], List[str]]:
+        # Returns ({worker_id: [camera_uuid, ...]}, [unassigned camera_uuid, ...]). A worker is given at most its capacity
+        assignment = {worker_id: [] for worker_id in worker_capacities}
+        unassigned_camera_uuids = []
+        for camera_uuid in sorted(camera_uuids, key=self.__hash):
+            worker_id = None
+            if len(self.ring) > 0:
+                ring_index = bisect.bisect(self.ring_hashes, self.__hash(camera_uuid))
+                for ring_offset in range(len(self.ring)):
+                    candidate_worker_id = self.ring[(ring_index + ring_offset) % len(self.ring)][1]
+                    if len(assignment[candidate_worker_id]) < worker_capacities[candidate_worker_id]:
+                        worker_id = candidate_worker_id
+                        break
+            if worker_id is None:
+                unassigned_camera_uuids.append(camera_uuid)
+            else:
+                assignment[worker_id].append(camera_uuid)
+        return assignment, unassigned_camera_uuids
+
+    def __hash(self, key:str = None) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+def return_result_transfer_dict(evaluation_result = None) -> Dict:
+    # JSON serializable copy of an evaluation result without its frame
+    return {
+        "camera_uuid": evaluation_result.camera_uuid,
+        "frame_uuid": evaluation_result.frame_uuid,
+        "frame_timestamp": evaluation_result.frame_timestamp,
+        "frame_shape": list(evaluation_result.frame_shape),
+        "rule_name": evaluation_result.rule_name,
+        "class_names": list(evaluation_result.class_names),
+        "bbox_confidences": evaluation_result.bbox_confidences.tolist(),
+        "bbox_xyxy_px": evaluation_result.bbox_xyxy_px.tolist(),
+        "keypoints_xy": evaluation_result.keypoints_xy.tolist(),
+        "keypoints_conf": evaluation_result.keypoints_conf.tolist(),
+        "track_ids": evaluation_result.track_ids.tolist() if evaluation_result.track_ids is not None else None,
+    }
+
+def return_result_from_transfer_dict(transfer_dict:Dict = None) -> detectors_module.PoseDetectionsRecord:
+    number_of_keypoints = len(detectors_module.PoseDetector.KEYPOINT_NAMES)
+    return detectors_module.PoseDetectionsRecord(
+        frame_info = {"frame": None, "camera_uuid": transfer_dict["camera_uuid"], "frame_uuid": transfer_dict["frame_uuid"], "frame_timestamp": transfer_dict["frame_timestamp"]},
+        frame_shape = transfer_dict["frame_shape"],
+        class_names = transfer_dict["class_names"],
+        bbox_confidences = np.array(transfer_dict["bbox_confidences"], dtype=np.float32).reshape(-1),
+        bbox_xyxy_px = np.array(transfer_dict["bbox_xyxy_px"], dtype=np.float32).reshape(-1, 4),
+        keypoints_xy = np.array(transfer_dict["keypoints_xy"], dtype=np.float32).reshape(-1, number_of_keypoints, 2),
+        keypoints_conf = np.array(transfer_dict["keypoints_conf"], dtype=np.float32).reshape(-1, number_of_keypoints),
+        track_ids = np.array(transfer_dict["track_ids"], dtype=np.int64) if transfer_dict["track_ids"] is not None else None,
+        rule_name = transfer_dict["rule_name"],
+    )
+
+def merge_prometheus_texts(prometheus_texts:Dict[str, str] = None) -> str:
+    # Merges the metrics of several nodes into one exposition, the samples of each node are labeled with its worker_id (None means no label, e.g. the coordinator itself)
+    # The samples of a family stay grouped under a single HELP/TYPE header as the text format requires
+    families:Dict[str, Dict] = collections.OrderedDict() # family name -> {"header": [HELP and TYPE lines], "samples": [...]}
+    for worker_id, prometheus_text in prometheus_texts.items():
+        family_name = None
+        for line in prometheus_text.splitlines():
+            if len(line.strip()) == 0: continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ["HELP", "TYPE"]:
+                    family_name = parts[2]
+                    family = families.setdefault(family_name, {"header": [], "header_kinds": set(), "samples": []})
+                    if parts[1] not in family["header_kinds"]:
+                        family["header"].append(line)
+                        family["header_kinds"].add(parts[1])
+                continue
+            if family_name is None: family_name = line.split("{", 1)[0].split(" ", 1)[0]
+            family = families.setdefault(family_name, {"header": [], "header_kinds": set(), "samples": []})
+            if worker_id is None:
+                family["samples"].append(line)
+            elif "{" in line: # Label values may contain spaces, but metric names never contain "{"
+                name, rest = line.split("{", 1)
+                family["samples"].append(f'{name}{{worker_id="{worker_id}",{rest}')
+            else:
+                name, rest = line.split(" ", 1)
+                family["samples"].append(f'{name}{{worker_id="{worker_id}"}} {rest}')
+
+    lines = []
+    for family in families.values():
+        lines.extend(family["header"])
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+class ClusterCoordinator:
+    # Assigns the alive cameras of the static database to the workers that send heartbeats, and merges their results and metrics
+    # Rebalances when a worker joins, leaves (graceful leave or missed heartbeats), becomes saturated or recovers, and when the static database changes
+    def __init__(self, camera_configs_json_path:Path = None, on_camera_configs_reloaded:Callable = None) -> None:
+        self.camera_configs_json_path = camera_configs_json_path
+        self.on_camera_configs_reloaded = on_camera_configs_reloaded # Called with the new {camera_uuid: config} of the alive cameras after each reload, outside of the cluster lock
+        self.camera_configs_json_mtime = None
+        self.camera_configs:Dict[str, Dict] = {} # camera_uuid -> config of the alive cameras
+
+        self.workers:Dict[str, Dict] = {} # worker_id -> {"capacity", "effective_capacity", "is_saturated", "last_saturation_change_time", "last_heartbeat_time", "assignment_version", "camera_uuids", "api_url", "metrics_text", "statistics"}
+        self.unassigned_camera_uuids:List[str] = []
+        self.is_rebalance_needed = True
+        self.cluster_lock = threading.Lock()
+
+        self.result_sinks:List[Callable] = [] # Called with each evaluation result forwarded by the workers
+        self.number_of_results_received = 0
+
+        self.maintenance_stop_event = threading.Event()
+        self.maintenance_thread = None
+        self.__reload_camera_configs_if_changed()
+
+    def add_result_sink(self, result_sink:Callable = None) -> None:
+        self.result_sinks.append(result_sink)
+
+    def start(self) -> None:
+        if self.maintenance_thread is not None: return
+        self.maintenance_stop_event.clear()
+        self.maintenance_thread = threading.Thread(target=self.__maintenance_thread)
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+    def stop(self) -> None:
+        if self.maintenance_thread is None: return
+        self.maintenance_stop_event.set()
+        self.maintenance_thread.join()
+        self.maintenance_thread = None
+
+    def handle_heartbeat(self, heartbeat:Dict = None) -> Dict:
+        # heartbeat: {"worker_id", "capacity", "is_saturated", "assignment_version", "api_url", "metrics_text", "statistics"}
+        # Returns {"assignment_version", "camera_configs"}, camera_configs is None if the worker already runs the latest assignment
+        worker_id = heartbeat["worker_id"]
+        with self.cluster_lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                worker = {"capacity": None, "effective_capacity": None, "is_saturated": False, "last_saturation_change_time": time.time(), "assignment_version": 0, "camera_uuids": [], "api_url": None, "metrics_text": "", "statistics": {}}
+                self.workers[worker_id] = worker
+                self.is_rebalance_needed = True
+                if server_preferences.CLUSTER_VERBOSE: print(f"Worker {worker_id} joined the cluster at {time.time()}")
+            if worker["capacity"] != heartbeat["capacity"]:
+                worker["capacity"] = worker["effective_capacity"] = heartbeat["capacity"]
+                self.is_rebalance_needed = True
+            if worker["is_saturated"] != heartbeat["is_saturated"]:
+                worker["is_saturated"] = heartbeat["is_saturated"]
+                worker["last_saturation_change_time"] = time.time()
+            worker["last_heartbeat_time"] = time.time()
+            worker["api_url"] = heartbeat.get("api_url")
+            worker["metrics_text"] = heartbeat.get("metrics_text", "")
+            worker["statistics"] = heartbeat.get("statistics", {})
+
+            if heartbeat["assignment_version"] == worker["assignment_version"]:
+                return {"assignment_version": worker["assignment_version"], "camera_configs": None}
+            return {"assignment_version": worker["assignment_version"], "camera_configs": [self.camera_configs[camera_uuid] for camera_uuid in worker["camera_uuids"]]}
+
+    def handle_leave(self, worker_id:str = None) -> None:
+        with self.cluster_lock:
+            if self.workers.pop(worker_id, None) is not None:
+                self.is_rebalance_needed = True
+                if server_preferences.CLUSTER_VERBOSE: print(f"Worker {worker_id} left the cluster at {time.time()}")
+
+    def add_result_transfer_dicts(self, transfer_dicts:List[Dict] = None) -> None:
+        for transfer_dict in transfer_dicts:
+            evaluation_result = return_result_from_transfer_dict(transfer_dict = transfer_dict)
+            self.number_of_results_received += 1
+            for result_sink in self.result_sinks:
+                try:
+                    result_sink(evaluation_result)
+                except Exception as e:
+                    if server_preferences.CLUSTER_VERBOSE: print(f"Error in result sink {result_sink}: {e}")
+
+    def return_camera_regions(self) -> Dict[str, str]:
+        return {camera_uuid: camera_config["camera_region"] for camera_uuid, camera_config in self.camera_configs.items()}
+
+    def return_camera_api_url(self, camera_uuid:str = None) -> str:
+        # API of the worker that serves the frames of the camera, None if the camera is not assigned or its worker has no API
+        with self.cluster_lock:
+            for worker in self.workers.values():
+                if camera_uuid in worker["camera_uuids"]: return worker["api_url"]
+        return None
+
+    def return_status(self) -> Dict:
+        with self.cluster_lock:
+            return {
+                "workers": {worker_id: {key: value for key, value in worker.items() if key != "metrics_text"} for worker_id, worker in self.workers.items()},
+                "camera_api_urls": {camera_uuid: worker["api_url"] for worker in self.workers.values() for camera_uuid in worker["camera_uuids"]},
+                "unassigned_camera_uuids": list(self.unassigned_camera_uuids),
+                "number_of_cameras": len(self.camera_configs),
+                "number_of_results_received": self.number_of_results_received,
+            }
+
+    def return_metrics_text(self) -> str:
+        # Metrics of the coordinator process merged with the latest metrics reported by each worker
+        with self.cluster_lock:
+            prometheus_texts = {worker_id: worker["metrics_text"] for worker_id, worker in self.workers.items()}
+        return merge_prometheus_texts(prometheus_texts = {None: metrics_module.METRICS.return_prometheus_text(), **prometheus_texts})
+
+    def __maintenance_thread(self) -> None:
+        while not self.maintenance_stop_event.wait(timeout=server_preferences.CLUSTER_REBALANCE_CHECK_INTERVAL_SECONDS):
+            try:
+                self.__reload_camera_configs_if_changed()
+                with self.cluster_lock:
+                    self.__remove_dead_workers()
+                    self.__update_effective_capacities()
+                    if self.is_rebalance_needed: self.__rebalance()
+            except Exception as e:
+                if server_preferences.CLUSTER_VERBOSE: print(f"Error in the cluster maintenance at {time.time()}: {e}")
+
+    def __reload_camera_configs_if_changed(self) -> None:
+        if self.camera_configs_json_path is None: return
+        try:
+            camera_configs_json_mtime = os.stat(self.camera_configs_json_path).st_mtime_ns
+            if camera_configs_json_mtime == self.camera_configs_json_mtime: return
+            with open(self.camera_configs_json_path, "r") as f:
+                camera_configs = json.load(f)["cameras"]
+        except (OSError, json.JSONDecodeError, KeyError) as e: # The file is missing, being replaced or being written: the last good configs are kept and it is read again at the next check
+            if server_preferences.CLUSTER_VERBOSE: print(f"Could not read the camera configs at {time.time()}: {e}")
+            return
+        with self.cluster_lock:
+            new_camera_configs = {camera_config["camera_uuid"]: camera_config for camera_config in camera_configs if camera_config["is_alive"]}
+            for worker in self.workers.values(): # Workers of the changed cameras get the new configs even if the assignment does not change
+                if any(self.camera_configs.get(camera_uuid) != new_camera_configs.get(camera_uuid) for camera_uuid in worker["camera_uuids"]):
+                    worker["assignment_version"] += 1
+            self.camera_configs = new_camera_configs
+            self.camera_configs_json_mtime = camera_configs_json_mtime
+            self.is_rebalance_needed = True
+        if self.on_camera_configs_reloaded is not None: self.on_camera_configs_reloaded(new_camera_configs)
+
+    def __remove_dead_workers(self) -> None:
+        for worker_id in [worker_id for worker_id, worker in self.workers.items() if time.time() - worker["last_heartbeat_time"] > server_preferences.CLUSTER_WORKER_TIMEOUT_SECONDS]:
+            del self.workers[worker_id]
+            self.is_rebalance_needed = True
+            if server_preferences.CLUSTER_VERBOSE: print(f"Worker {worker_id} missed its heartbeats and is removed from the cluster at {time.time()}")
+
+    def __update_effective_capacities(self) -> None:
+        # A saturated worker sheds one camera per cooldown period, a recovered worker gets one more per cooldown period up to its reported capacity
+        for worker in self.workers.values():
+            if time.time() - worker["last_saturation_change_time"] < server_preferences.CLUSTER_SATURATION_COOLDOWN_SECONDS: continue
+            if worker["is_saturated"] and len(worker["camera_uuids"]) > 1:
+                worker["effective_capacity"] = len(worker["camera_uuids"]) - 1
+            elif not worker["is_saturated"] and worker["effective_capacity"] < worker["capacity"]:
+                worker["effective_capacity"] += 1
+            else:
+                continue
+            worker["last_saturation_change_time"] = time.time()
+            self.is_rebalance_needed = True
+
+    def __rebalance(self) -> None:
+        # Must be called with cluster_lock held
+        worker_capacities = {worker_id: worker["effective_capacity"] for worker_id, worker in self.workers.items()}
+        assignment, self.unassigned_camera_uuids = ConsistentHashRing(worker_capacities = worker_capacities).assign(camera_uuids = list(self.camera_configs.keys()), worker_capacities = worker_capacities)
+        for worker_id, camera_uuids in assignment.items():
+            worker = self.workers[worker_id]
+            if sorted(camera_uuids) != sorted(worker["camera_uuids"]):
+                worker["camera_uuids"] = camera_uuids
+                worker["assignment_version"] += 1
+        self.is_rebalance_needed = False
+        if server_preferences.CLUSTER_VERBOSE: print(f"Cluster is rebalanced at {time.time()}: {[(worker_id, len(camera_uuids)) for worker_id, camera_uuids in assignment.items()]}, unassigned: {len(self.unassigned_camera_uuids)}")
+
+class ClusterWorker:
+    # Runs in a worker node next to its StreamManager and EvaluationPipeline. Sends heartbeats to the coordinator, applies the assigned cameras and forwards the evaluation results
+    # If the coordinator can not be reached for CLUSTER_WORKER_TIMEOUT_SECONDS, the cameras are released since the coordinator gives them to other workers by then
+    __STOP_SIGNAL = object()
+
+    def __init__(self, worker_id:str = None, coordinator_url:str = None, capacity:int = None, api_url:str = None, stream_manager = None, evaluation_pipeline = None, on_camera_configs_reconciled:Callable = None) -> None:
+        self.worker_id = worker_id
+        self.coordinator_url = coordinator_url.rstrip("/")
+        self.capacity = capacity
+        self.api_url = api_url # Address of the API of this worker as seen by the clients, None if the worker does not serve one
+        self.stream_manager = stream_manager
+        self.evaluation_pipeline = evaluation_pipeline
+        self.on_camera_configs_reconciled = on_camera_configs_reconciled # Called with the changes of StreamManager.reconcile_camera_configs
+
+        self.assignment_version = -1 # Never matches the coordinator's version, so that the first heartbeat returns the assignment
+        self.last_successful_heartbeat_time = time.time()
+        self.result_queue = queue.Queue(maxsize=server_preferences.CLUSTER_RESULT_QUEUE_SIZE)
+        self.number_of_results_forwarded = 0
+        self.number_of_results_dropped = 0
+
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+        self.forwarder_thread = None
+
+    def start(self) -> None:
+        self.stop_event.clear()
+        self.heartbeat_thread = threading.Thread(target=self.__heartbeat_thread)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+        self.forwarder_thread = threading.Thread(target=self.__forwarder_thread)
+        self.forwarder_thread.daemon = True
+        self.forwarder_thread.start()
+
+    def stop(self) -> None:
+        # Forwards the queued results and leaves the cluster, so that the coordinator reassigns the cameras without waiting for the timeout
+        self.stop_event.set()
+        if self.heartbeat_thread is not None: self.heartbeat_thread.join()
+        self.result_queue.put(ClusterWorker.__STOP_SIGNAL)
+        if self.forwarder_thread is not None: self.forwarder_thread.join()
+        self.heartbeat_thread = self.forwarder_thread = None
+        try:
+            self.__post(path = "/cluster/leave", payload = {"worker_id": self.worker_id})
+        except (urllib.error.URLError, OSError) as e:
+            if server_preferences.CLUSTER_VERBOSE: print(f"Could not leave the cluster: {e}")
+
+    def add_evaluation_result(self, evaluation_result = None) -> None:
+        # Result sink of the EvaluationPipeline. Never blocks: if the coordinator can not keep up, the results are dropped and counted
+        try:
+            self.result_queue.put_nowait(return_result_transfer_dict(evaluation_result = evaluation_result))
+        except queue.Full:
+            self.number_of_results_dropped += 1
+
+    def is_saturated(self) -> bool:
+        # The worker can not keep up with its cameras if the frames wait too long before their evaluation ends
+        latency_statistics = self.evaluation_pipeline.return_latency_statistics()
+        return latency_statistics["p95_seconds"] is not None and latency_statistics["p95_seconds"] > server_preferences.CLUSTER_SATURATION_LATENCY_SECONDS
+
+    def __heartbeat_thread(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                heartbeat = {
+                    "worker_id": self.worker_id,
+                    "capacity": self.capacity,
+                    "is_saturated": self.is_saturated(),
+                    "assignment_version": self.assignment_version,
+                    "api_url": self.api_url,
+                    "metrics_text": metrics_module.METRICS.return_prometheus_text(),
+                    "statistics": {"number_of_cameras": len(self.stream_manager.cameras), "latency": self.evaluation_pipeline.return_latency_statistics(), "number_of_results_forwarded": self.number_of_results_forwarded, "number_of_results_dropped": self.number_of_results_dropped},
+                }
+                response = self.__post(path = "/cluster/heartbeat", payload = heartbeat)
+                self.last_successful_heartbeat_time = time.time()
+                if response["camera_configs"] is not None:
+                    self.__apply_camera_configs(camera_configs = response["camera_configs"])
+                    self.assignment_version = response["assignment_version"]
+            except Exception as e:
+                if server_preferences.CLUSTER_VERBOSE: print(f"Heartbeat of {self.worker_id} failed at {time.time()}: {e}")
+                if time.time() - self.last_successful_heartbeat_time > server_preferences.CLUSTER_WORKER_TIMEOUT_SECONDS and len(self.stream_manager.cameras) > 0:
+                    self.__apply_camera_configs(camera_configs = []) # The coordinator already considers this worker dead
+                    self.assignment_version = -1
+            self.stop_event.wait(timeout=server_preferences.CLUSTER_HEARTBEAT_INTERVAL_SECONDS)
+
+    def __apply_camera_configs(self, camera_configs:List[Dict] = None) -> None:
+        changes = self.stream_manager.reconcile_camera_configs(camera_configs = camera_configs)
+        if self.on_camera_configs_reconciled is not None: self.on_camera_configs_reconciled(changes)
+        if server_preferences.CLUSTER_VERBOSE: print(f"Worker {self.worker_id} runs {len(camera_configs)} cameras at {time.time()}")
+
+    def __forwarder_thread(self) -> None:
+        is_stopping = False
+        while not is_stopping:
+            # Wait for the first result, then collect the others until the batch is full or the batch timeout is exceeded
+            transfer_dicts = [self.result_queue.get()]
+            batch_deadline = time.time() + server_preferences.CLUSTER_RESULT_BATCH_TIMEOUT_SECONDS
+            while len(transfer_dicts) < server_preferences.CLUSTER_RESULT_MAX_BATCH_SIZE:
+                try:
+                    transfer_dicts.append(self.result_queue.get(timeout=max(0, batch_deadline - time.time())))
+                except queue.Empty:
+                    break
+            is_stopping = any(transfer_dict is ClusterWorker.__STOP_SIGNAL for transfer_dict in transfer_dicts)
+            transfer_dicts = [transfer_dict for transfer_dict in transfer_dicts if transfer_dict is not ClusterWorker.__STOP_SIGNAL]
+            if len(transfer_dicts) == 0: continue
+
+            try:
+                self.__post(path = "/cluster/results", payload = {"worker_id": self.worker_id, "results": transfer_dicts})
+                self.number_of_results_forwarded += len(transfer_dicts)
+            except Exception as e:
+                self.number_of_results_dropped += len(transfer_dicts)
+                if server_preferences.CLUSTER_VERBOSE: print(f"Could not forward {len(transfer_dicts)} results of {self.worker_id}: {e}")
+
+    def __post(self, path:str = None, payload:Dict = None) -> Dict:
+        headers = {"Content-Type": "application/json"}
+        if server_preferences.CLUSTER_SHARED_SECRET is not None: headers["X-Cluster-Secret"] = server_preferences.CLUSTER_SHARED_SECRET
+        request = urllib.request.Request(self.coordinator_url + path, data=json.dumps(payload).encode("utf-8"), headers=headers, method="POST")
+        with urllib.request.urlopen(request, timeout=server_preferences.CLUSTER_REQUEST_TIMEOUT_SECONDS) as response:
+            return json.loads(response.read().decode("utf-8"))
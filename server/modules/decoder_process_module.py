@@ -0,0 +1,246 @@
+import multiprocessing, threading, queue, time
+from multiprocessing import shared_memory
+from typing import Dict, List
+import numpy as np
+
+import server_preferences
+
+class SharedFrameRingWriter:
+    # Used in the decoder processes in place of the frame queues of the CameraStreamFetchers (see StreamManager.attach_frame_queues)
+    # Each camera has a ring of slots in a shared memory block. The first bytes of the block hold the sequence number of each slot (-1 while the slot is being written)
+    # Only the slot location is sent to the evaluation process, the frame itself is never pickled
+    def __init__(self, notification_queue:multiprocessing.Queue = None, number_of_slots:int = None) -> None:
+        self.notification_queue = notification_queue
+        self.number_of_slots = number_of_slots if number_of_slots is not None else server_preferences.CAMERA_SHARED_MEMORY_SLOTS_PER_CAMERA
+        self.rings:Dict[str, Dict] = {} # camera_uuid -> {"shared_memory", "frame_shape", "sequences", "slots", "next_slot_index", "sequence"}
+        self.rings_lock = threading.Lock()
+
+    def put(self, frame_info:Dict = None) -> None:
+        frame = frame_info["frame"]
+        with self.rings_lock:
+            ring = self.rings.get(frame_info["camera_uuid"])
+            if ring is None or ring["frame_shape"] != frame.shape:
+                ring = self.__create_ring(camera_uuid = frame_info["camera_uuid"], frame_shape = frame.shape)
+
+        slot_index = ring["next_slot_index"]
+        ring["sequence"] += 1
+        ring["sequences"][slot_index] = -1
+        ring["slots"][slot_index][...] = frame
+        ring["sequences"][slot_index] = ring["sequence"]
+        ring["next_slot_index"] = (slot_index+1) % self.number_of_slots
+
+        self.notification_queue.put(("frame", {
+            "camera_uuid": frame_info["camera_uuid"],
+            "frame_uuid": frame_info["frame_uuid"],
+            "frame_timestamp": frame_info["frame_timestamp"],
+            "motion_score": frame_info.get("motion_score"),
+            "decode_duration_seconds": frame_info.get("decode_duration_seconds"),
+            "shared_memory_name": ring["shared_memory"].name,
+            "frame_shape": frame.shape,
+            "number_of_slots": self.number_of_slots,
+            "slot_index": slot_index,
+            "sequence": ring["sequence"],
+        }))
+
+    def close(self) -> None:
+        with self.rings_lock:
+            for ring in self.rings.values():
+                self.__release_ring(ring)
+            self.rings = {}
+
+    def __create_ring(self, camera_uuid:str = None, frame_shape:tuple = None) -> Dict:
+        if camera_uuid in self.rings: self.__release_ring(self.rings[camera_uuid]) # Frame shape changed, the evaluation process keeps its own mapping of the old block until it closes it
+
+        header_bytes = 8*self.number_of_slots
+        frame_bytes = int(np.prod(frame_shape))
+        block = shared_memory.SharedMemory(create=True, size=header_bytes + self.number_of_slots*frame_bytes)
+        sequences = np.ndarray((self.number_of_slots,), dtype=np.int64, buffer=block.buf)
+        sequences[:] = -1
+        slots = np.ndarray((self.number_of_slots, *frame_shape), dtype=np.uint8, buffer=block.buf, offset=header_bytes)
+
+        self.rings[camera_uuid] = {"shared_memory": block, "frame_shape": frame_shape, "sequences": sequences, "slots": slots, "next_slot_index": 0, "sequence": 0}
+        return self.rings[camera_uuid]
+
+    def __release_ring(self, ring:Dict = None) -> None:
+        del ring["sequences"], ring["slots"] # numpy views must be released before the block can be closed
+        ring["shared_memory"].close()
+        ring["shared_memory"].unlink()
+
+def _decoder_process_main(camera_configs:List[Dict] = None, notification_queue:multiprocessing.Queue = None, control_queue:multiprocessing.Queue = None, stop_event = None) -> None:
+    # Entry point of a decoder process. Runs a regular StreamManager (with its own supervisor) for the given cameras and writes their frames to shared memory
+    import camera_module
+    server_preferences.CAMERA_DECODER_PROCESSES = 0 # The cameras of this process are decoded by its own threads
+
+    stream_manager = camera_module.StreamManager(camera_configs = camera_configs)
+    shared_frame_writer = SharedFrameRingWriter(notification_queue = notification_queue)
+    stream_manager.attach_frame_queues(frame_queues = shared_frame_writer)
+    stream_manager.start_cameras_by_uuid(camera_uuids = [])
+
+    while not stop_event.wait(timeout=server_preferences.CAMERA_SUPERVISOR_PERIOD_SECONDS):
+        notification_queue.put(("health", stream_manager.return_camera_health_states()))
+
+        # The frames are evaluated in the evaluation process, so the fetching delays are controlled from there
+        while not control_queue.empty():
+            fetching_delays = control_queue.get()
+            for camera in stream_manager.cameras:
+                if camera.camera_uuid in fetching_delays: camera.fetching_delay_override = camera.camera_fetching_delay = fetching_delays[camera.camera_uuid]
+
+    stream_manager.stop_supervisor()
+    stream_manager.stop_cameras_by_uuid(camera_uuids = [])
+    shared_frame_writer.close()
+
+class DecoderProcessPool:
+    # Shards the cameras across decoder processes. Frames are read from shared memory without copying and published through the parent's CameraStreamFetcher objects,
+    # so the rest of the server (last_frame_info, frame queues, evaluation) does not need to know which process decoded the frame
+    def __init__(self, cameras:List = None, number_of_processes:int = None) -> None:
+        self.cameras_by_uuid = {camera.camera_uuid: camera for camera in cameras}
+        self.number_of_processes = max(1, min(number_of_processes, len(cameras)))
+
+        self.multiprocessing_context = multiprocessing.get_context("spawn") # Forking a process that already runs capture threads is not safe
+        self.notification_queue = self.multiprocessing_context.Queue()
+        self.stop_event = self.multiprocessing_context.Event()
+        self.processes:List[Dict] = [] # {"process", "camera_configs", "control_queue"}
+        self.attached_shared_memories:Dict[str, shared_memory.SharedMemory] = {}
+        self.camera_shared_memory_names:Dict[str, str] = {} # camera_uuid -> name of the block its latest frame was read from
+        self.detached_shared_memories:List[shared_memory.SharedMemory] = [] # Replaced blocks whose frames are still referenced, closed as soon as possible
+
+        self.is_running = False
+        self.reader_thread = None
+
+    def start(self) -> None:
+        self.is_running = True
+        self.stop_event.clear()
+
+        shards:List[List[Dict]] = [[] for _ in range(self.number_of_processes)]
+        for camera_index, camera in enumerate(self.cameras_by_uuid.values()):
+            shards[camera_index % self.number_of_processes].append(camera.camera_config)
+            camera.is_fetching_frames = True
+            camera.health_state = "connecting"
+
+        for camera_configs in shards:
+            control_queue = self.multiprocessing_context.Queue()
+            self.processes.append({"process": self.__start_decoder_process(camera_configs = camera_configs, control_queue = control_queue), "camera_configs": camera_configs, "control_queue": control_queue})
+
+        self.reader_thread = threading.Thread(target=self.__reader_thread)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def stop(self) -> None:
+        # The reader thread keeps draining the notification queue until the decoder processes exit, otherwise they may block while flushing the queue
+        self.stop_event.set()
+        for decoder_process in self.processes:
+            decoder_process["process"].join(timeout=server_preferences.CAMERA_GRAB_TIMEOUT_SECONDS)
+            if decoder_process["process"].is_alive(): decoder_process["process"].terminate()
+        self.processes = []
+        self.is_running = False
+        if self.reader_thread is not None: self.reader_thread.join()
+        self.reader_thread = None
+
+        for camera in self.cameras_by_uuid.values():
+            camera.is_fetching_frames = False
+            camera.health_state = "stopped"
+            camera.last_frame_info = None # Frames are views of the shared memory blocks which are closed below
+        for attached_shared_memory in list(self.attached_shared_memories.values()) + self.detached_shared_memories:
+            try:
+                attached_shared_memory.close()
+            except BufferError: # Some frames are still referenced (e.g. by evaluation results), the mapping is released when they are garbage collected
+                pass
+        self.attached_shared_memories = {}
+        self.camera_shared_memory_names = {}
+        self.detached_shared_memories = []
+
+    def is_shared_frame_valid(self, frame_info:Dict = None) -> bool:
+        # A frame read from shared memory stays valid until its slot is overwritten by the decoder process. Check this after using a frame if that matters
+        attached_shared_memory = self.attached_shared_memories.get(frame_info["shared_memory_name"])
+        if attached_shared_memory is None: return False
+        sequences = np.ndarray((frame_info["number_of_slots"],), dtype=np.int64, buffer=attached_shared_memory.buf)
+        return int(sequences[frame_info["slot_index"]]) == frame_info["sequence"]
+
+    def __start_decoder_process(self, camera_configs:List[Dict] = None, control_queue:multiprocessing.Queue = None):
+        decoder_process = self.multiprocessing_context.Process(target=_decoder_process_main, args=(camera_configs, self.notification_queue, control_queue, self.stop_event))
+        decoder_process.daemon = True
+        decoder_process.start()
+        return decoder_process
+
+    def __reader_thread(self) -> None:
+        while self.is_running:
+            try:
+                message_type, message = self.notification_queue.get(timeout=server_preferences.CAMERA_SUPERVISOR_PERIOD_SECONDS)
+            except queue.Empty:
+                self.__restart_dead_decoder_processes()
+                continue
+
+            if message_type == "frame":
+                self.__publish_shared_frame(frame_metadata = message)
+            elif message_type == "health":
+                for camera_uuid, health_state in message.items():
+                    camera = self.cameras_by_uuid[camera_uuid]
+                    camera.health_state = health_state["health_state"]
+                    camera.reconnect_attempts = health_state["reconnect_attempts"]
+                    camera.last_successful_grab_time = health_state["last_successful_grab_time"]
+                self.__send_fetching_delays()
+                self.__restart_dead_decoder_processes()
+                self.__close_detached_shared_memories()
+
+    def __publish_shared_frame(self, frame_metadata:Dict = None) -> None:
+        shared_memory_name = frame_metadata["shared_memory_name"]
+        if shared_memory_name not in self.attached_shared_memories:
+            try:
+                self.attached_shared_memories[shared_memory_name] = shared_memory.SharedMemory(name=shared_memory_name)
+            except FileNotFoundError: # The block is already released by the decoder process (frame shape changed or the process stopped)
+                return
+        attached_shared_memory = self.attached_shared_memories[shared_memory_name]
+
+        # A new block means the frame shape of the camera changed (or its decoder process restarted), the old block is never written again
+        previous_shared_memory_name = self.camera_shared_memory_names.get(frame_metadata["camera_uuid"])
+        if previous_shared_memory_name is not None and previous_shared_memory_name != shared_memory_name:
+            previous_shared_memory = self.attached_shared_memories.pop(previous_shared_memory_name, None)
+            if previous_shared_memory is not None: self.detached_shared_memories.append(previous_shared_memory)
+            self.__close_detached_shared_memories()
+        self.camera_shared_memory_names[frame_metadata["camera_uuid"]] = shared_memory_name
+
+        header_bytes = 8*frame_metadata["number_of_slots"]
+        frame_shape = frame_metadata["frame_shape"]
+        frame_bytes = int(np.prod(frame_shape))
+        frame = np.ndarray(frame_shape, dtype=np.uint8, buffer=attached_shared_memory.buf, offset=header_bytes + frame_metadata["slot_index"]*frame_bytes)
+
+        camera = self.cameras_by_uuid[frame_metadata["camera_uuid"]]
+        frame_info = {}
+        frame_info["frame"] = frame
+        frame_info["camera_uuid"] = frame_metadata["camera_uuid"]
+        frame_info["frame_uuid"] = frame_metadata["frame_uuid"]
+        frame_info["frame_timestamp"] = frame_metadata["frame_timestamp"]
+        frame_info["active_rules"] = camera.active_rules
+        frame_info["is_evaluated"] = False
+        frame_info["motion_score"] = frame_metadata["motion_score"]
+        frame_info["shared_memory_name"] = shared_memory_name
+        frame_info["number_of_slots"] = frame_metadata["number_of_slots"]
+        frame_info["slot_index"] = frame_metadata["slot_index"]
+        frame_info["sequence"] = frame_metadata["sequence"]
+
+        if camera.last_frame_info is not None and not camera.last_frame_info["is_evaluated"]:
+            camera.number_of_frames_overwritten_unevaluated += 1
+        camera.last_frame_info = frame_info
+        camera.number_of_frames_fetched += 1
+        if frame_metadata["decode_duration_seconds"] is not None: camera.record_decode_duration(decode_duration_seconds = frame_metadata["decode_duration_seconds"])
+        if camera.frame_queues is not None: camera.frame_queues.put(frame_info)
+
+    def __close_detached_shared_memories(self) -> None:
+        still_referenced_shared_memories = []
+        for detached_shared_memory in self.detached_shared_memories:
+            try:
+                detached_shared_memory.close()
+            except BufferError: # Frames of the block are still waiting for their evaluation, try again later
+                still_referenced_shared_memories.append(detached_shared_memory)
+        self.detached_shared_memories = still_referenced_shared_memories
+
+    def __send_fetching_delays(self) -> None:
+        # The rate controllers of the cameras run in this process, where the evaluations happen
+        for decoder_process in self.processes:
+            decoder_process["control_queue"].put({camera_config["camera_uuid"]: self.cameras_by_uuid[camera_config["camera_uuid"]].camera_fetching_delay for camera_config in decoder_process["camera_configs"]})
+
+    def __restart_dead_decoder_processes(self) -> None:
+        for decoder_process in self.processes:
+            if not self.stop_event.is_set() and not decoder_process["process"].is_alive():
+                if server_preferences.CAMERA_VERBOSE: print(f'Decoder process {decoder_process["process"].pid} is dead, restarting it at {time.time()}')
+                decoder_process["process"] = self.__start_decoder_process(camera_configs = decoder_process["camera_configs"], control_queue = decoder_process["control_queue"])
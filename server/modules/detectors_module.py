@@ -6,23 +6,101 @@ from ultralytics import YOLO
 import numpy as np
 import cv2
 #Local imports
-import modules.server_preferences as server_preferences
+import server_preferences
+import inference_backend_module
+import metrics_module
 
-class PoseDetector(): 
-    #keypoints detected by the model in the detection order
-    KEYPOINT_NAMES = ["nose", "right_eye", "left_eye", "left_ear", "right_ear", "left_shoulder", "right_shoulder", "left_elbow" ,"right_elbow","left_wrist", "right_wrist", "left_hip", "right_hip", "left_knee", "right_knee", "left_ankle", "right_ankle"]
-    POSE_MODEL_PATHS = {
-        "yolov8n-pose":"modules/trained_yolo_models/yolov8n-pose.pt",
-        "yolov8l-pose":"modules/trained_yolo_models/yolov8l-pose.pt",
-        "yolov8x-pose":"modules/trained_yolo_models/yolov8x-pose.pt"
-    }
+class PoseDetectionsRecord():
+    # Columnar container for the detections of a single frame. N detections are stored as arrays (N,), (N,4), (N,17,2), (N,17)
+    # Indexing or iterating the record returns the detections in the legacy dictionary format, which are built lazily and cached
 
-    def __init__(self, model_name: str = None ) -> None:   
-        if model_name not in PoseDetector.POSE_MODEL_PATHS.keys():
-            raise ValueError(f"Invalid model name. Available models are: {PoseDetector.POSE_MODEL_PATHS.keys()}")
-        self.MODEL_PATH = PoseDetector.POSE_MODEL_PATHS[model_name]        
-        self.yolo_object = YOLO( self.MODEL_PATH, verbose= server_preferences.POSE_DETECTION_VERBOSE)        
-        self.recent_prediction_results:List[Dict] = None # This will be a list of dictionaries, each dictionary will contain the prediction results for a single detection
+    def __init__(self, frame_info:Dict = None, frame_shape:List[int] = None, class_names:List[str] = None, bbox_confidences:np.ndarray = None, bbox_xyxy_px:np.ndarray = None, keypoints_xy:np.ndarray = None, keypoints_conf:np.ndarray = None, track_ids:np.ndarray = None, rule_name:str = None) -> None:
+        self.frame = frame_info["frame"]
+        self.camera_uuid = frame_info["camera_uuid"]
+        self.frame_uuid = frame_info["frame_uuid"]
+        self.frame_timestamp = frame_info["frame_timestamp"]
+        self.frame_shape = frame_shape                          # [height , width] in pixels
+        self.class_names = class_names                          # (N,) class name of each detection
+        self.bbox_confidences = bbox_confidences                # (N,) 0.0 to 1.0
+        self.bbox_xyxy_px = bbox_xyxy_px                        # (N,4) [x1,y1,x2,y2] in pixels
+        self.keypoints_xy = keypoints_xy                        # (N,17,2) [x,y] in pixels, in PoseDetector.KEYPOINT_NAMES order
+        self.keypoints_conf = keypoints_conf                    # (N,17) negative if the keypoint is not detected
+        self.track_ids = track_ids                              # (N,) id of the tracked person of each detection, None until the detections are tracked
+        self.rule_name = rule_name                              # name of the rule violated by the detections, None if the record is not an evaluation result
+
+        self.__detection_dicts:List[Dict] = [None]*len(self.bbox_confidences)
+
+    @property
+    def bbox_center_px(self) -> np.ndarray:
+        return (self.bbox_xyxy_px[:, 0:2] + self.bbox_xyxy_px[:, 2:4]) / 2
+
+    def select(self, detection_mask:np.ndarray = None) -> "PoseDetectionsRecord":
+        # Returns a new record containing only the detections where detection_mask is True
+        frame_info = {"frame":self.frame, "camera_uuid":self.camera_uuid, "frame_uuid":self.frame_uuid, "frame_timestamp":self.frame_timestamp}
+        return PoseDetectionsRecord(
+            frame_info = frame_info,
+            frame_shape = self.frame_shape,
+            class_names = [class_name for class_name, is_selected in zip(self.class_names, detection_mask) if is_selected],
+            bbox_confidences = self.bbox_confidences[detection_mask],
+            bbox_xyxy_px = self.bbox_xyxy_px[detection_mask],
+            keypoints_xy = self.keypoints_xy[detection_mask],
+            keypoints_conf = self.keypoints_conf[detection_mask],
+            track_ids = self.track_ids[detection_mask] if self.track_ids is not None else None,
+            rule_name = self.rule_name,
+        )
+
+    def map_to_frame(self, frame:np.ndarray = None) -> "PoseDetectionsRecord":
+        # Returns a new record for the same detections on another resolution of the same view (e.g. the high resolution evidence frame of a sub-stream detection)
+        # Missing keypoints are kept at (0,0)
+        frame_height, frame_width = frame.shape[:2]
+        scale_x, scale_y = frame_width / self.frame_shape[1], frame_height / self.frame_shape[0]
+        is_keypoint_missing = self.keypoints_conf < 0
+
+        frame_info = {"frame":frame, "camera_uuid":self.camera_uuid, "frame_uuid":self.frame_uuid, "frame_timestamp":self.frame_timestamp}
+        return PoseDetectionsRecord(
+            frame_info = frame_info,
+            frame_shape = [frame_height, frame_width],
+            class_names = list(self.class_names),
+            bbox_confidences = self.bbox_confidences.copy(),
+            bbox_xyxy_px = self.bbox_xyxy_px * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32),
+            keypoints_xy = np.where(is_keypoint_missing[..., np.newaxis], self.keypoints_xy, self.keypoints_xy * np.array([scale_x, scale_y], dtype=np.float32)),
+            keypoints_conf = self.keypoints_conf.copy(),
+            track_ids = self.track_ids.copy() if self.track_ids is not None else None,
+            rule_name = self.rule_name,
+        )
+
+    def __len__(self) -> int:
+        return len(self.bbox_confidences)
+
+    def __iter__(self):
+        for detection_index in range(len(self)):
+            yield self[detection_index]
+
+    def __getitem__(self, detection_index:int) -> Dict:
+        if self.__detection_dicts[detection_index] is None:
+            self.__detection_dicts[detection_index] = self.__build_prediction_dict(detection_index = detection_index)
+        return self.__detection_dicts[detection_index]
+
+    def __build_prediction_dict(self, detection_index:int = None) -> Dict:
+        box_xyxy = self.bbox_xyxy_px[detection_index]
+
+        prediction_dict_template = self.__get_empty_prediction_dict_template()
+        prediction_dict_template["common_keys"]["frame"] = self.frame
+        prediction_dict_template["common_keys"]["camera_uuid"] = self.camera_uuid
+        prediction_dict_template["common_keys"]["frame_uuid"] = self.frame_uuid
+        prediction_dict_template["common_keys"]["frame_timestamp"] = self.frame_timestamp
+        prediction_dict_template["common_keys"]["frame_shape"] = self.frame_shape
+        prediction_dict_template["common_keys"]["class_name"] = self.class_names[detection_index]
+        prediction_dict_template["common_keys"]["bbox_confidence"] = self.bbox_confidences[detection_index]
+        prediction_dict_template["common_keys"]["bbox_xyxy_px"] = box_xyxy # Bounding box in the format [x1,y1,x2,y2]
+        prediction_dict_template["common_keys"]["bbox_center_px"] = [ (box_xyxy[0]+box_xyxy[2])/2, (box_xyxy[1]+box_xyxy[3])/2]
+        prediction_dict_template["common_keys"]["track_id"] = int(self.track_ids[detection_index]) if self.track_ids is not None else None
+
+        for keypoint_index, keypoint_name in enumerate(PoseDetector.KEYPOINT_NAMES):
+            keypoint_x, keypoint_y = self.keypoints_xy[detection_index][keypoint_index]
+            prediction_dict_template["unique_keys"]["keypoints"][keypoint_name] = [keypoint_x, keypoint_y , self.keypoints_conf[detection_index][keypoint_index]]
+
+        return prediction_dict_template
 
     def __get_empty_prediction_dict_template(self) -> dict:
         empty_prediction_dict = {   
@@ -38,6 +116,7 @@ class PoseDetector():
                         "bbox_confidence":0,                                        # 0.0 to 1.0
                         "bbox_xyxy_px":[0,0,0,0],                                   # [x1,y1,x2,y2] in pixels
                         "bbox_center_px": [0,0],                                    # [x,y] in pixels
+                        "track_id": None,                                           # id of the tracked person, stable between the frames of the camera
                     },
                     #------------------pose specific fields------------------
                     "unique_keys":{ # Any other information that is not covered by the fields above
@@ -63,58 +142,132 @@ class PoseDetector():
                    
         }
         return empty_prediction_dict
-    
-    def predict_frame_and_return_detections(self, frame_info:np.ndarray = None, bbox_confidence:float=0.75) -> List[Dict]:
-        self.recent_prediction_results = []
-        
-        #frame_info is a dictionary containing the frame, camera_uuid, frame_uuid, frame_timestamp and is_checked_for_active_rules
-        frame = frame_info["frame"]
-        camera_uuid = frame_info["camera_uuid"]
-        frame_uuid = frame_info["frame_uuid"]
-        frame_timestamp = frame_info["frame_timestamp"]
-
-        results = self.yolo_object(frame, task = "pose", verbose= server_preferences.POSE_DETECTION_VERBOSE)[0]
-        for i, result in enumerate(results):
-            boxes = result.boxes
-            box_cls_no = int(boxes.cls.cpu().numpy()[0])
-            box_cls_name = self.yolo_object.names[box_cls_no]
-            if box_cls_name not in ["person"]:
-                continue
-            box_conf = boxes.conf.cpu().numpy()[0]
-            if box_conf < bbox_confidence:
-                continue
-            box_xyxy = boxes.xyxy.cpu().numpy()[0]
-
-            prediction_dict_template = self.__get_empty_prediction_dict_template()
-            prediction_dict_template["common_keys"]["frame"] = frame
-            prediction_dict_template["common_keys"]["camera_uuid"] = camera_uuid
-            prediction_dict_template["common_keys"]["frame_uuid"] = frame_uuid
-            prediction_dict_template["common_keys"]["detection_uuid"] = str(uuid.uuid4()) #unique id for the detection
-            prediction_dict_template["common_keys"]["frame_timestamp"] = frame_timestamp
-            prediction_dict_template["common_keys"]["frame_shape"] = list(results.orig_shape)
-            prediction_dict_template["common_keys"]["class_name"] = box_cls_name
-            prediction_dict_template["common_keys"]["bbox_confidence"] = box_conf
-            prediction_dict_template["common_keys"]["bbox_xyxy_px"] = box_xyxy # Bounding box in the format [x1,y1,x2,y2]
-            prediction_dict_template["common_keys"]["bbox_center_px"] = [ (box_xyxy[0]+box_xyxy[2])/2, (box_xyxy[1]+box_xyxy[3])/2]
-            
-            key_points = result.keypoints  # Keypoints object for pose outputs
-            keypoint_confs = key_points.conf.cpu().numpy()[0]
-            keypoints_xy = key_points.xy.cpu().numpy()[0]
-                       
-            for keypoint_index, keypoint_name in enumerate(PoseDetector.KEYPOINT_NAMES):
-                keypoint_conf = keypoint_confs[keypoint_index] 
-                keypoint_x = keypoints_xy[keypoint_index][0]
-                keypoint_y = keypoints_xy[keypoint_index][1]
-                if keypoint_x == 0 and keypoint_y == 0: #if the keypoint is not detected
-                    #But this is also a prediction. Thus the confidence should not be set to zero. negative values are used to indicate that the keypoint is not detected
-                    keypoint_conf = -keypoint_conf
-
-                prediction_dict_template["unique_keys"]["keypoints"][keypoint_name] = [keypoint_x, keypoint_y , keypoint_conf]
-
-            self.recent_prediction_results.append(prediction_dict_template)
 
+class PoseDetector(): 
+    #keypoints detected by the model in the detection order
+    KEYPOINT_NAMES = ["nose", "right_eye", "left_eye", "left_ear", "right_ear", "left_shoulder", "right_shoulder", "left_elbow" ,"right_elbow","left_wrist", "right_wrist", "left_hip", "right_hip", "left_knee", "right_knee", "left_ankle", "right_ankle"]
+    POSE_MODEL_PATHS = {
+        "yolov8n-pose":"modules/trained_yolo_models/yolov8n-pose.pt",
+        "yolov8l-pose":"modules/trained_yolo_models/yolov8l-pose.pt",
+        "yolov8x-pose":"modules/trained_yolo_models/yolov8x-pose.pt"
+    }
+
+    BACKENDS = ["pytorch", "onnx", "onnx_static", "onnx_int8", "onnx_static_int8"]
+
+    def __init__(self, model_name: str = None, backend: str = None ) -> None:   
+        if model_name not in PoseDetector.POSE_MODEL_PATHS.keys():
+            raise ValueError(f"Invalid model name. Available models are: {PoseDetector.POSE_MODEL_PATHS.keys()}")
+        self.backend = backend if backend is not None else server_preferences.INFERENCE_BACKENDS.get(model_name, "pytorch")
+        if self.backend not in PoseDetector.BACKENDS:
+            raise ValueError(f"Invalid inference backend: {self.backend}. Available backends are: {PoseDetector.BACKENDS}")
+        self.model_name = model_name
+        self.MODEL_PATH = PoseDetector.POSE_MODEL_PATHS[model_name]        
+
+        # The onnx backends run the weights exported from self.MODEL_PATH, see inference_backend_module
+        self.yolo_object = None
+        self.onnx_backend = None
+        if self.backend == "pytorch":
+            self.yolo_object = YOLO( self.MODEL_PATH, verbose= server_preferences.POSE_DETECTION_VERBOSE)        
+            self.class_names = self.yolo_object.names
+        else:
+            onnx_model_path = inference_backend_module.return_onnx_model_path(pt_model_path = self.MODEL_PATH, image_size = server_preferences.INFERENCE_IMAGE_SIZE, is_static_shape = "static" in self.backend, is_int8 = "int8" in self.backend)
+            self.onnx_backend = inference_backend_module.ONNXPoseBackend(onnx_model_path = onnx_model_path)
+            self.class_names = inference_backend_module.ONNXPoseBackend.CLASS_NAMES
+        metric_labels = {"model": model_name, "backend": self.backend}
+        self.inference_duration_histogram = metrics_module.METRICS.histogram(name = "safety_ai_detector_inference_seconds", help_text = "Duration of a forward pass including the decoding of the results", labels = metric_labels)
+        self.batch_size_histogram = metrics_module.METRICS.histogram(name = "safety_ai_detector_batch_size", help_text = "Number of frames in a forward pass", labels = metric_labels, bucket_bounds = server_preferences.METRICS_BATCH_SIZE_BUCKETS)
+        self.recent_prediction_results:PoseDetectionsRecord = None # Detections of the most recent frame, indexing it returns the prediction results of a single detection as a dictionary
+
+    def predict_frame_and_return_detections(self, frame_info:np.ndarray = None, bbox_confidence:float=0.75) -> "PoseDetectionsRecord":
+        self.recent_prediction_results = self.predict_frames_and_return_detections(frames_info = [frame_info], bbox_confidence = bbox_confidence)[0]
         return self.recent_prediction_results
 
+    def predict_frames_and_return_detections(self, frames_info:List[Dict] = None, bbox_confidence:float=0.75, rois_xyxy:List[List[int]] = None, is_warmup:bool = False) -> List["PoseDetectionsRecord"]:
+        # Runs a single forward pass for all the frames and returns the detections of each frame in the same order as frames_info
+        # Warmup inferences (see ModelRegistry) are kept out of the inference duration and batch size histograms
+        # If rois_xyxy is provided, inference runs only on the [x1,y1,x2,y2] crop of each frame (None means the full frame) and detections are mapped back to full-frame pixel coordinates
+        if len(frames_info) == 0: return []
+        if rois_xyxy is None: rois_xyxy = [None]*len(frames_info)
+        inference_start_time = time.perf_counter()
+
+        frames = []
+        for frame_info, roi_xyxy in zip(frames_info, rois_xyxy):
+            if roi_xyxy is None:
+                frames.append(frame_info["frame"])
+            else:
+                frames.append(frame_info["frame"][roi_xyxy[1]:roi_xyxy[3], roi_xyxy[0]:roi_xyxy[2]])
+        # Model inputs prepared by the fetcher threads (see CAMERA_PREPARE_MODEL_INPUTS), None for the frames that are preprocessed here
+        model_inputs = [frame_info.get("model_inputs", {}).get(tuple(roi_xyxy) if roi_xyxy is not None else None) for frame_info, roi_xyxy in zip(frames_info, rois_xyxy)]
+
+        if self.onnx_backend is not None:
+            batch_arrays = self.onnx_backend.predict(frames = frames, model_inputs = model_inputs)
+        elif any(model_input is not None for model_input in model_inputs):
+            batch_arrays = self.__predict_model_inputs(frames = frames, model_inputs = model_inputs)
+        else:
+            batch_arrays = [self.__return_result_arrays(results = results) for results in self.yolo_object(frames, task = "pose", verbose= server_preferences.POSE_DETECTION_VERBOSE)]
+
+        detections_per_frame = []
+        for frame_info, result_arrays, roi_xyxy in zip(frames_info, batch_arrays, rois_xyxy):
+            detections_per_frame.append(self.__decode_results(frame_info = frame_info, result_arrays = result_arrays, bbox_confidence = bbox_confidence, roi_xyxy = roi_xyxy))
+        if not is_warmup:
+            self.inference_duration_histogram.observe(time.perf_counter() - inference_start_time)
+            self.batch_size_histogram.observe(len(frames_info))
+        return detections_per_frame
+
+    def __predict_model_inputs(self, frames:List[np.ndarray] = None, model_inputs:List[Tuple] = None) -> List[Tuple]:
+        # The letterboxed inputs are passed to ultralytics as a single tensor, which skips its own preprocessing. The results are mapped back from the letterboxed inputs to the frames
+        import torch
+        for frame_index, model_input in enumerate(model_inputs):
+            if model_input is None or model_input[0].shape != (server_preferences.INFERENCE_IMAGE_SIZE, server_preferences.INFERENCE_IMAGE_SIZE, 3):
+                model_inputs[frame_index] = inference_backend_module.return_model_input(frame = frames[frame_index], image_size = server_preferences.INFERENCE_IMAGE_SIZE)
+        input_batch = torch.from_numpy(inference_backend_module.return_input_batch(model_inputs = model_inputs))
+
+        batch_arrays = []
+        for results, model_input in zip(self.yolo_object(input_batch, task = "pose", verbose= server_preferences.POSE_DETECTION_VERBOSE), model_inputs):
+            boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = self.__return_result_arrays(results = results)
+            boxes_xyxy, keypoints_xy = inference_backend_module.undo_letterbox(boxes_xyxy = boxes_xyxy, keypoints_xy = keypoints_xy, letterbox_transform = model_input[1])
+            batch_arrays.append((boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf))
+        return batch_arrays
+
+    def __return_result_arrays(self, results = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Boxes and keypoints are copied off the device once per frame
+        boxes_cls = results.boxes.cls.cpu().numpy().astype(np.int32)
+        boxes_conf = results.boxes.conf.cpu().numpy().astype(np.float32)
+        boxes_xyxy = results.boxes.xyxy.cpu().numpy().astype(np.float32)
+        if results.keypoints is not None:
+            keypoints_xy = results.keypoints.xy.cpu().numpy().astype(np.float32)
+            keypoints_conf = results.keypoints.conf.cpu().numpy().astype(np.float32) if results.keypoints.conf is not None else np.ones(keypoints_xy.shape[:2], dtype=np.float32)
+        else:
+            keypoints_xy = np.zeros((len(boxes_cls), len(PoseDetector.KEYPOINT_NAMES), 2), dtype=np.float32)
+            keypoints_conf = np.zeros((len(boxes_cls), len(PoseDetector.KEYPOINT_NAMES)), dtype=np.float32)
+        return boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf
+
+    def __decode_results(self, frame_info:Dict = None, result_arrays:Tuple = None, bbox_confidence:float=0.75, roi_xyxy:List[int] = None) -> "PoseDetectionsRecord":
+        # Filtering is done on the whole arrays at once
+        boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = result_arrays
+        person_class_ids = [class_no for class_no, class_name in self.class_names.items() if class_name in ["person"]]
+        keep_mask = np.isin(boxes_cls, person_class_ids) & (boxes_conf >= bbox_confidence)
+
+        #if the keypoint is not detected, it is still a prediction. Thus the confidence should not be set to zero. negative values are used to indicate that the keypoint is not detected
+        keypoints_xy = keypoints_xy[keep_mask]
+        keypoints_conf = keypoints_conf[keep_mask]
+        is_keypoint_missing = np.all(keypoints_xy == 0, axis=2)
+        keypoints_conf = np.where(is_keypoint_missing, -keypoints_conf, keypoints_conf)
+
+        boxes_xyxy = boxes_xyxy[keep_mask]
+        if roi_xyxy is not None: # Map the detections from the crop back to the full frame, missing keypoints are kept at (0,0)
+            boxes_xyxy = boxes_xyxy + np.array([roi_xyxy[0], roi_xyxy[1], roi_xyxy[0], roi_xyxy[1]], dtype=np.float32)
+            keypoints_xy = np.where(is_keypoint_missing[..., np.newaxis], keypoints_xy, keypoints_xy + np.array([roi_xyxy[0], roi_xyxy[1]], dtype=np.float32))
+
+        return PoseDetectionsRecord(
+            frame_info = frame_info,
+            frame_shape = list(frame_info["frame"].shape[:2]),
+            class_names = [self.class_names[class_no] for class_no in boxes_cls[keep_mask]],
+            bbox_confidences = boxes_conf[keep_mask],
+            bbox_xyxy_px = boxes_xyxy,
+            keypoints_xy = keypoints_xy,
+            keypoints_conf = keypoints_conf,
+        )
 
 # Test
 
@@ -1,64 +1,258 @@
-import pprint, random
-from typing import List, Dict, Tuple #for python3.8 compatibility
+import pprint, time, math, queue
+from typing import List, Dict, Tuple, Set #for python3.8 compatibility
+import numpy as np
+import cv2
 import detectors_module
+import scheduler_module
+import tracker_module
+import model_registry_module
+import metrics_module
+import inference_backend_module
 import server_preferences
 
 
 class EvaluationManager():
+    # Keypoints that are checked against the restricted area mask, in addition to the bottom center of the bounding box (footpoint)
+    RESTRICTED_AREA_KEYPOINT_NAMES = ["left_hip", "right_hip", "left_ankle", "right_ankle"]
   
     def __init__(self, yolo_models_to_be_used:List[str] = None) -> None:
-        AVAILABLE_MODELS = ["yolov8n-pose", "yolov8l-pose", "yolov8x-pose"] # add model names defined in predictors_module.py classes here
-        for model_name in yolo_models_to_be_used:
-            print(model_name, AVAILABLE_MODELS)
-            if model_name not in AVAILABLE_MODELS:
-                raise ValueError(f"Invalid model name. Available models are: {AVAILABLE_MODELS}")
-            
-        # Create YOLO objects
-        self.DETECTORS = {}
-        for model_name in yolo_models_to_be_used:
-            if model_name in ["yolov8n-pose", "yolov8l-pose", "yolov8x-pose"]:
-                self.DETECTORS[model_name] = detectors_module.PoseDetector(model_name=model_name)
-            else:
-                raise ValueError(f"Invalid model name. Available models are: {AVAILABLE_MODELS}")
-            
+        # Models are loaded by the registry on their first use, not here
+        self.model_registry = model_registry_module.ModelRegistry()
+        self.model_registry.validate_model_names(model_names = yolo_models_to_be_used)
+        self.yolo_models_to_use = set(yolo_models_to_be_used) # Models required by the active rules of the cameras
+
         # Keep track of the camera 'usefulness' allocation of the computation resources
         self.camera_usefulness = {}
-        self.camera_evaluation_probabilities = {}
+
+        # The scheduler shares the inference budget between the cameras in proportion to their usefulness
+        if server_preferences.EVALUATION_BUDGET_MODE == "frames":
+            budget_per_second = server_preferences.EVALUATION_BUDGET_FRAMES_PER_SECOND
+        elif server_preferences.EVALUATION_BUDGET_MODE == "model_time":
+            budget_per_second = server_preferences.EVALUATION_BUDGET_MODEL_MS_PER_SECOND
+        else:
+            raise ValueError(f"Invalid evaluation budget mode: {server_preferences.EVALUATION_BUDGET_MODE}. Available modes are: ['frames', 'model_time']")
+        self.scheduler = scheduler_module.EvaluationScheduler(budget_per_second = budget_per_second)
+        self.model_inference_ms_per_frame = {} # yolo_model_to_use -> moving average of the measured inference duration per frame, used as the frame cost in 'model_time' budget mode
+
+        # Frames waiting to be evaluated in a single forward pass, grouped by the yolo model they require
+        self.pending_batches = {} # yolo_model_to_use -> {"frames_info": {frame_uuid: frame_info}, "collection_start_time": float}
+
+        # Rasterized restricted area masks. Rebuilt only when the rule polygon or the frame shape changes
+        self.zone_masks = {} # (camera_uuid, rule_index) -> {"rule_polygon": tuple, "frame_shape": tuple, "mask": np.ndarray, "mask_integral": np.ndarray}
+
+        # Padded bounding boxes of the restricted areas, merged for the rules of a camera that use the same yolo model
+        self.camera_rois = {} # (camera_uuid, yolo_model_to_use) -> {"rule_polygons": tuple, "frame_shape": tuple, "roi_xyxy": List[int] or None}
+
+        # People are tracked between the evaluations of a camera, so that each detection has a stable track id
+        self.trackers = {} # (camera_uuid, yolo_model_to_use) -> tracker_module.MultiPersonTracker
+        self.reported_track_ids = {} # (camera_uuid, rule_index) -> set of the (yolo_model_to_use, track_id) pairs that are already reported as violating the rule
+
+        # Config changes prepared by other threads (see update_models and forget_cameras), applied by the evaluation thread between two evaluations
+        self.pending_config_updates = queue.Queue()
+
+        # Updated by the evaluation thread only. The per camera scores are read by the metrics collector at scrape time (see return_metrics)
+        self.evaluation_duration_histogram = metrics_module.METRICS.histogram(name = "safety_ai_evaluation_call_seconds", help_text = "Duration of a single evaluate_frames_info call")
+        self.frames_skipped_static_counter = metrics_module.METRICS.counter(name = "safety_ai_evaluation_frames_skipped_static_total", help_text = "Frames skipped without inference because the scene was static")
+        self.frame_age_at_inference_histograms = {} # yolo_model_to_use -> metrics_module.Histogram of the age of the frames when their batch is sent to the model
+        metrics_module.METRICS.register_collector(collector_name = "evaluation_manager", collector = self.return_metrics)
             
-    def evaluate_frames_info(self, frames_info:List[Dict]) -> Tuple[List[str], List[Dict]]:
-        evaluated_uuids:List[str] = []
+    def evaluate_frames_info(self, frames_info:List[Dict]) -> Tuple[Set[str], List[Dict]]:
+        evaluated_uuids:Set[str] = set() # A frame can be evaluated by several models, a set keeps the membership checks constant time
         evaluation_results:List[Dict] = []
 
-        self.test_print_camera_usefulness_and_evaluation_probability()
+        evaluation_start_time = time.perf_counter()
+        self.__apply_pending_config_updates()
 
         for frame_info in frames_info:
-            # if random number is less than the camera's evaluation probability, the frame will be evaluated  
-            random_number = random.random()
-            if random_number > self.camera_evaluation_probabilities.setdefault(frame_info["camera_uuid"], server_preferences.MINIMUM_EVALUATION_PROBABILITY):
+            # Static scenes are skipped without running the model, unless the camera must be revisited so that nothing is missed indefinitely
+            if frame_info.get("motion_score") is not None and frame_info["motion_score"] < server_preferences.EVALUATION_MOTION_SCORE_THRESHOLD and not self.scheduler.is_camera_overdue(camera_uuid = frame_info["camera_uuid"]):
+                self.frames_skipped_static_counter.increment()
                 continue
-            
-            evaluated_uuids.append(frame_info["frame_uuid"])
-            
-            active_rules = frame_info["active_rules"]            
-            for active_rule in active_rules:
-                if active_rule["rule_name"] == "RESTRICTED_AREA":
-                    evaluation_result, was_usefull_to_evaluate = self.__restricted_area_rule(frame_info = frame_info, active_rule = active_rule)
-                    if len(evaluation_result) > 0: evaluation_results.append(evaluation_result)
-                    self.__update_camera_usefulness(camera_uuid=frame_info["camera_uuid"], was_usefull=was_usefull_to_evaluate)
-                    if server_preferences.EVALUATION_VERBOSE: print(f"Restricted Area Rule is applied: {frame_info['camera_uuid']}, Was useful ?: {was_usefull_to_evaluate}, Usefulness Score: {self.camera_usefulness[frame_info['camera_uuid']]['usefulness_score']}")
-
-        self.__update_camera_evaluation_probabilities()
+            self.scheduler.add_frame(frame_info = frame_info, weight = self.__return_camera_weight(frame_info = frame_info), cost = self.__return_frame_cost(frame_info = frame_info))
+
+        for frame_info in self.scheduler.pop_frames_to_evaluate():
+            for active_rule in frame_info["active_rules"]:
+                if active_rule["yolo_model_to_use"] not in self.yolo_models_to_use: continue # The model of a newly added rule is not loaded yet
+                self.__add_frame_to_pending_batch(yolo_model_to_use = active_rule["yolo_model_to_use"], frame_info = frame_info)
+
+        for yolo_model_to_use in list(self.pending_batches.keys()):
+            if not self.__is_batch_ready(yolo_model_to_use = yolo_model_to_use):
+                continue
+
+            batch_frames_info = list(self.pending_batches.pop(yolo_model_to_use)["frames_info"].values())
+            for batch_start in range(0, len(batch_frames_info), server_preferences.EVALUATION_MAX_BATCH_SIZE):
+                batch_chunk = batch_frames_info[batch_start:batch_start+server_preferences.EVALUATION_MAX_BATCH_SIZE]
+                rois_xyxy = [self.__return_roi_xyxy(frame_info = frame_info, yolo_model_to_use = yolo_model_to_use) for frame_info in batch_chunk] if server_preferences.EVALUATION_ROI_MODE else None
+                inference_start_time = time.time()
+                frame_age_at_inference_histogram = self.__return_frame_age_at_inference_histogram(yolo_model_to_use = yolo_model_to_use)
+                for frame_info in batch_chunk:
+                    frame_age_at_inference_histogram.observe(inference_start_time - frame_info["frame_timestamp"])
+                detections_per_frame = self.model_registry.return_detector(model_name = yolo_model_to_use).predict_frames_and_return_detections(frames_info = batch_chunk, bbox_confidence=0.75, rois_xyxy = rois_xyxy)
+                self.__update_model_inference_duration(yolo_model_to_use = yolo_model_to_use, inference_ms_per_frame = 1000*(time.time() - inference_start_time)/len(batch_chunk))
+
+                for frame_info, detections in zip(batch_chunk, detections_per_frame):
+                    evaluated_uuids.add(frame_info["frame_uuid"])
+                    tracker = self.trackers.setdefault((frame_info["camera_uuid"], yolo_model_to_use), tracker_module.MultiPersonTracker())
+                    detections.track_ids = tracker.update(bboxes_xyxy = detections.bbox_xyxy_px, timestamp = frame_info["frame_timestamp"])
+
+                    for rule_index, active_rule in enumerate(frame_info["active_rules"]):
+                        if active_rule["yolo_model_to_use"] != yolo_model_to_use:
+                            continue
+                        if active_rule["rule_name"] == "RESTRICTED_AREA":
+                            evaluation_result, was_usefull_to_evaluate = self.__restricted_area_rule(frame_info = frame_info, active_rule = active_rule, rule_index = rule_index, detections = detections)
+                            evaluation_result.rule_name = active_rule["rule_name"]
+                            if len(evaluation_result) > 0: evaluation_results.append(evaluation_result)
+                            self.__update_camera_usefulness(camera_uuid=frame_info["camera_uuid"], was_usefull=was_usefull_to_evaluate)
+                            if server_preferences.EVALUATION_VERBOSE: print(f"Restricted Area Rule is applied: {frame_info['camera_uuid']}, Was useful ?: {was_usefull_to_evaluate}, Usefulness Score: {self.camera_usefulness[frame_info['camera_uuid']]['usefulness_score']}")
+
+        self.model_registry.evict_idle_models() # An evicted model is loaded again if a rule uses it later on
+
+        self.evaluation_duration_histogram.observe(time.perf_counter() - evaluation_start_time)
         return evaluated_uuids, evaluation_results      
 
-    def test_print_camera_usefulness_and_evaluation_probability(self):
-        print("")
-        sorted_cameras = sorted(
-            self.camera_usefulness.items(), 
-            key=lambda item: item[1]['usefulness_score'], 
-            reverse=True
-        )
-        for camera_uuid, usefulness in sorted_cameras:
-            print(f"Camera UUID: {camera_uuid:<10}, Usefulness Score: {usefulness['usefulness_score']:<6.2f}, Evaluation Probability: {self.camera_evaluation_probabilities[camera_uuid]:<2}")
+    def return_metrics(self) -> List[tuple]:
+        # Metrics collector, called at scrape time from another thread. The dictionaries are copied first since the evaluation thread may be changing them
+        camera_usefulness = dict(self.camera_usefulness)
+        camera_weights = dict(self.scheduler.camera_weights)
+        total_camera_weight = sum(camera_weights.values())
+        metrics = []
+        for camera_uuid, usefulness in camera_usefulness.items():
+            metrics.append(("safety_ai_evaluation_camera_usefulness_score", "gauge", "Usefulness score of the camera, higher when its recent evaluations found people", {"camera_uuid": camera_uuid}, usefulness["usefulness_score"]))
+        for camera_uuid, camera_weight in camera_weights.items():
+            metrics.append(("safety_ai_evaluation_camera_budget_share", "gauge", "Expected fraction of the inference budget (evaluation probability) of the camera if all cameras had a ready frame", {"camera_uuid": camera_uuid}, camera_weight/total_camera_weight if total_camera_weight > 0 else 0))
+        for yolo_model_to_use, inference_ms_per_frame in dict(self.model_inference_ms_per_frame).items():
+            metrics.append(("safety_ai_evaluation_model_inference_ms_per_frame", "gauge", "Moving average of the inference duration per frame, used as the frame cost in model_time budget mode", {"model": yolo_model_to_use}, inference_ms_per_frame))
+        metrics.append(("safety_ai_evaluation_budget_tokens", "gauge", "Remaining inference budget of the scheduler", {}, self.scheduler.budget_tokens))
+        return metrics
+
+    def update_models(self, yolo_models_to_use:List[str] = None) -> Tuple[List[str], List[str]]:
+        # Loads the models that are newly needed in the calling thread, so that the evaluation is not blocked while loading. Returns (added, removed) model names
+        # The new model set replaces the current one before the next evaluation, the models that are no longer used are released then
+        self.model_registry.validate_model_names(model_names = yolo_models_to_use)
+        current_models = set(self.yolo_models_to_use)
+        for model_name in yolo_models_to_use:
+            if model_name not in current_models: self.model_registry.return_detector(model_name = model_name)
+        self.pending_config_updates.put(("models", set(yolo_models_to_use)))
+        return [model_name for model_name in yolo_models_to_use if model_name not in current_models], [model_name for model_name in current_models if model_name not in yolo_models_to_use]
+
+    def forget_cameras(self, camera_uuids:List[str] = None, is_rule_state_only:bool = False) -> None:
+        # Drops the state of removed or restarted cameras before the next evaluation. The state of the other cameras (e.g. camera_usefulness) is kept
+        # If is_rule_state_only, only the state that depends on the rules of the cameras is dropped (for cameras whose rules changed)
+        self.pending_config_updates.put(("forget_rules" if is_rule_state_only else "forget_cameras", list(camera_uuids)))
+
+    def __apply_pending_config_updates(self) -> None:
+        while not self.pending_config_updates.empty():
+            update_type, update = self.pending_config_updates.get()
+            if update_type == "models":
+                removed_model_names = [model_name for model_name in self.yolo_models_to_use if model_name not in update]
+                self.yolo_models_to_use = update
+                for model_name in removed_model_names:
+                    self.model_registry.unload_model(model_name = model_name)
+                self.__forget_model_state(model_names = removed_model_names)
+            elif update_type == "forget_rules":
+                camera_uuids = set(update)
+                for state in [self.zone_masks, self.camera_rois, self.reported_track_ids]:
+                    for state_key in [state_key for state_key in state if state_key[0] in camera_uuids]:
+                        del state[state_key]
+            elif update_type == "forget_cameras":
+                camera_uuids = set(update)
+                for camera_uuid in camera_uuids:
+                    self.camera_usefulness.pop(camera_uuid, None)
+                    self.scheduler.remove_camera(camera_uuid = camera_uuid)
+                for pending_batch in self.pending_batches.values():
+                    pending_batch["frames_info"] = {frame_uuid: frame_info for frame_uuid, frame_info in pending_batch["frames_info"].items() if frame_info["camera_uuid"] not in camera_uuids}
+                for state in [self.zone_masks, self.camera_rois, self.trackers, self.reported_track_ids]:
+                    for state_key in [state_key for state_key in state if state_key[0] in camera_uuids]:
+                        del state[state_key]
+
+    def __forget_model_state(self, model_names:List[str] = None) -> None:
+        for model_name in model_names:
+            self.pending_batches.pop(model_name, None)
+            self.model_inference_ms_per_frame.pop(model_name, None)
+        for camera_model_key in [camera_model_key for camera_model_key in list(self.trackers.keys()) + list(self.camera_rois.keys()) if camera_model_key[1] in model_names]:
+            self.trackers.pop(camera_model_key, None)
+            self.camera_rois.pop(camera_model_key, None)
+
+    def return_next_wakeup_delay(self) -> float:
+        # Seconds until evaluate_frames_info has something to do even if no new frame arrives. None if nothing is waiting
+        delays = []
+        for pending_batch in self.pending_batches.values():
+            delays.append(max(0, server_preferences.EVALUATION_BATCH_COLLECTION_TIMEOUT_SECONDS - (time.time() - pending_batch["collection_start_time"])))
+        scheduler_delay = self.scheduler.return_next_decision_delay()
+        if scheduler_delay is not None: delays.append(scheduler_delay)
+        return min(delays) if len(delays) > 0 else None
+
+    def return_predicted_tracks(self, camera_uuid:str = None, timestamp:float = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        # Track ids and predicted [x1,y1,x2,y2] boxes of the people seen by the camera, for each yolo model. Bridges the gaps between the evaluations of the camera
+        return {yolo_model_to_use: tracker.predict(timestamp = timestamp) for (tracker_camera_uuid, yolo_model_to_use), tracker in self.trackers.items() if tracker_camera_uuid == camera_uuid}
+
+    def __return_camera_weight(self, frame_info:Dict = None) -> float:
+        camera_uuid = frame_info["camera_uuid"]
+        usefulness_score = self.camera_usefulness[camera_uuid]["usefulness_score"] if camera_uuid in self.camera_usefulness else 0
+        camera_weight = server_preferences.EVALUATION_MINIMUM_CAMERA_WEIGHT + usefulness_score
+        if self.__are_all_tracks_outside_zones(frame_info = frame_info):
+            camera_weight *= server_preferences.TRACKER_OUTSIDE_ZONES_WEIGHT_MULTIPLIER
+        return camera_weight
+
+    def __are_all_tracks_outside_zones(self, frame_info:Dict = None) -> bool:
+        # True if the camera has confirmed tracks and none of their predicted boxes, enlarged by a safety margin, touches a restricted area at the frame time
+        frame_shape = frame_info["frame"].shape
+        frame_height, frame_width = frame_shape[:2]
+        has_tracks = False
+        for rule_index, active_rule in enumerate(frame_info["active_rules"]):
+            tracker = self.trackers.get((frame_info["camera_uuid"], active_rule["yolo_model_to_use"]))
+            if tracker is None or len(tracker) == 0:
+                continue
+            if active_rule.get("rule_polygon") is None or np.any(tracker.number_of_hits < server_preferences.TRACKER_MIN_HITS_TO_CONFIRM):
+                return False
+            has_tracks = True
+
+            _, predicted_boxes = tracker.predict(timestamp = frame_info["frame_timestamp"])
+            margins = (predicted_boxes[:, 2:4] - predicted_boxes[:, 0:2]) * server_preferences.TRACKER_OUTSIDE_ZONES_MARGIN_RATIO
+            x1 = np.clip(predicted_boxes[:, 0] - margins[:, 0], 0, frame_width).astype(np.int32)
+            y1 = np.clip(predicted_boxes[:, 1] - margins[:, 1], 0, frame_height).astype(np.int32)
+            x2 = np.clip(predicted_boxes[:, 2] + margins[:, 0], 0, frame_width).astype(np.int32)
+            y2 = np.clip(predicted_boxes[:, 3] + margins[:, 1], 0, frame_height).astype(np.int32)
+
+            # Number of zone pixels inside each box, from the integral image of the zone mask
+            self.__return_zone_mask(camera_uuid = frame_info["camera_uuid"], rule_index = rule_index, rule_polygon = active_rule["rule_polygon"], frame_shape = frame_shape)
+            mask_integral = self.zone_masks[(frame_info["camera_uuid"], rule_index)]["mask_integral"]
+            zone_pixels_in_boxes = mask_integral[y2, x2] - mask_integral[y1, x2] - mask_integral[y2, x1] + mask_integral[y1, x1]
+            if np.any(zone_pixels_in_boxes > 0):
+                return False
+        return has_tracks
+
+    def __return_frame_cost(self, frame_info:Dict = None) -> float:
+        if server_preferences.EVALUATION_BUDGET_MODE == "frames":
+            return 1
+        yolo_models_to_use = set(active_rule["yolo_model_to_use"] for active_rule in frame_info["active_rules"])
+        return sum(self.model_inference_ms_per_frame.get(yolo_model_to_use, server_preferences.EVALUATION_DEFAULT_INFERENCE_MS_PER_FRAME) for yolo_model_to_use in yolo_models_to_use)
+
+    def __return_frame_age_at_inference_histogram(self, yolo_model_to_use:str = None) -> metrics_module.Histogram:
+        frame_age_at_inference_histogram = self.frame_age_at_inference_histograms.get(yolo_model_to_use)
+        if frame_age_at_inference_histogram is None:
+            frame_age_at_inference_histogram = metrics_module.METRICS.histogram(name = "safety_ai_evaluation_frame_age_at_inference_seconds", help_text = "Age of a frame when its batch is sent to the model, including the scheduling and batching delays", labels = {"model": yolo_model_to_use})
+            self.frame_age_at_inference_histograms[yolo_model_to_use] = frame_age_at_inference_histogram
+        return frame_age_at_inference_histogram
+
+    def __update_model_inference_duration(self, yolo_model_to_use:str = None, inference_ms_per_frame:float = None) -> None:
+        if yolo_model_to_use not in self.model_inference_ms_per_frame:
+            self.model_inference_ms_per_frame[yolo_model_to_use] = inference_ms_per_frame
+        else:
+            self.model_inference_ms_per_frame[yolo_model_to_use] = 0.9*self.model_inference_ms_per_frame[yolo_model_to_use] + 0.1*inference_ms_per_frame
+
+    def __add_frame_to_pending_batch(self, yolo_model_to_use:str = None, frame_info:Dict = None) -> None:
+        if yolo_model_to_use not in self.pending_batches:
+            self.pending_batches[yolo_model_to_use] = {"frames_info": {}, "collection_start_time": time.time()}
+        # A frame is added only once per model even if multiple rules of the camera use the same model
+        self.pending_batches[yolo_model_to_use]["frames_info"][frame_info["frame_uuid"]] = frame_info
+
+    def __is_batch_ready(self, yolo_model_to_use:str = None) -> bool:
+        # A batch is evaluated either when it is full or when the collection timeout is exceeded
+        pending_batch = self.pending_batches[yolo_model_to_use]
+        if len(pending_batch["frames_info"]) >= server_preferences.EVALUATION_MAX_BATCH_SIZE:
+            return True
+        return time.time() - pending_batch["collection_start_time"] >= server_preferences.EVALUATION_BATCH_COLLECTION_TIMEOUT_SECONDS
 
     def __update_camera_usefulness(self, camera_uuid:str, was_usefull:bool) -> None:
         #Update the camera's usefulness score
@@ -73,38 +267,83 @@ class EvaluationManager():
         if self.camera_usefulness[camera_uuid]["usefulness_score"] < server_preferences.MINIMUM_USEFULNESS_SCORE_TO_CONSIDER:
             self.camera_usefulness[camera_uuid]["usefulness_score"] = 0
 
-    def __update_camera_evaluation_probabilities(self) -> None:
-        #Update the camera's evaluation probability
-        different_usefulness = []
-        for _, usefulness in self.camera_usefulness.items():
-            if usefulness["usefulness_score"] not in different_usefulness:
-                different_usefulness.append(usefulness["usefulness_score"])
-
-        number_of_terms = len(different_usefulness)
-        if number_of_terms == 0: return
-        geometric_sum = (1-server_preferences.GEOMETRIC_R**number_of_terms)/(1-server_preferences.GEOMETRIC_R) # assume first term is 1
-        first_term = 1/geometric_sum # Probability of evaluation of the camera(s) with the highest usefulness. Update first term so that sum is 1
-
-        sorted_usefullness = sorted(different_usefulness, reverse=True)
-        for camera_uuid, usefulness in self.camera_usefulness.items():
-            if camera_uuid not in self.camera_evaluation_probabilities:
-                self.camera_evaluation_probabilities[camera_uuid] = server_preferences.MINIMUM_EVALUATION_PROBABILITY
-                       
-            usefulness_index = sorted_usefullness.index(usefulness["usefulness_score"])
-            probability = first_term*server_preferences.GEOMETRIC_R**usefulness_index
-            self.camera_evaluation_probabilities[camera_uuid] = max(probability, server_preferences.MINIMUM_EVALUATION_PROBABILITY)     
-
-    def __restricted_area_rule(self, frame_info:Dict = None, active_rule:Dict = None) -> Dict:
-        yolo_model_to_use = active_rule["yolo_model_to_use"]
-
-        was_usefull_to_evaluate = False
-        evaluation_result = self.DETECTORS[yolo_model_to_use].predict_frame_and_return_detections(frame_info = frame_info, bbox_confidence=0.75)
-        if len(evaluation_result) > 0: was_usefull_to_evaluate = True
+    def __return_zone_mask(self, camera_uuid:str = None, rule_index:int = None, rule_polygon:List[List[float]] = None, frame_shape:Tuple[int,int] = None) -> np.ndarray:
+        # rule_polygon is a list of [x, y] points normalized to the frame size (0.0 to 1.0). Returns a boolean (height, width) mask which is True inside the zone
+        rule_polygon_key = tuple(tuple(point) for point in rule_polygon)
+        frame_shape_key = tuple(frame_shape[:2])
 
-        return evaluation_result, was_usefull_to_evaluate
-    
-    
-    
+        cached_zone_mask = self.zone_masks.get((camera_uuid, rule_index))
+        if cached_zone_mask is not None and cached_zone_mask["rule_polygon"] == rule_polygon_key and cached_zone_mask["frame_shape"] == frame_shape_key:
+            return cached_zone_mask["mask"]
 
+        frame_height, frame_width = frame_shape_key
+        polygon_px = np.round(np.array(rule_polygon, dtype=np.float32) * [frame_width-1, frame_height-1]).astype(np.int32)
+        mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
+        cv2.fillPoly(mask, [polygon_px], 1)
+
+        self.zone_masks[(camera_uuid, rule_index)] = {"rule_polygon": rule_polygon_key, "frame_shape": frame_shape_key, "mask": mask.astype(bool), "mask_integral": cv2.integral(mask)}
+        return self.zone_masks[(camera_uuid, rule_index)]["mask"]
+
+    def __return_roi_xyxy(self, frame_info:Dict = None, yolo_model_to_use:str = None) -> List[int]:
+        # Returns the padded [x1,y1,x2,y2] crop covering the zones of all rules of the camera that use the given model. None means the full frame should be used
+        rule_polygons = []
+        for active_rule in frame_info["active_rules"]:
+            if active_rule["yolo_model_to_use"] != yolo_model_to_use:
+                continue
+            if active_rule.get("rule_polygon") is None: # A rule without a polygon covers the whole frame
+                rule_polygons = None
+                break
+            rule_polygons.append(tuple(tuple(point) for point in active_rule["rule_polygon"]))
+        rule_polygons_key = tuple(rule_polygons) if rule_polygons is not None else None
+        frame_shape_key = tuple(frame_info["frame"].shape[:2])
+
+        cached_roi = self.camera_rois.get((frame_info["camera_uuid"], yolo_model_to_use))
+        if cached_roi is not None and cached_roi["rule_polygons"] == rule_polygons_key and cached_roi["frame_shape"] == frame_shape_key:
+            return cached_roi["roi_xyxy"]
+
+        # Same crop as the one the fetcher threads prepare the model inputs for (see inference_backend_module.return_model_inputs)
+        roi_xyxy = inference_backend_module.return_rules_roi_xyxy(active_rules = frame_info["active_rules"], yolo_model_to_use = yolo_model_to_use, frame_shape = frame_shape_key)
+
+        self.camera_rois[(frame_info["camera_uuid"], yolo_model_to_use)] = {"rule_polygons": rule_polygons_key, "frame_shape": frame_shape_key, "roi_xyxy": roi_xyxy}
+        return roi_xyxy
+
+    def __restricted_area_rule(self, frame_info:Dict = None, active_rule:Dict = None, rule_index:int = None, detections:detectors_module.PoseDetectionsRecord = None) -> Dict:
+        # If the rule does not define a polygon, the whole frame is considered as the restricted area
+        if len(detections) == 0: # A new empty record, the caller sets the rule name on it and the detections are shared by all the rules of the frame
+            return detections.select(np.zeros((0,), dtype=bool)), False
+        if active_rule.get("rule_polygon") is None:
+            is_detection_in_zone = np.ones((len(detections),), dtype=bool)
+            if server_preferences.EVALUATION_REPORT_EACH_PERSON_ONCE and detections.track_ids is not None:
+                is_detection_in_zone &= self.__return_is_track_not_reported(camera_uuid = frame_info["camera_uuid"], rule_index = rule_index, yolo_model_to_use = active_rule["yolo_model_to_use"], track_ids = detections.track_ids, is_violating = is_detection_in_zone)
+            return detections.select(is_detection_in_zone), True
+
+        zone_mask = self.__return_zone_mask(camera_uuid = frame_info["camera_uuid"], rule_index = rule_index, rule_polygon = active_rule["rule_polygon"], frame_shape = frame_info["frame"].shape)
+        frame_height, frame_width = zone_mask.shape
+
+        # (N, P, 2) points to check for each detection: selected keypoints followed by the bbox footpoint
+        keypoint_indexes = [detectors_module.PoseDetector.KEYPOINT_NAMES.index(keypoint_name) for keypoint_name in EvaluationManager.RESTRICTED_AREA_KEYPOINT_NAMES]
+        footpoints = np.stack([(detections.bbox_xyxy_px[:, 0] + detections.bbox_xyxy_px[:, 2]) / 2, detections.bbox_xyxy_px[:, 3]], axis=1)
+        points = np.concatenate([detections.keypoints_xy[:, keypoint_indexes], footpoints[:, np.newaxis]], axis=1)
+        is_point_valid = np.concatenate([detections.keypoints_conf[:, keypoint_indexes] > 0, np.ones((len(detections), 1), dtype=bool)], axis=1) # negative confidence means the keypoint is not detected
+
+        points_x = np.clip(points[..., 0].astype(np.int32), 0, frame_width-1)
+        points_y = np.clip(points[..., 1].astype(np.int32), 0, frame_height-1)
+        is_detection_in_zone = np.any(zone_mask[points_y, points_x] & is_point_valid, axis=1)
+
+        was_usefull_to_evaluate = bool(np.any(is_detection_in_zone))
+        if server_preferences.EVALUATION_REPORT_EACH_PERSON_ONCE and detections.track_ids is not None:
+            is_detection_in_zone &= self.__return_is_track_not_reported(camera_uuid = frame_info["camera_uuid"], rule_index = rule_index, yolo_model_to_use = active_rule["yolo_model_to_use"], track_ids = detections.track_ids, is_violating = is_detection_in_zone)
+
+        evaluation_result = detections.select(is_detection_in_zone)
+        return evaluation_result, was_usefull_to_evaluate
 
+    def __return_is_track_not_reported(self, camera_uuid:str = None, rule_index:int = None, yolo_model_to_use:str = None, track_ids:np.ndarray = None, is_violating:np.ndarray = None) -> np.ndarray:
+        # A person is reported once while it is tracked. Ids of the tracks that are dropped by the tracker are forgotten, so a person leaving and coming back is reported again
+        # Each model of a camera has its own tracker numbering its tracks from 0, so the ids are only compared together with the model that tracked them
+        reported_track_ids = self.reported_track_ids.setdefault((camera_uuid, rule_index), set())
+        live_track_ids = set((tracker_key[1], int(track_id)) for tracker_key, tracker in self.trackers.items() if tracker_key[0] == camera_uuid for track_id in tracker.track_ids)
+        reported_track_ids.intersection_update(live_track_ids)
 
+        is_not_reported = np.array([(yolo_model_to_use, int(track_id)) not in reported_track_ids for track_id in track_ids], dtype=bool)
+        reported_track_ids.update((yolo_model_to_use, int(track_id)) for track_id in track_ids[is_violating])
+        return is_not_reported
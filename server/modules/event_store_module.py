@@ -0,0 +1,141 @@
+import sqlite3, threading, queue, time, platform
+from pathlib import Path
+from typing import List, Dict
+import numpy as np
+
+import server_preferences
+
+EVENT_STORE_MODULE_PATH = Path(__file__).resolve()
+if platform.system() == "Linux":
+    DEFAULT_EVENT_DATABASE_PATH = EVENT_STORE_MODULE_PATH.parent.parent.parent.parent / "safety_AI_volume" / "violation_events.db"
+else:
+    DEFAULT_EVENT_DATABASE_PATH = EVENT_STORE_MODULE_PATH.parent.parent / "configs" / "violation_events.db"
+
+class ViolationEventStore:
+    # Persists the violations of the evaluation results to SQLite, one row per violating detection
+    # - Rows are compact: box and keypoints are packed as float32/float16 blobs, frames are never stored
+    # - Writes are queued and committed in batches by a background writer thread, so the caller never waits for the disk
+    # - The database runs in WAL mode so that queries do not block the writer
+    __STOP_SIGNAL = object()
+
+    def __init__(self, database_path:str = None) -> None:
+        self.database_path = str(database_path if database_path is not None else DEFAULT_EVENT_DATABASE_PATH)
+        self.event_queue = queue.Queue(maxsize=server_preferences.EVENT_STORE_QUEUE_SIZE)
+        self.number_of_events_written = 0
+        self.number_of_events_dropped = 0
+
+        self.read_connection = self.__open_connection()
+        self.read_lock = threading.Lock()
+        self.__create_schema(self.read_connection)
+
+        self.writer_thread = threading.Thread(target=self.__writer_thread)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def add_evaluation_result(self, evaluation_result = None) -> None:
+        # Can be used as a result sink of the EvaluationPipeline. Never blocks: if the writer can not keep up, the events are dropped and counted
+        track_ids = evaluation_result.track_ids if evaluation_result.track_ids is not None else [None]*len(evaluation_result)
+        for detection_index in range(len(evaluation_result)):
+            keypoints = np.concatenate([evaluation_result.keypoints_xy[detection_index], evaluation_result.keypoints_conf[detection_index][:, np.newaxis]], axis=1) # (17,3) [x,y,confidence]
+            event_row = (
+                evaluation_result.frame_timestamp,
+                evaluation_result.camera_uuid,
+                evaluation_result.rule_name,
+                evaluation_result.frame_uuid,
+                int(track_ids[detection_index]) if track_ids[detection_index] is not None else None,
+                float(evaluation_result.bbox_confidences[detection_index]),
+                evaluation_result.bbox_xyxy_px[detection_index].astype(np.float32).tobytes(),
+                keypoints.astype(np.float32).tobytes(), # float32 keeps the sub-pixel keypoint coordinates (float16 rounds them to 0.25 px above 256 and to 0.5 px above 512)
+            )
+            try:
+                self.event_queue.put_nowait(event_row)
+            except queue.Full:
+                self.number_of_events_dropped += 1
+                if server_preferences.EVENT_STORE_VERBOSE: print(f"Event store queue is full, a violation event of {evaluation_result.camera_uuid} is dropped")
+
+    def query_events(self, start_timestamp:float = None, end_timestamp:float = None, camera_uuid:str = None, rule_name:str = None, limit:int = 1000) -> List[Dict]:
+        # Returns the most recent events first. All filters are optional and served by the indexes
+        conditions, parameters = [], []
+        if start_timestamp is not None: conditions.append("frame_timestamp >= ?"); parameters.append(start_timestamp)
+        if end_timestamp is not None: conditions.append("frame_timestamp < ?"); parameters.append(end_timestamp)
+        if camera_uuid is not None: conditions.append("camera_uuid = ?"); parameters.append(camera_uuid)
+        if rule_name is not None: conditions.append("rule_name = ?"); parameters.append(rule_name)
+        where_clause = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+
+        with self.read_lock:
+            rows = self.read_connection.execute(f"SELECT event_id, frame_timestamp, camera_uuid, rule_name, frame_uuid, track_id, bbox_confidence, bbox_xyxy, keypoints FROM violation_events {where_clause} ORDER BY frame_timestamp DESC LIMIT ?", (*parameters, limit)).fetchall()
+        return [self.__return_event_dict(row) for row in rows]
+
+    def close(self) -> None:
+        # Writes the queued events before returning
+        self.event_queue.put(ViolationEventStore.__STOP_SIGNAL)
+        self.writer_thread.join()
+        with self.read_lock:
+            self.read_connection.close()
+
+    def __open_connection(self) -> sqlite3.Connection:
+        Path(self.database_path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL") # With WAL, a power loss may only lose the last batches, the database is never corrupted
+        return connection
+
+    def __create_schema(self, connection:sqlite3.Connection = None) -> None:
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS violation_events (
+                event_id INTEGER PRIMARY KEY,
+                frame_timestamp REAL NOT NULL,
+                camera_uuid TEXT NOT NULL,
+                rule_name TEXT,
+                frame_uuid TEXT NOT NULL,
+                track_id INTEGER,
+                bbox_confidence REAL,
+                bbox_xyxy BLOB,
+                keypoints BLOB
+            )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS violation_events_by_timestamp ON violation_events (frame_timestamp)")
+            connection.execute("CREATE INDEX IF NOT EXISTS violation_events_by_camera ON violation_events (camera_uuid, frame_timestamp)")
+            connection.execute("CREATE INDEX IF NOT EXISTS violation_events_by_rule ON violation_events (rule_name, frame_timestamp)")
+
+    def __writer_thread(self) -> None:
+        write_connection = self.__open_connection()
+        is_stopping = False
+        while not is_stopping:
+            # Wait for the first event, then collect the others until the batch is full or the batch timeout is exceeded
+            event_rows = [self.event_queue.get()]
+            batch_deadline = time.time() + server_preferences.EVENT_STORE_BATCH_TIMEOUT_SECONDS
+            while len(event_rows) < server_preferences.EVENT_STORE_MAX_BATCH_SIZE:
+                try:
+                    event_rows.append(self.event_queue.get(timeout=max(0, batch_deadline - time.time())))
+                except queue.Empty:
+                    break
+            is_stopping = any(event_row is ViolationEventStore.__STOP_SIGNAL for event_row in event_rows)
+            event_rows = [event_row for event_row in event_rows if event_row is not ViolationEventStore.__STOP_SIGNAL]
+            if len(event_rows) == 0: continue
+
+            try:
+                with write_connection:
+                    write_connection.executemany("INSERT INTO violation_events (frame_timestamp, camera_uuid, rule_name, frame_uuid, track_id, bbox_confidence, bbox_xyxy, keypoints) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", event_rows)
+                self.number_of_events_written += len(event_rows)
+            except sqlite3.Error as e:
+                self.number_of_events_dropped += len(event_rows)
+                if server_preferences.EVENT_STORE_VERBOSE: print(f"Error while writing {len(event_rows)} violation events: {e}")
+        write_connection.close()
+
+    def __return_keypoints_dtype(self, keypoints:bytes = None) -> type:
+        # Events written before the keypoints were stored as float32 hold 17x3 float16 values
+        return np.float16 if len(keypoints) == 17*3*np.dtype(np.float16).itemsize else np.float32
+
+    def __return_event_dict(self, row:tuple = None) -> Dict:
+        event_id, frame_timestamp, camera_uuid, rule_name, frame_uuid, track_id, bbox_confidence, bbox_xyxy, keypoints = row
+        return {
+            "event_id": event_id,
+            "frame_timestamp": frame_timestamp,
+            "camera_uuid": camera_uuid,
+            "rule_name": rule_name,
+            "frame_uuid": frame_uuid,
+            "track_id": track_id,
+            "bbox_confidence": bbox_confidence,
+            "bbox_xyxy_px": np.frombuffer(bbox_xyxy, dtype=np.float32).tolist(),
+            "keypoints": np.frombuffer(keypoints, dtype=self.__return_keypoints_dtype(keypoints = keypoints)).astype(np.float32).reshape(-1, 3).tolist(), # [x,y,confidence] in PoseDetector.KEYPOINT_NAMES order
+        }
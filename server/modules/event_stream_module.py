@@ -0,0 +1,102 @@
+import asyncio, threading, collections, json
+from typing import List, Dict
+
+import server_preferences
+
+class EventSubscriber:
+    # A single streaming client. Events are kept in a bounded deque: when the client is too slow, the oldest events are dropped
+    def __init__(self, loop:asyncio.AbstractEventLoop = None, camera_uuids:List[str] = None, camera_regions:List[str] = None, queue_size:int = None) -> None:
+        self.loop = loop # Event loop of the connection, the publisher wakes the subscriber up through it
+        self.camera_uuids = set(camera_uuids) if camera_uuids else None # None means all cameras
+        self.camera_regions = set(camera_regions) if camera_regions else None # None means all regions
+        self.events = collections.deque(maxlen=queue_size if queue_size is not None else server_preferences.EVENT_STREAM_SUBSCRIBER_QUEUE_SIZE)
+        self.events_lock = threading.Lock()
+        self.wakeup_event = asyncio.Event()
+        self.is_wakeup_scheduled = False
+        self.number_of_events_dropped = 0
+
+    def is_interested(self, camera_uuid:str = None, camera_region:str = None) -> bool:
+        if self.camera_uuids is not None and camera_uuid not in self.camera_uuids: return False
+        if self.camera_regions is not None and camera_region not in self.camera_regions: return False
+        return True
+
+    def push(self, event_json:str = None) -> None:
+        # Called from the publisher thread, never blocks
+        with self.events_lock:
+            if len(self.events) == self.events.maxlen:
+                self.number_of_events_dropped += 1
+            self.events.append(event_json)
+            if self.is_wakeup_scheduled: return
+            self.is_wakeup_scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup_event.set)
+        except RuntimeError: # The event loop of the connection is already closed
+            pass
+
+    async def get_events(self, timeout:float = None) -> List[str]:
+        # Waits until at least one event is available or the timeout expires. Returns all the queued events
+        try:
+            await asyncio.wait_for(self.wakeup_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self.events_lock:
+            self.wakeup_event.clear()
+            self.is_wakeup_scheduled = False
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+class EventBroadcaster:
+    # Fans out the evaluation results of the pipeline to the streaming clients of the API
+    # Each result is serialized once, then appended to the queue of every interested subscriber
+    def __init__(self, camera_regions:Dict[str, str] = None) -> None:
+        self.camera_regions = dict(camera_regions) if camera_regions is not None else {} # camera_uuid -> camera_region
+        self.subscribers:List[EventSubscriber] = []
+        self.subscribers_lock = threading.Lock()
+        self.number_of_events_published = 0
+
+    def set_camera_regions(self, camera_regions:Dict[str, str] = None) -> None:
+        self.camera_regions = dict(camera_regions)
+
+    def subscribe(self, camera_uuids:List[str] = None, camera_regions:List[str] = None) -> EventSubscriber:
+        # Must be called from the event loop of the connection
+        subscriber = EventSubscriber(loop = asyncio.get_running_loop(), camera_uuids = camera_uuids, camera_regions = camera_regions)
+        with self.subscribers_lock:
+            self.subscribers = self.subscribers + [subscriber] # Copy on write, so that publishing iterates over a snapshot without holding the lock
+        return subscriber
+
+    def unsubscribe(self, subscriber:EventSubscriber = None) -> None:
+        with self.subscribers_lock:
+            self.subscribers = [other_subscriber for other_subscriber in self.subscribers if other_subscriber is not subscriber]
+
+    def publish_evaluation_result(self, evaluation_result = None) -> None:
+        # Can be used as a result sink of the EvaluationPipeline
+        subscribers = self.subscribers
+        if len(subscribers) == 0: return
+
+        camera_region = self.camera_regions.get(evaluation_result.camera_uuid)
+        interested_subscribers = [subscriber for subscriber in subscribers if subscriber.is_interested(camera_uuid = evaluation_result.camera_uuid, camera_region = camera_region)]
+        if len(interested_subscribers) == 0: return
+
+        event_json = json.dumps(self.__return_event_dict(evaluation_result = evaluation_result, camera_region = camera_region))
+        for subscriber in interested_subscribers:
+            subscriber.push(event_json = event_json)
+        self.number_of_events_published += 1
+
+    def __return_event_dict(self, evaluation_result = None, camera_region:str = None) -> Dict:
+        return {
+            "camera_uuid": evaluation_result.camera_uuid,
+            "camera_region": camera_region,
+            "rule_name": evaluation_result.rule_name,
+            "frame_uuid": evaluation_result.frame_uuid,
+            "frame_timestamp": evaluation_result.frame_timestamp,
+            "frame_shape": list(evaluation_result.frame_shape),
+            "detections": [
+                {
+                    "track_id": int(evaluation_result.track_ids[detection_index]) if evaluation_result.track_ids is not None else None,
+                    "bbox_confidence": round(float(evaluation_result.bbox_confidences[detection_index]), 3),
+                    "bbox_xyxy_px": [round(float(coordinate), 1) for coordinate in evaluation_result.bbox_xyxy_px[detection_index]],
+                }
+                for detection_index in range(len(evaluation_result))
+            ],
+        }
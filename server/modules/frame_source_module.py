@@ -0,0 +1,131 @@
+import time, random, math
+from typing import Dict, List, Tuple
+import numpy as np
+import cv2
+
+import server_preferences
+
+class SyntheticFrameSource:
+    # Drop-in replacement of cv2.VideoCapture for the CameraStreamFetcher (isOpened, set, grab, retrieve, read, release), used to run the system without real cameras
+    # - Replays a local video file in a loop, or generates frames with a configurable number of simulated people walking around
+    # - grab() blocks until the next frame is due, so that the source behaves like a live stream at the given fps. Frames that are not grabbed in time are skipped
+    def __init__(self, fps:float = None, frame_size:Tuple[int,int] = None, number_of_people:int = None, video_path:str = None, seed:int = None) -> None:
+        self.fps = fps if fps is not None else server_preferences.SYNTHETIC_DEFAULT_FPS
+        self.frame_size = tuple(frame_size) if frame_size is not None else tuple(server_preferences.SYNTHETIC_DEFAULT_FRAME_SIZE) # (width, height)
+        self.number_of_people = number_of_people if number_of_people is not None else server_preferences.SYNTHETIC_DEFAULT_NUMBER_OF_PEOPLE # Can be changed while the source is running
+        self.video_path = video_path
+        self.random_generator = random.Random(seed)
+
+        self.video_capture = None
+        if self.video_path is not None:
+            self.video_capture = cv2.VideoCapture(self.video_path)
+        else:
+            self.background = self.__create_background()
+            self.people:List[Dict] = []
+
+        self.is_opened = self.video_capture is None or self.video_capture.isOpened()
+        self.next_frame_time = time.time()
+        self.last_grab_time = None
+        self.number_of_frames_grabbed = 0
+        self.number_of_frames_skipped = 0 # Frames that were due while nobody was grabbing, as a live stream would drop them
+
+    def isOpened(self) -> bool:
+        return self.is_opened
+
+    def set(self, property_id:int = None, value:float = None) -> bool:
+        return False # Capture properties (e.g. the buffer size) do not apply
+
+    def grab(self) -> bool:
+        if not self.is_opened: return False
+        waiting_seconds = self.next_frame_time - time.time()
+        if waiting_seconds > 0:
+            time.sleep(waiting_seconds)
+        elif -waiting_seconds > 1/self.fps: # More than one frame behind, continue from now on instead of bursting the missed frames
+            self.number_of_frames_skipped += int(-waiting_seconds*self.fps)
+            self.next_frame_time = time.time()
+        self.next_frame_time += 1/self.fps
+
+        if self.video_capture is not None and not self.video_capture.grab():
+            self.video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0) # Loop the video
+            if not self.video_capture.grab(): return False
+
+        now = time.time()
+        if self.video_capture is None: self.__move_people(elapsed_seconds = now - self.last_grab_time if self.last_grab_time is not None else 0)
+        self.last_grab_time = now
+        self.number_of_frames_grabbed += 1
+        return True
+
+    def retrieve(self) -> Tuple[bool, np.ndarray]:
+        if not self.is_opened or self.last_grab_time is None: return False, None
+        if self.video_capture is not None:
+            ret, frame = self.video_capture.retrieve()
+            if ret and (frame.shape[1], frame.shape[0]) != self.frame_size and server_preferences.SYNTHETIC_RESIZE_VIDEO_FRAMES:
+                frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+            return ret, frame
+        return True, self.__draw_people()
+
+    def read(self) -> Tuple[bool, np.ndarray]:
+        if not self.grab(): return False, None
+        return self.retrieve()
+
+    def release(self) -> None:
+        if self.video_capture is not None: self.video_capture.release()
+        self.is_opened = False
+
+    def __create_background(self) -> np.ndarray:
+        # Static gray gradient with some noise, so that the JPEG encoding and the motion score do not work on a flat image
+        frame_width, frame_height = self.frame_size
+        gradient = np.linspace(60, 160, frame_height, dtype=np.float32)[:, np.newaxis].repeat(frame_width, axis=1)
+        noise = np.random.default_rng(self.random_generator.randrange(2**32)).normal(0, 8, (frame_height, frame_width)).astype(np.float32)
+        return np.clip(gradient + noise, 0, 255).astype(np.uint8)[..., np.newaxis].repeat(3, axis=2)
+
+    def __move_people(self, elapsed_seconds:float = None) -> None:
+        # People walk in straight lines at a random speed and turn back at the frame borders. Positions are normalized to the frame size
+        while len(self.people) < self.number_of_people:
+            direction = self.random_generator.uniform(0, 2*math.pi)
+            speed = self.random_generator.uniform(*server_preferences.SYNTHETIC_PERSON_SPEED_RANGE)
+            self.people.append({"x": self.random_generator.uniform(0.1, 0.9), "y": self.random_generator.uniform(0.2, 0.9), "vx": speed*math.cos(direction), "vy": speed*math.sin(direction), "color": tuple(self.random_generator.randrange(256) for _ in range(3))})
+        del self.people[self.number_of_people:]
+
+        for person in self.people:
+            person["x"] += person["vx"]*elapsed_seconds
+            person["y"] += person["vy"]*elapsed_seconds
+            if not 0.05 <= person["x"] <= 0.95: person["vx"] = -person["vx"]
+            if not 0.2 <= person["y"] <= 0.95: person["vy"] = -person["vy"]
+            person["x"], person["y"] = min(0.95, max(0.05, person["x"])), min(0.95, max(0.2, person["y"]))
+
+    def __draw_people(self) -> np.ndarray:
+        # Stick figures standing on their (x, y) footpoint, farther people (smaller y) are drawn smaller and first
+        frame = self.background.copy()
+        frame_width, frame_height = self.frame_size
+        for person in sorted(self.people, key=lambda person: person["y"]):
+            height = int(frame_height*server_preferences.SYNTHETIC_PERSON_HEIGHT_RATIO*(0.5 + 0.5*person["y"]))
+            thickness = max(2, height//12)
+            foot_x, foot_y = int(person["x"]*frame_width), int(person["y"]*frame_height)
+            hip_y, shoulder_y, head_radius = foot_y - height*45//100, foot_y - height*75//100, height//10
+            cv2.line(frame, (foot_x - height//8, foot_y), (foot_x, hip_y), person["color"], thickness)
+            cv2.line(frame, (foot_x + height//8, foot_y), (foot_x, hip_y), person["color"], thickness)
+            cv2.line(frame, (foot_x, hip_y), (foot_x, shoulder_y), person["color"], thickness*2)
+            cv2.line(frame, (foot_x - height//6, hip_y), (foot_x, shoulder_y), person["color"], thickness)
+            cv2.line(frame, (foot_x + height//6, hip_y), (foot_x, shoulder_y), person["color"], thickness)
+            cv2.circle(frame, (foot_x, shoulder_y - head_radius), head_radius, person["color"], -1)
+        return frame
+
+def return_synthetic_camera_configs(number_of_cameras:int = None, fps:float = None, frame_size:Tuple[int,int] = None, number_of_people:int = None, video_path:str = None, yolo_model_to_use:str = None, rule_polygon:List[List[float]] = None) -> List[Dict]:
+    # Camera configs in the static database format whose frames come from SyntheticFrameSources (see CameraStreamFetcher frame_source)
+    camera_configs = []
+    for camera_index in range(number_of_cameras):
+        camera_configs.append({
+            "camera_uuid": f"synthetic-camera-{camera_index}",
+            "camera_region": "synthetic",
+            "camera_description": f"Synthetic camera {camera_index}",
+            "is_alive": True,
+            "NVR_ip": "synthetic",
+            "camera_ip_address": f"synthetic-{camera_index}",
+            "username": "",
+            "password": "",
+            "stream_path": "",
+            "frame_source": {"fps": fps, "frame_size": list(frame_size) if frame_size is not None else None, "number_of_people": number_of_people, "video_path": video_path, "seed": camera_index},
+            "active_rules": [{"rule_name": "RESTRICTED_AREA", "yolo_model_to_use": yolo_model_to_use, "rule_polygon": rule_polygon}],
+        })
+    return camera_configs
@@ -0,0 +1,187 @@
+import os, time, math, glob
+from pathlib import Path
+from typing import List, Dict, Tuple
+import numpy as np
+import cv2
+
+import frame_source_module
+import server_preferences
+
+def return_onnx_model_path(pt_model_path:str = None, image_size:int = None, is_static_shape:bool = False, is_int8:bool = False) -> str:
+    # Exports the PyTorch weights to ONNX once and caches the result next to the weights. The int8 variant is quantized from the float32 export with calibration frames
+    # Cache file names contain the export settings, delete the cache folder to export again (e.g. after the .pt weights are replaced)
+    pt_model_path = Path(pt_model_path)
+    cache_directory = pt_model_path.parent / "onnx_cache"
+    shape_name = f"static{image_size}" if is_static_shape else f"dynamic{image_size}"
+    onnx_model_path = cache_directory / f"{pt_model_path.stem}_{shape_name}.onnx"
+    int8_model_path = cache_directory / f"{pt_model_path.stem}_{shape_name}_int8_qdq.onnx"
+
+    if not onnx_model_path.exists():
+        from ultralytics import YOLO
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        exported_model_path = YOLO(str(pt_model_path)).export(format="onnx", imgsz=image_size, dynamic=not is_static_shape, simplify=True)
+        os.replace(exported_model_path, onnx_model_path)
+        if server_preferences.INFERENCE_VERBOSE: print(f"{pt_model_path.name} is exported to {onnx_model_path}")
+
+    if not is_int8: return str(onnx_model_path)
+
+    if not int8_model_path.exists():
+        quantize_onnx_model_to_int8(onnx_model_path = str(onnx_model_path), int8_model_path = str(int8_model_path), image_size = image_size)
+        if server_preferences.INFERENCE_VERBOSE: print(f"{onnx_model_path.name} is quantized to {int8_model_path}")
+    return str(int8_model_path)
+
+def quantize_onnx_model_to_int8(onnx_model_path:str = None, int8_model_path:str = None, image_size:int = None) -> None:
+    # Static QDQ quantization: the pose models are almost only convolutions, which dynamic quantization leaves in float (it mostly targets MatMul/Gemm)
+    # The activation ranges are calibrated on real looking frames, and the output head is kept in float since its single output tensor mixes pixel coordinates and scores, which one int8 scale can not represent both
+    # Check the accuracy of the result with ModelRegistry.compare_backend_to_pytorch before enabling an int8 backend
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import quantize_static, CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType
+
+    input_name = onnxruntime.InferenceSession(onnx_model_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    class PoseCalibrationDataReader(CalibrationDataReader):
+        def __init__(self) -> None:
+            self.input_batches = iter([{input_name: return_input_batch(model_inputs = [return_model_input(frame = frame, image_size = image_size)])} for frame in return_calibration_frames()])
+
+        def get_next(self) -> Dict:
+            return next(self.input_batches, None)
+
+    quantize_static(onnx_model_path, int8_model_path, PoseCalibrationDataReader(), quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True, calibrate_method=CalibrationMethod.MinMax, nodes_to_exclude=return_output_head_node_names(onnx_model = onnx.load(onnx_model_path)))
+
+def return_output_head_node_names(onnx_model = None) -> List[str]:
+    # Nodes of the last module of an exported ultralytics model (e.g. "/model.22/..." for yolov8 pose), which decodes the boxes and the keypoints
+    module_indexes = [int(node.name.split("/")[1].split(".")[1]) for node in onnx_model.graph.node if node.name.startswith("/model.") and len(node.name.split("/")) > 2]
+    if len(module_indexes) == 0: return []
+    head_prefix = f"/model.{max(module_indexes)}/"
+    return [node.name for node in onnx_model.graph.node if node.name.startswith(head_prefix)]
+
+def return_calibration_frames() -> List[np.ndarray]:
+    # Frames saved from the cameras represent the deployment best (INFERENCE_INT8_CALIBRATION_FRAMES_DIRECTORY), synthetic frames with people are used otherwise
+    number_of_frames = server_preferences.INFERENCE_INT8_CALIBRATION_NUMBER_OF_FRAMES
+    frames = []
+    if server_preferences.INFERENCE_INT8_CALIBRATION_FRAMES_DIRECTORY is not None:
+        frames_directory = str(server_preferences.INFERENCE_INT8_CALIBRATION_FRAMES_DIRECTORY)
+        for image_path in sorted(glob.glob(os.path.join(frames_directory, "*.jpg")) + glob.glob(os.path.join(frames_directory, "*.png")))[:number_of_frames]:
+            frame = cv2.imread(image_path)
+            if frame is not None: frames.append(frame)
+    if len(frames) > 0: return frames
+
+    for seed in range(number_of_frames): # Each seed is another scene, a high fps so that reading a frame does not wait
+        frame_source = frame_source_module.SyntheticFrameSource(fps = 1000, seed = seed)
+        is_read, frame = frame_source.read()
+        frame_source.release()
+        if is_read: frames.append(frame)
+    return frames
+
+def letterbox_frame(frame:np.ndarray = None, image_size:int = None) -> Tuple[np.ndarray, Tuple[float, int, int]]:
+    # Resizes the frame to fit in a square image keeping the aspect ratio, the rest is padded with gray like ultralytics does. Returns the image and (scale, pad_x, pad_y)
+    frame_height, frame_width = frame.shape[:2]
+    scale = min(image_size / frame_height, image_size / frame_width)
+    resized_width, resized_height = max(1, round(frame_width*scale)), max(1, round(frame_height*scale))
+    pad_x, pad_y = (image_size - resized_width) // 2, (image_size - resized_height) // 2
+
+    letterboxed_frame = np.full((image_size, image_size, 3), 114, dtype=np.uint8)
+    cv2.resize(frame, (resized_width, resized_height), dst=letterboxed_frame[pad_y:pad_y+resized_height, pad_x:pad_x+resized_width], interpolation=cv2.INTER_LINEAR)
+    return letterboxed_frame, (scale, pad_x, pad_y)
+
+def return_model_input(frame:np.ndarray = None, image_size:int = None) -> Tuple[np.ndarray, Tuple[float, int, int]]:
+    # The letterboxed BGR uint8 frame and (scale, pad_x, pad_y). It is kept as uint8 (1.2 MB at 640x640 instead of 4.9 MB as float32) until return_input_batch normalizes the batch
+    return letterbox_frame(frame = frame, image_size = image_size)
+
+def return_input_batch(model_inputs:List[Tuple] = None) -> np.ndarray:
+    # (N, 3, image_size, image_size) RGB float32 batch in [0, 1] of the pose models, from the model inputs returned by return_model_input
+    return cv2.dnn.blobFromImages([model_input[0] for model_input in model_inputs], scalefactor=1/255.0, swapRB=True)
+
+def undo_letterbox(boxes_xyxy:np.ndarray = None, keypoints_xy:np.ndarray = None, letterbox_transform:Tuple[float, int, int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Maps (N,4) boxes and (N,K,2) keypoints from the model input back to the frame. Missing keypoints are kept at (0,0)
+    scale, pad_x, pad_y = letterbox_transform
+    offset = np.array([pad_x, pad_y], dtype=np.float32)
+    boxes_xyxy = ((boxes_xyxy.reshape(-1, 2, 2) - offset) / scale).reshape(-1, 4).astype(np.float32)
+    is_keypoint_missing = np.all(keypoints_xy == 0, axis=-1, keepdims=True)
+    keypoints_xy = np.where(is_keypoint_missing, 0, (keypoints_xy - offset) / scale).astype(np.float32)
+    return boxes_xyxy, keypoints_xy
+
+def return_rules_roi_xyxy(active_rules:List[Dict] = None, yolo_model_to_use:str = None, frame_shape:Tuple[int, int] = None) -> List[int]:
+    # Padded [x1,y1,x2,y2] crop covering the zones of the rules that use the given model. None means the full frame should be used
+    # Shared by the evaluation (which crops the frames) and the fetcher threads (which prepare the model inputs of the crops in advance)
+    rule_polygons = []
+    for active_rule in active_rules:
+        if active_rule["yolo_model_to_use"] != yolo_model_to_use:
+            continue
+        if active_rule.get("rule_polygon") is None: # A rule without a polygon covers the whole frame
+            return None
+        rule_polygons.append(active_rule["rule_polygon"])
+    if len(rule_polygons) == 0: return None
+
+    frame_height, frame_width = frame_shape[:2]
+    points = np.concatenate([np.array(rule_polygon, dtype=np.float32) for rule_polygon in rule_polygons], axis=0) * [frame_width-1, frame_height-1] # Same pixel convention as the zone masks
+    (x1, y1), (x2, y2) = points.min(axis=0), points.max(axis=0)
+    padding_x = (x2-x1)*server_preferences.EVALUATION_ROI_PADDING_RATIO
+    padding_y = (y2-y1)*server_preferences.EVALUATION_ROI_PADDING_RATIO
+    roi_xyxy = [max(0, int(x1-padding_x)), max(0, int(y1-padding_y)), min(frame_width, int(math.ceil(x2+padding_x))+1), min(frame_height, int(math.ceil(y2+padding_y))+1)] # x2 and y2 are exclusive
+    if roi_xyxy[2] - roi_xyxy[0] < 2 or roi_xyxy[3] - roi_xyxy[1] < 2: return None # Degenerate zone, fall back to the full frame
+    return roi_xyxy
+
+def return_model_inputs(frame_info:Dict = None, image_size:int = None) -> Dict:
+    # Model inputs of all the crops the evaluation will run on for this frame: tuple(roi_xyxy) or None (full frame) -> (letterboxed frame, letterbox transform)
+    model_inputs = {}
+    for yolo_model_to_use in set(active_rule["yolo_model_to_use"] for active_rule in frame_info["active_rules"]):
+        roi_xyxy = return_rules_roi_xyxy(active_rules = frame_info["active_rules"], yolo_model_to_use = yolo_model_to_use, frame_shape = frame_info["frame"].shape) if server_preferences.EVALUATION_ROI_MODE else None
+        roi_key = tuple(roi_xyxy) if roi_xyxy is not None else None
+        if roi_key in model_inputs: continue
+        frame = frame_info["frame"] if roi_xyxy is None else frame_info["frame"][roi_xyxy[1]:roi_xyxy[3], roi_xyxy[0]:roi_xyxy[2]]
+        model_inputs[roi_key] = return_model_input(frame = frame, image_size = image_size)
+    return model_inputs
+
+def decode_pose_output(output:np.ndarray = None, letterbox_transform:Tuple[float, int, int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # output: (4 + 1 + 17*3, number_of_anchors) -> [cx, cy, w, h, person_score, (x, y, confidence) of each keypoint]
+    predictions = output.T
+    scores = predictions[:, 4]
+    predictions = predictions[scores >= server_preferences.INFERENCE_MIN_CONFIDENCE]
+    scores = predictions[:, 4]
+
+    boxes_xywh = np.stack([predictions[:, 0] - predictions[:, 2]/2, predictions[:, 1] - predictions[:, 3]/2, predictions[:, 2], predictions[:, 3]], axis=1)
+    kept_indexes = np.array(cv2.dnn.NMSBoxes(boxes_xywh.tolist(), scores.tolist(), server_preferences.INFERENCE_MIN_CONFIDENCE, server_preferences.INFERENCE_NMS_IOU_THRESHOLD), dtype=np.int64).reshape(-1)
+    predictions, boxes_xywh, scores = predictions[kept_indexes], boxes_xywh[kept_indexes], scores[kept_indexes]
+
+    keypoints = predictions[:, 5:].reshape(len(predictions), (output.shape[0] - 5) // 3, 3) # The keypoint count comes from the output rows, -1 can not be inferred when no prediction is kept (e.g. the warmup on a blank frame)
+    keypoints_xy = keypoints[..., 0:2].astype(np.float32)
+    keypoints_conf = keypoints[..., 2].astype(np.float32)
+    keypoints_xy[keypoints_conf < 0.5] = 0 # ultralytics reports the keypoints with a confidence below 0.5 at (0,0)
+    boxes_xyxy, keypoints_xy = undo_letterbox(boxes_xyxy = np.concatenate([boxes_xywh[:, 0:2], boxes_xywh[:, 0:2] + boxes_xywh[:, 2:4]], axis=1), keypoints_xy = keypoints_xy, letterbox_transform = letterbox_transform)
+
+    return np.zeros((len(predictions),), dtype=np.int32), scores.astype(np.float32), boxes_xyxy, keypoints_xy, keypoints_conf
+
+class ONNXPoseBackend:
+    # Runs an exported YOLOv8 pose model with ONNX Runtime on the CPU (or on OpenVINO if its execution provider is installed and configured)
+    # Letterboxing, confidence filtering, NMS and keypoint decoding are done here, and the outputs have the same format as the ultralytics results
+    CLASS_NAMES = {0: "person"}
+
+    def __init__(self, onnx_model_path:str = None, intra_op_threads:int = None, execution_providers:List[str] = None) -> None:
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = intra_op_threads if intra_op_threads is not None else server_preferences.INFERENCE_INTRA_OP_THREADS
+        available_providers = onnxruntime.get_available_providers()
+        providers = [provider for provider in (execution_providers if execution_providers is not None else server_preferences.INFERENCE_EXECUTION_PROVIDERS) if provider in available_providers]
+        self.session = onnxruntime.InferenceSession(onnx_model_path, sess_options=session_options, providers=providers if len(providers) > 0 else ["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.is_static_shape = all(isinstance(dimension, int) for dimension in model_input.shape)
+        self.image_size = model_input.shape[2] if isinstance(model_input.shape[2], int) else server_preferences.INFERENCE_IMAGE_SIZE
+
+    def predict(self, frames:List[np.ndarray] = None, model_inputs:List[Tuple] = None) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        # Returns (boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf) of each frame, in the pixel coordinates of the frame
+        # model_inputs: optional (letterboxed frame, letterbox transform) of each frame prepared by return_model_input, None for the frames that should be preprocessed here
+        if model_inputs is None: model_inputs = [None]*len(frames)
+        model_inputs = [model_input if model_input is not None and model_input[0].shape == (self.image_size, self.image_size, 3) else return_model_input(frame = frame, image_size = self.image_size) for frame, model_input in zip(frames, model_inputs)]
+        letterbox_transforms = [model_input[1] for model_input in model_inputs]
+        input_batch = return_input_batch(model_inputs = model_inputs)
+
+        if self.is_static_shape: # Batch size is fixed to 1
+            outputs = np.concatenate([self.session.run(None, {self.input_name: input_batch[frame_index:frame_index+1]})[0] for frame_index in range(len(frames))], axis=0)
+        else:
+            outputs = self.session.run(None, {self.input_name: input_batch})[0]
+
+        return [decode_pose_output(output = output, letterbox_transform = letterbox_transform) for output, letterbox_transform in zip(outputs, letterbox_transforms)]
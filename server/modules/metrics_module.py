@@ -0,0 +1,115 @@
+import bisect, threading, time
+from typing import Dict, List, Tuple, Callable
+
+import server_preferences
+
+class Counter:
+    # Monotonic counter. Every metric is written by a single thread (its fetcher thread, the evaluation thread...), so increments do not take a lock
+    def __init__(self) -> None:
+        self.value = 0
+
+    def increment(self, amount:float = 1) -> None:
+        self.value += amount
+
+class Histogram:
+    # Fixed-bucket histogram: observing a value is a binary search and two additions, nothing is allocated
+    def __init__(self, bucket_bounds:List[float] = None) -> None:
+        self.bucket_bounds = list(bucket_bounds) # Upper bounds of the buckets in increasing order, the last (+Inf) bucket is implicit
+        self.bucket_counts = [0]*(len(self.bucket_bounds)+1)
+        self.sum = 0.0
+
+    def observe(self, value:float = None) -> None:
+        self.bucket_counts[bisect.bisect_left(self.bucket_bounds, value)] += 1
+        self.sum += value
+
+class MetricsRegistry:
+    # Metric families keyed by name, each family has one metric per label set. Rendered in the Prometheus text exposition format by return_prometheus_text
+    # - Counters and histograms are updated on the hot path
+    # - Values that the modules already keep (e.g. number_of_frames_fetched, camera_usefulness) are read by collectors at scrape time instead of being copied on every frame
+    def __init__(self) -> None:
+        self.families:Dict[str, Dict] = {} # name -> {"type", "help", "bucket_bounds", "metrics": {labels tuple: Counter or Histogram}}
+        self.collectors:Dict[str, Callable] = {} # collector_name -> callable returning [(name, type, help, labels dict, value), ...]
+        self.registry_lock = threading.Lock() # Only taken when a metric or a collector is created or removed, never when a metric is updated
+
+    def counter(self, name:str = None, help_text:str = None, labels:Dict[str, str] = None) -> Counter:
+        return self.__return_metric(name = name, metric_type = "counter", help_text = help_text, labels = labels, create_metric = Counter)
+
+    def histogram(self, name:str = None, help_text:str = None, labels:Dict[str, str] = None, bucket_bounds:List[float] = None) -> Histogram:
+        bucket_bounds = bucket_bounds if bucket_bounds is not None else server_preferences.METRICS_DEFAULT_SECONDS_BUCKETS
+        return self.__return_metric(name = name, metric_type = "histogram", help_text = help_text, labels = labels, create_metric = lambda: Histogram(bucket_bounds = bucket_bounds))
+
+    def remove_metrics(self, labels:Dict[str, str] = None) -> None:
+        # Removes the metrics of all families that have all the given labels, e.g. {"camera_uuid": ...} when a camera is removed
+        with self.registry_lock:
+            for family in self.families.values():
+                for labels_key in [labels_key for labels_key in family["metrics"] if all((label_name, label_value) in labels_key for label_name, label_value in labels.items())]:
+                    del family["metrics"][labels_key]
+
+    def register_collector(self, collector_name:str = None, collector:Callable = None) -> None:
+        # Registering the same collector_name again replaces the previous collector (e.g. a new EvaluationManager)
+        with self.registry_lock:
+            self.collectors[collector_name] = collector
+
+    def unregister_collector(self, collector_name:str = None) -> None:
+        with self.registry_lock:
+            self.collectors.pop(collector_name, None)
+
+    def return_prometheus_text(self) -> str:
+        with self.registry_lock:
+            families = [(name, family["type"], family["help"], family["bucket_bounds"], list(family["metrics"].items())) for name, family in self.families.items()]
+            collectors = list(self.collectors.items())
+
+        lines = []
+        for name, metric_type, help_text, bucket_bounds, metrics in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels_key, metric in metrics:
+                if metric_type == "counter":
+                    lines.append(f"{name}{self.__format_labels(labels_key)} {metric.value}")
+                    continue
+                bucket_counts, histogram_sum = list(metric.bucket_counts), metric.sum # Copied first so that the buckets, the sum and the count are consistent enough
+                cumulative_count = 0
+                for bucket_bound, bucket_count in zip(bucket_bounds + [float("inf")], bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f"{name}_bucket{self.__format_labels(labels_key + (('le', '+Inf' if bucket_bound == float('inf') else repr(float(bucket_bound))),))} {cumulative_count}")
+                lines.append(f"{name}_sum{self.__format_labels(labels_key)} {histogram_sum}")
+                lines.append(f"{name}_count{self.__format_labels(labels_key)} {cumulative_count}")
+
+        collected_families:Dict[str, Dict] = {}
+        for collector_name, collector in collectors:
+            try:
+                for name, metric_type, help_text, labels, value in collector():
+                    collected_families.setdefault(name, {"type": metric_type, "help": help_text, "samples": []})["samples"].append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                if server_preferences.METRICS_VERBOSE: print(f"Error in metrics collector {collector_name} at {time.time()}: {e}")
+        for name, collected_family in collected_families.items():
+            lines.append(f"# HELP {name} {collected_family['help']}")
+            lines.append(f"# TYPE {name} {collected_family['type']}")
+            for labels_key, value in collected_family["samples"]:
+                lines.append(f"{name}{self.__format_labels(labels_key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def __return_metric(self, name:str = None, metric_type:str = None, help_text:str = None, labels:Dict[str, str] = None, create_metric:Callable = None):
+        # Returns the existing metric of the label set if there is one, so that a restarted camera keeps counting where it left
+        labels_key = tuple(sorted((labels if labels is not None else {}).items()))
+        family = self.families.get(name)
+        metric = family["metrics"].get(labels_key) if family is not None and family["type"] == metric_type else None
+        if metric is not None: return metric
+
+        with self.registry_lock:
+            family = self.families.get(name)
+            if family is None:
+                metric = create_metric()
+                family = {"type": metric_type, "help": help_text, "bucket_bounds": list(metric.bucket_bounds) if metric_type == "histogram" else None, "metrics": {}}
+                self.families[name] = family
+            elif family["type"] != metric_type:
+                raise ValueError(f"Metric {name} is already registered as a {family['type']}")
+            return family["metrics"].setdefault(labels_key, metric if metric is not None else create_metric())
+
+    def __format_labels(self, labels_key:Tuple = None) -> str:
+        if len(labels_key) == 0: return ""
+        escaped_labels = [(label_name, str(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for label_name, label_value in labels_key]
+        return "{" + ",".join(f'{label_name}="{label_value}"' for label_name, label_value in escaped_labels) + "}"
+
+# Shared by all modules of the process, exported by the /metrics endpoint of the API
+METRICS = MetricsRegistry()
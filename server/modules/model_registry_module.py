@@ -0,0 +1,140 @@
+import threading, time, gc
+from typing import List, Dict
+import numpy as np
+
+import detectors_module
+import metrics_module
+import server_preferences
+
+class ModelRegistry:
+    # Single place where the yolo models are created. All rules and cameras using the same model share one detector
+    # - A model is loaded on its first use and warmed up with a blank frame, so that the first real frame does not pay for the lazy initialization of the model
+    # - Models that are not used for MODEL_REGISTRY_IDLE_EVICTION_SECONDS are released
+    AVAILABLE_MODELS = list(detectors_module.PoseDetector.POSE_MODEL_PATHS.keys())
+
+    def __init__(self) -> None:
+        self.models:Dict[str, Dict] = {} # model_name -> {"detector", "load_seconds", "warmup_seconds", "last_used_time"}
+        self.model_locks:Dict[str, threading.Lock] = {model_name: threading.Lock() for model_name in ModelRegistry.AVAILABLE_MODELS} # A model is loaded only once even if multiple threads need it at the same time
+        self.last_eviction_check_time = time.time()
+        metrics_module.METRICS.register_collector(collector_name = "model_registry", collector = self.return_metrics)
+
+    def validate_model_names(self, model_names:List[str] = None) -> None:
+        for model_name in model_names:
+            if model_name not in ModelRegistry.AVAILABLE_MODELS:
+                raise ValueError(f"Invalid model name: {model_name}. Available models are: {ModelRegistry.AVAILABLE_MODELS}")
+
+    def is_model_loaded(self, model_name:str = None) -> bool:
+        return model_name in self.models
+
+    def return_detector(self, model_name:str = None) -> detectors_module.PoseDetector:
+        # Blocks while the model is loaded on its first use
+        model = self.models.get(model_name)
+        if model is None:
+            self.validate_model_names(model_names = [model_name])
+            with self.model_locks[model_name]:
+                model = self.models.get(model_name)
+                if model is None:
+                    model = self.__load_model(model_name = model_name)
+                    self.models[model_name] = model
+        model["last_used_time"] = time.time()
+        return model["detector"]
+
+    def unload_model(self, model_name:str = None) -> None:
+        with self.model_locks[model_name]:
+            model = self.models.pop(model_name, None)
+        if model is None: return
+        del model
+        gc.collect() # Releases the model weights now instead of at an arbitrary later collection
+        if server_preferences.MODEL_REGISTRY_VERBOSE: print(f"Model {model_name} is unloaded at {time.time()}")
+
+    def evict_idle_models(self) -> List[str]:
+        # Cheap to call often, the models are checked at most every MODEL_REGISTRY_EVICTION_CHECK_INTERVAL_SECONDS. Returns the evicted model names
+        if time.time() - self.last_eviction_check_time < server_preferences.MODEL_REGISTRY_EVICTION_CHECK_INTERVAL_SECONDS: return []
+        self.last_eviction_check_time = time.time()
+        if server_preferences.MODEL_REGISTRY_IDLE_EVICTION_SECONDS is None: return []
+
+        idle_model_names = [model_name for model_name, model in list(self.models.items()) if time.time() - model["last_used_time"] > server_preferences.MODEL_REGISTRY_IDLE_EVICTION_SECONDS]
+        for model_name in idle_model_names:
+            self.unload_model(model_name = model_name)
+        return idle_model_names
+
+    def return_model_statistics(self) -> Dict[str, Dict]:
+        return {model_name: {"backend": model["detector"].backend, "load_seconds": model["load_seconds"], "warmup_seconds": model["warmup_seconds"], "idle_seconds": time.time() - model["last_used_time"]} for model_name, model in list(self.models.items())}
+
+    def return_metrics(self) -> List[tuple]:
+        # Metrics collector, called at scrape time. Only the loaded models are exported, an evicted model is loaded and measured again on its next use
+        metrics = []
+        for model_name, model_statistics in self.return_model_statistics().items():
+            metric_labels = {"model": model_name, "backend": model_statistics["backend"]}
+            metrics.append(("safety_ai_model_load_seconds", "gauge", "Duration of the last load of the model", metric_labels, model_statistics["load_seconds"]))
+            metrics.append(("safety_ai_model_warmup_seconds", "gauge", "Duration of the warmup inference after the last load of the model", metric_labels, model_statistics["warmup_seconds"]))
+            metrics.append(("safety_ai_model_idle_seconds", "gauge", "Seconds since the model was last used", metric_labels, model_statistics["idle_seconds"]))
+        return metrics
+
+    def compare_backend_to_pytorch(self, model_name:str = None, backend:str = None, frames_info:List[Dict] = None, bbox_confidence:float = 0.5, min_iou:float = 0.5) -> Dict:
+        # Runs the frames through the pytorch model and through the given backend of the same model, and reports the speed up and the accuracy loss of the backend
+        # The pytorch detections are taken as the ground truth. Detections are matched greedily by box IoU, keypoint errors are measured on the keypoints both sides detected
+        self.validate_model_names(model_names = [model_name])
+        reference_detector = self.__load_model(model_name = model_name, backend = "pytorch")["detector"]
+        backend_detector = self.__load_model(model_name = model_name, backend = backend)["detector"]
+
+        comparison = {"model_name": model_name, "backend": backend, "number_of_frames": len(frames_info)}
+        detections = {}
+        for name, detector in [("pytorch", reference_detector), (backend, backend_detector)]:
+            latencies_ms, detections[name] = [], []
+            for frame_info in frames_info:
+                inference_start_time = time.perf_counter()
+                detections[name].append(detector.predict_frames_and_return_detections(frames_info = [frame_info], bbox_confidence = bbox_confidence)[0])
+                latencies_ms.append((time.perf_counter() - inference_start_time)*1000)
+            comparison[f"{name}_mean_latency_ms"] = float(np.mean(latencies_ms)) if len(latencies_ms) > 0 else None
+            comparison[f"{name}_p95_latency_ms"] = float(np.percentile(latencies_ms, 95)) if len(latencies_ms) > 0 else None
+
+        number_of_references, number_of_predictions, matched_ious, keypoint_errors_px, confidence_differences = 0, 0, [], [], []
+        for reference_record, backend_record in zip(detections["pytorch"], detections[backend]):
+            number_of_references += len(reference_record.bbox_confidences)
+            number_of_predictions += len(backend_record.bbox_confidences)
+            for reference_index, backend_index, iou in self.__match_boxes(reference_boxes_xyxy = reference_record.bbox_xyxy_px, backend_boxes_xyxy = backend_record.bbox_xyxy_px, min_iou = min_iou):
+                matched_ious.append(iou)
+                confidence_differences.append(abs(float(reference_record.bbox_confidences[reference_index]) - float(backend_record.bbox_confidences[backend_index])))
+                is_keypoint_detected = (reference_record.keypoints_conf[reference_index] > 0) & (backend_record.keypoints_conf[backend_index] > 0)
+                keypoint_errors_px.extend(np.linalg.norm(reference_record.keypoints_xy[reference_index] - backend_record.keypoints_xy[backend_index], axis=1)[is_keypoint_detected].tolist())
+
+        comparison["recall"] = len(matched_ious)/number_of_references if number_of_references > 0 else None
+        comparison["precision"] = len(matched_ious)/number_of_predictions if number_of_predictions > 0 else None
+        comparison["mean_box_iou"] = float(np.mean(matched_ious)) if len(matched_ious) > 0 else None
+        comparison["mean_keypoint_error_px"] = float(np.mean(keypoint_errors_px)) if len(keypoint_errors_px) > 0 else None
+        comparison["mean_confidence_difference"] = float(np.mean(confidence_differences)) if len(confidence_differences) > 0 else None
+        if comparison[f"{backend}_mean_latency_ms"]: comparison["speed_up"] = comparison["pytorch_mean_latency_ms"]/comparison[f"{backend}_mean_latency_ms"]
+        return comparison
+
+    def __match_boxes(self, reference_boxes_xyxy:np.ndarray = None, backend_boxes_xyxy:np.ndarray = None, min_iou:float = 0.5) -> List:
+        # Greedy matching, highest IoU pairs first. Returns [(reference_index, backend_index, iou), ...]
+        if len(reference_boxes_xyxy) == 0 or len(backend_boxes_xyxy) == 0: return []
+        top_left = np.maximum(reference_boxes_xyxy[:, np.newaxis, :2], backend_boxes_xyxy[np.newaxis, :, :2])
+        bottom_right = np.minimum(reference_boxes_xyxy[:, np.newaxis, 2:], backend_boxes_xyxy[np.newaxis, :, 2:])
+        intersection_areas = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+        reference_areas = np.prod(reference_boxes_xyxy[:, 2:] - reference_boxes_xyxy[:, :2], axis=1)
+        backend_areas = np.prod(backend_boxes_xyxy[:, 2:] - backend_boxes_xyxy[:, :2], axis=1)
+        ious = intersection_areas / np.maximum(reference_areas[:, np.newaxis] + backend_areas[np.newaxis, :] - intersection_areas, 1e-9)
+
+        matches = []
+        for reference_index, backend_index in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+            if ious[reference_index, backend_index] < min_iou: break
+            if any(reference_index == match[0] or backend_index == match[1] for match in matches): continue
+            matches.append((int(reference_index), int(backend_index), float(ious[reference_index, backend_index])))
+        return matches
+
+    def __load_model(self, model_name:str = None, backend:str = None) -> Dict:
+        # backend None means the backend configured in INFERENCE_BACKENDS
+        load_start_time = time.time()
+        detector = detectors_module.PoseDetector(model_name = model_name, backend = backend)
+        load_seconds = time.time() - load_start_time
+
+        warmup_start_time = time.time()
+        warmup_frame_width, warmup_frame_height = server_preferences.MODEL_REGISTRY_WARMUP_FRAME_SIZE
+        warmup_frame_info = {"frame": np.zeros((warmup_frame_height, warmup_frame_width, 3), dtype=np.uint8), "camera_uuid": "warmup", "frame_uuid": "warmup", "frame_timestamp": time.time()}
+        detector.predict_frames_and_return_detections(frames_info = [warmup_frame_info], is_warmup = True)
+        warmup_seconds = time.time() - warmup_start_time
+
+        if server_preferences.MODEL_REGISTRY_VERBOSE: print(f"Model {model_name} ({detector.backend}) is loaded in {load_seconds:.2f} s and warmed up in {warmup_seconds:.2f} s")
+        return {"detector": detector, "load_seconds": load_seconds, "warmup_seconds": warmup_seconds, "last_used_time": time.time()}
@@ -0,0 +1,103 @@
+import threading, math, time
+from typing import Dict, Tuple
+import numpy as np
+import cv2
+
+import server_preferences
+
+class MosaicRenderer:
+    # Renders the latest frames of the cameras in a grid on a preallocated canvas
+    # - The grid layout and the tile views of the canvas are cached until the camera list or the window size changes
+    # - Frames are resized directly into their tile, and only the tiles whose frame_uuid changed since the last render are redrawn
+    # - In headless mode the mosaic is published as a JPEG buffer (see return_mosaic_jpeg) instead of being shown in a window
+    def __init__(self, window_size:Tuple[int,int] = None, is_headless:bool = None) -> None:
+        self.window_size = tuple(window_size) if window_size is not None else tuple(server_preferences.MOSAIC_WINDOW_SIZE) # (width, height)
+        self.is_headless = is_headless if is_headless is not None else server_preferences.MOSAIC_HEADLESS
+        self.canvas = np.zeros((self.window_size[1], self.window_size[0], 3), dtype=np.uint8)
+
+        self.layout_camera_uuids:Tuple[str] = None
+        self.tile_views:Dict[str, np.ndarray] = {} # camera_uuid -> view of the canvas
+        self.tile_frame_uuids:Dict[str, str] = {} # camera_uuid -> frame_uuid drawn in the tile, None if the tile is empty
+
+        self.mosaic_jpeg:bytes = None
+        self.mosaic_version = 0 # Incremented every time the published mosaic changes
+        self.mosaic_lock = threading.Lock()
+
+        self.render_stop_event = threading.Event()
+        self.render_thread = None
+
+    def render(self, camera_frames_info:Dict[str, Dict] = None) -> int:
+        # camera_frames_info: camera_uuid -> latest frame_info of the camera or None. Returns the number of redrawn tiles
+        camera_uuids = tuple(camera_frames_info.keys())
+        if camera_uuids != self.layout_camera_uuids:
+            self.__update_layout(camera_uuids = camera_uuids)
+
+        number_of_redrawn_tiles = 0
+        for camera_uuid, frame_info in camera_frames_info.items():
+            frame_uuid = frame_info["frame_uuid"] if frame_info is not None else None
+            if frame_uuid == self.tile_frame_uuids[camera_uuid]: continue
+
+            tile_view = self.tile_views[camera_uuid]
+            if frame_info is None:
+                tile_view[...] = 0
+            else:
+                cv2.resize(frame_info["frame"], (tile_view.shape[1], tile_view.shape[0]), dst=tile_view, interpolation=cv2.INTER_AREA)
+            self.tile_frame_uuids[camera_uuid] = frame_uuid
+            number_of_redrawn_tiles += 1
+
+        if number_of_redrawn_tiles > 0:
+            if self.is_headless:
+                self.__publish_mosaic()
+            else:
+                cv2.imshow('Fetched CCTV Frames', self.canvas)
+        if not self.is_headless: cv2.waitKey(1)
+        return number_of_redrawn_tiles
+
+    def return_mosaic_jpeg(self) -> Tuple[int, bytes]:
+        # (mosaic_version, jpeg bytes) of the last published mosaic, jpeg bytes are None until the first frame is rendered
+        with self.mosaic_lock:
+            return self.mosaic_version, self.mosaic_jpeg
+
+    def start_rendering(self, stream_manager = None) -> None:
+        # Renders the latest frames of the stream manager in a background thread, away from the evaluation
+        if self.render_thread is not None: return
+        self.render_stop_event.clear()
+        self.render_thread = threading.Thread(target=self.__render_thread, args=(stream_manager,))
+        self.render_thread.daemon = True
+        self.render_thread.start()
+
+    def stop_rendering(self) -> None:
+        if self.render_thread is None: return
+        self.render_stop_event.set()
+        self.render_thread.join()
+        self.render_thread = None
+
+    def __render_thread(self, stream_manager = None) -> None:
+        while not self.render_stop_event.wait(timeout=server_preferences.MOSAIC_RENDER_INTERVAL_SECONDS):
+            try:
+                self.render(camera_frames_info = {camera.camera_uuid: camera.get_last_frame_info() for camera in stream_manager.cameras})
+            except Exception as e:
+                if server_preferences.CAMERA_VERBOSE: print(f"Error in rendering the mosaic at {time.time()}: {e}")
+
+    def __update_layout(self, camera_uuids:Tuple[str] = None) -> None:
+        self.canvas[...] = 0
+        self.layout_camera_uuids = camera_uuids
+        self.tile_views = {}
+        self.tile_frame_uuids = {}
+        if len(camera_uuids) == 0: return
+
+        grid_cols = math.ceil(math.sqrt(len(camera_uuids)))
+        grid_rows = math.ceil(len(camera_uuids) / grid_cols)
+        tile_width = self.window_size[0] // grid_cols
+        tile_height = self.window_size[1] // grid_rows
+        for camera_index, camera_uuid in enumerate(camera_uuids):
+            row, col = camera_index // grid_cols, camera_index % grid_cols
+            self.tile_views[camera_uuid] = self.canvas[row*tile_height:(row+1)*tile_height, col*tile_width:(col+1)*tile_width]
+            self.tile_frame_uuids[camera_uuid] = None
+
+    def __publish_mosaic(self) -> None:
+        is_success, jpeg_buffer = cv2.imencode(".jpg", self.canvas, [cv2.IMWRITE_JPEG_QUALITY, server_preferences.MOSAIC_JPEG_QUALITY])
+        if not is_success: return
+        with self.mosaic_lock:
+            self.mosaic_jpeg = jpeg_buffer.tobytes()
+            self.mosaic_version += 1
@@ -0,0 +1,211 @@
+import threading, time, queue, collections
+from typing import List, Dict, Callable
+
+import server_preferences
+import metrics_module
+
+class CameraFrameQueues:
+    # Bounded per-camera frame queues shared by the fetcher threads (producers) and the evaluation worker (consumer)
+    # When a camera's queue is full, the oldest frame is dropped so that the most recent frames always win
+    def __init__(self, queue_size:int = None) -> None:
+        self.queue_size = queue_size if queue_size is not None else server_preferences.PIPELINE_CAMERA_QUEUE_SIZE
+        self.camera_queues:Dict[str, collections.deque] = {}
+        self.ready_condition = threading.Condition() # Signaled whenever a new frame is put or the queues are closed
+        self.is_closed = False
+        self.number_of_frames_put = 0
+        self.number_of_frames_dropped = 0
+
+    def put(self, frame_info:Dict = None) -> None:
+        with self.ready_condition:
+            if self.is_closed: return
+            camera_queue = self.camera_queues.setdefault(frame_info["camera_uuid"], collections.deque(maxlen=self.queue_size))
+            if len(camera_queue) == camera_queue.maxlen:
+                self.number_of_frames_dropped += 1
+            camera_queue.append(frame_info)
+            self.number_of_frames_put += 1
+            self.ready_condition.notify()
+
+    def get_all(self, timeout:float = None) -> List[Dict]:
+        # Blocks until at least one frame is available, the timeout expires or the queues are closed. Returns all the queued frames
+        with self.ready_condition:
+            self.ready_condition.wait_for(lambda: self.is_closed or any(len(camera_queue) > 0 for camera_queue in self.camera_queues.values()), timeout=timeout)
+            frames_info = []
+            for camera_queue in self.camera_queues.values():
+                frames_info.extend(camera_queue)
+                camera_queue.clear()
+            return frames_info
+
+    def close(self) -> None:
+        with self.ready_condition:
+            self.is_closed = True
+            self.ready_condition.notify_all()
+
+class EvaluationPipeline:
+    # fetcher threads -> CameraFrameQueues -> evaluation worker -> bounded result queue -> sink worker -> result sinks
+    # Every stage blocks instead of polling, so the pipeline is idle when there are no new frames
+    __STOP_SIGNAL = object()
+
+    def __init__(self, stream_manager = None, evaluation_manager = None) -> None:
+        self.stream_manager = stream_manager
+        self.evaluation_manager = evaluation_manager
+
+        self.frame_queues = CameraFrameQueues()
+        self.result_queue = queue.Queue(maxsize=server_preferences.PIPELINE_RESULT_QUEUE_SIZE)
+        self.result_sinks:List[Callable] = [] # Each sink is called with a single evaluation result
+        self.evidence_sinks:List[Callable] = [] # Each sink is called with a single evaluation result mapped to its high resolution evidence frame
+
+        self.is_running = False
+        self.evaluation_thread = None
+        self.sink_thread = None
+
+        self.number_of_results_dropped = 0
+        self.number_of_frames_evaluated = 0
+        self.number_of_evaluation_errors = 0
+        self.number_of_results_dropped_stale_frame = 0
+        self.capture_to_evaluation_latencies = collections.deque(maxlen=server_preferences.PIPELINE_LATENCY_WINDOW_SIZE) # seconds between frame fetching and the end of its evaluation
+        self.queue_wait_latencies = collections.deque(maxlen=server_preferences.PIPELINE_LATENCY_WINDOW_SIZE) # seconds between frame fetching and its dequeuing by the evaluation worker
+        self.evaluation_call_latencies = collections.deque(maxlen=server_preferences.PIPELINE_LATENCY_WINDOW_SIZE) # seconds spent in a single evaluate_frames_info call
+        self.queue_wait_histogram = metrics_module.METRICS.histogram(name = "safety_ai_pipeline_queue_wait_seconds", help_text = "Age of a frame when the evaluation worker takes it from the frame queues")
+        self.capture_to_evaluation_histogram = metrics_module.METRICS.histogram(name = "safety_ai_pipeline_capture_to_evaluation_seconds", help_text = "Age of a frame at the end of its evaluation")
+        metrics_module.METRICS.register_collector(collector_name = "evaluation_pipeline", collector = self.return_metrics)
+
+    def add_result_sink(self, result_sink:Callable = None) -> None:
+        self.result_sinks.append(result_sink)
+
+    def add_evidence_sink(self, evidence_sink:Callable = None) -> None:
+        self.evidence_sinks.append(evidence_sink)
+
+    def start(self) -> None:
+        self.is_running = True
+        self.stream_manager.attach_frame_queues(frame_queues = self.frame_queues)
+
+        self.evaluation_thread = threading.Thread(target=self.__evaluation_worker)
+        self.evaluation_thread.daemon = True
+        self.evaluation_thread.start()
+
+        self.sink_thread = threading.Thread(target=self.__sink_worker)
+        self.sink_thread.daemon = True
+        self.sink_thread.start()
+
+    def stop(self) -> None:
+        # Stops the stages in order, so that the results that are already evaluated are delivered to the sinks
+        self.is_running = False
+        self.stream_manager.attach_frame_queues(frame_queues = None)
+        self.frame_queues.close()
+        if self.evaluation_thread is not None: self.evaluation_thread.join()
+        self.result_queue.put(EvaluationPipeline.__STOP_SIGNAL)
+        if self.sink_thread is not None: self.sink_thread.join()
+        self.evaluation_thread = None
+        self.sink_thread = None
+
+    def return_latency_statistics(self, latencies:collections.deque = None) -> Dict:
+        # Statistics of the capture to evaluation latencies, or of the given latency window (e.g. queue_wait_latencies)
+        latencies = sorted(latencies if latencies is not None else self.capture_to_evaluation_latencies)
+        if len(latencies) == 0:
+            return {"number_of_samples":0, "p50_seconds":None, "p95_seconds":None, "max_seconds":None}
+        return {
+            "number_of_samples": len(latencies),
+            "p50_seconds": latencies[int(0.50*(len(latencies)-1))],
+            "p95_seconds": latencies[int(0.95*(len(latencies)-1))],
+            "max_seconds": latencies[-1],
+        }
+
+    def return_metrics(self) -> List[tuple]:
+        # Metrics collector, called at scrape time
+        return [
+            ("safety_ai_pipeline_frames_queued_total", "counter", "Frames put to the frame queues", {}, self.frame_queues.number_of_frames_put),
+            ("safety_ai_pipeline_frames_dropped_total", "counter", "Frames dropped from a full frame queue before being evaluated", {}, self.frame_queues.number_of_frames_dropped),
+            ("safety_ai_pipeline_frames_evaluated_total", "counter", "Frames evaluated by at least one model", {}, self.number_of_frames_evaluated),
+            ("safety_ai_pipeline_evaluation_errors_total", "counter", "evaluate_frames_info calls that raised an exception, their frames are not evaluated", {}, self.number_of_evaluation_errors),
+            ("safety_ai_pipeline_results_dropped_stale_frame_total", "counter", "Evaluation results dropped because the shared memory slot of their frame was reused during the evaluation (decoder process mode)", {}, self.number_of_results_dropped_stale_frame),
+            ("safety_ai_pipeline_results_dropped_total", "counter", "Evaluation results dropped because the result queue was full", {}, self.number_of_results_dropped),
+            ("safety_ai_pipeline_result_queue_size", "gauge", "Evaluation results waiting for the result sinks", {}, self.result_queue.qsize()),
+        ]
+
+    def __evaluation_worker(self) -> None:
+        frame_timestamps = {} # frame_uuid -> frame_timestamp, used to measure the capture to evaluation latency
+        shared_frames_info = {} # frame_uuid -> frame_info of the frames that are views of the decoder processes' shared memory
+        while self.is_running:
+            # If some frames are waiting in a partially filled batch or for the inference budget, wake up in time to evaluate them
+            timeout = self.evaluation_manager.return_next_wakeup_delay()
+            frames_info = self.frame_queues.get_all(timeout=timeout)
+            if not self.is_running: break
+            evaluation_start_time = time.time()
+            for frame_info in frames_info:
+                frame_timestamps[frame_info["frame_uuid"]] = frame_info["frame_timestamp"]
+                if "shared_memory_name" in frame_info: shared_frames_info[frame_info["frame_uuid"]] = frame_info
+                self.queue_wait_latencies.append(evaluation_start_time - frame_info["frame_timestamp"])
+                self.queue_wait_histogram.observe(evaluation_start_time - frame_info["frame_timestamp"])
+
+            try:
+                evaluated_uuids, evaluation_results = self.evaluation_manager.evaluate_frames_info(frames_info = frames_info)
+            except Exception as e: # A bad frame, rule or model must not stop the evaluation of the other cameras
+                self.number_of_evaluation_errors += 1
+                if server_preferences.PIPELINE_VERBOSE: print(f"Error in the evaluation of {len(frames_info)} frames at {time.time()}: {e}")
+                time.sleep(server_preferences.PIPELINE_EVALUATION_ERROR_BACKOFF_SECONDS) # Frames kept in the scheduler or a pending batch may raise again on the next call
+                continue
+            self.stream_manager.update_frame_evaluations(evaluated_frame_uuids = evaluated_uuids)
+
+            evaluation_end_time = time.time()
+            self.evaluation_call_latencies.append(evaluation_end_time - evaluation_start_time)
+            self.number_of_frames_evaluated += len(evaluated_uuids)
+            for evaluated_uuid in evaluated_uuids:
+                if evaluated_uuid not in frame_timestamps: continue
+                self.capture_to_evaluation_latencies.append(evaluation_end_time - frame_timestamps[evaluated_uuid])
+                self.capture_to_evaluation_histogram.observe(evaluation_end_time - frame_timestamps[evaluated_uuid])
+            # Only the timestamps of the frames waiting in a partially filled batch or in the scheduler are needed later on. The scheduler drops the frames older than EVALUATION_MAX_FRAME_AGE_SECONDS
+            pending_uuids = set(frame_uuid for pending_batch in self.evaluation_manager.pending_batches.values() for frame_uuid in pending_batch["frames_info"])
+            frame_timestamps = {frame_uuid:frame_timestamp for frame_uuid, frame_timestamp in frame_timestamps.items() if frame_uuid in pending_uuids or (frame_uuid not in evaluated_uuids and evaluation_end_time - frame_timestamp <= server_preferences.EVALUATION_MAX_FRAME_AGE_SECONDS)}
+
+            if len(shared_frames_info) > 0:
+                evaluation_results = self.__return_results_with_copied_frames(evaluation_results = evaluation_results, shared_frames_info = shared_frames_info)
+                shared_frames_info = {frame_uuid:frame_info for frame_uuid, frame_info in shared_frames_info.items() if frame_uuid in frame_timestamps}
+
+            for evaluation_result in evaluation_results:
+                try:
+                    self.result_queue.put(evaluation_result, timeout=server_preferences.PIPELINE_RESULT_QUEUE_PUT_TIMEOUT_SECONDS)
+                except queue.Full:
+                    self.number_of_results_dropped += 1
+                    if server_preferences.PIPELINE_VERBOSE: print(f"Result queue is full, an evaluation result of {evaluation_result.camera_uuid} is dropped")
+
+    def __return_results_with_copied_frames(self, evaluation_results:List = None, shared_frames_info:Dict[str, Dict] = None) -> List:
+        # A shared memory slot is reused by its decoder process after CAMERA_SHARED_MEMORY_SLOTS_PER_CAMERA newer frames, possibly while the frame was being evaluated
+        # The frame of each result is copied first and the slot is checked afterwards: if it was overwritten in the meantime, the detections and the copy may be torn and the result is dropped
+        # The results then own their frames, so the sinks can keep them after the slot is reused
+        copied_frames = {} # frame_uuid -> copy of the frame, None if the slot was overwritten
+        kept_evaluation_results = []
+        for evaluation_result in evaluation_results:
+            frame_info = shared_frames_info.get(evaluation_result.frame_uuid)
+            if frame_info is not None:
+                if evaluation_result.frame_uuid not in copied_frames:
+                    frame_copy = frame_info["frame"].copy()
+                    copied_frames[evaluation_result.frame_uuid] = frame_copy if self.stream_manager.is_frame_valid(frame_info = frame_info) else None
+                if copied_frames[evaluation_result.frame_uuid] is None:
+                    self.number_of_results_dropped_stale_frame += 1
+                    if server_preferences.PIPELINE_VERBOSE: print(f"The frame of an evaluation result of {evaluation_result.camera_uuid} was overwritten during its evaluation, the result is dropped")
+                    continue
+                evaluation_result.frame = copied_frames[evaluation_result.frame_uuid]
+            kept_evaluation_results.append(evaluation_result)
+        return kept_evaluation_results
+
+    def __sink_worker(self) -> None:
+        while True:
+            evaluation_result = self.result_queue.get()
+            if evaluation_result is EvaluationPipeline.__STOP_SIGNAL: break
+
+            for result_sink in self.result_sinks:
+                try:
+                    result_sink(evaluation_result)
+                except Exception as e:
+                    if server_preferences.PIPELINE_VERBOSE: print(f"Error in result sink {result_sink}: {e}")
+
+            # Evidence frames are only fetched if someone needs them. The stream manager fetches them in the background
+            if len(self.evidence_sinks) > 0:
+                self.stream_manager.request_evidence(evaluation_result = evaluation_result, on_evidence_ready = self.__deliver_evidence)
+
+    def __deliver_evidence(self, evidence_result = None) -> None:
+        for evidence_sink in self.evidence_sinks:
+            try:
+                evidence_sink(evidence_result)
+            except Exception as e:
+                if server_preferences.PIPELINE_VERBOSE: print(f"Error in evidence sink {evidence_sink}: {e}")
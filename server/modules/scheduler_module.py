@@ -0,0 +1,105 @@
+import heapq, time
+from typing import List, Dict
+
+import server_preferences
+
+class EvaluationScheduler:
+    # Decides which of the ready frames are evaluated, within a global inference budget
+    # - The budget is a token bucket refilled at budget_per_second, in the same unit as the frame costs (frames or model milliseconds)
+    # - Cameras share the budget in proportion to their weights using self-clocked weighted fair queuing, each camera keeps only its freshest frame
+    # - A camera that is not evaluated for max_revisit_interval_seconds is evaluated regardless of the budget
+    # Every decision is a heap operation, O(log n) in the number of cameras
+    def __init__(self, budget_per_second:float = None, max_revisit_interval_seconds:float = None, max_frame_age_seconds:float = None, burst_seconds:float = None) -> None:
+        self.budget_per_second = budget_per_second
+        self.max_revisit_interval_seconds = max_revisit_interval_seconds if max_revisit_interval_seconds is not None else server_preferences.EVALUATION_MAX_REVISIT_INTERVAL_SECONDS
+        self.max_frame_age_seconds = max_frame_age_seconds if max_frame_age_seconds is not None else server_preferences.EVALUATION_MAX_FRAME_AGE_SECONDS
+        self.budget_capacity = budget_per_second * (burst_seconds if burst_seconds is not None else server_preferences.EVALUATION_BUDGET_BURST_SECONDS)
+
+        self.budget_tokens = self.budget_capacity
+        self.last_refill_time = time.time()
+        self.virtual_time = 0.0
+
+        self.ready_frames:Dict[str, Dict] = {} # camera_uuid -> {"frame_info", "cost", "finish_tag", "ready_sequence"}
+        self.camera_finish_tags:Dict[str, float] = {} # camera_uuid -> finish tag of the last frame of the camera that entered the fair queue
+        self.camera_last_evaluation_times:Dict[str, float] = {} # camera_uuid -> timestamp of the last time a frame of the camera is scheduled
+        self.camera_weights:Dict[str, float] = {}
+
+        self.ready_sequence = 0 # Heap entries of frames that are replaced or already scheduled are skipped lazily by comparing this sequence
+        self.fair_queue_heap = [] # (finish_tag, ready_sequence, camera_uuid)
+        self.revisit_heap = [] # (revisit_deadline, ready_sequence, camera_uuid)
+
+    def is_camera_overdue(self, camera_uuid:str = None) -> bool:
+        return time.time() - self.camera_last_evaluation_times.get(camera_uuid, 0) >= self.max_revisit_interval_seconds
+
+    def add_frame(self, frame_info:Dict = None, weight:float = None, cost:float = None) -> None:
+        # A newer frame replaces the ready frame of the camera but keeps its place in the queue
+        camera_uuid = frame_info["camera_uuid"]
+        self.camera_weights[camera_uuid] = weight
+        if camera_uuid in self.ready_frames:
+            self.ready_frames[camera_uuid]["frame_info"] = frame_info
+            return
+
+        finish_tag = max(self.virtual_time, self.camera_finish_tags.get(camera_uuid, 0)) + cost/weight
+        self.camera_finish_tags[camera_uuid] = finish_tag
+        self.ready_sequence += 1
+        self.ready_frames[camera_uuid] = {"frame_info": frame_info, "cost": cost, "finish_tag": finish_tag, "ready_sequence": self.ready_sequence}
+        heapq.heappush(self.fair_queue_heap, (finish_tag, self.ready_sequence, camera_uuid))
+        heapq.heappush(self.revisit_heap, (self.camera_last_evaluation_times.get(camera_uuid, 0) + self.max_revisit_interval_seconds, self.ready_sequence, camera_uuid))
+
+    def pop_frames_to_evaluate(self) -> List[Dict]:
+        self.__refill_budget()
+        frames_to_evaluate = []
+
+        # Overdue cameras first, they are not limited by the budget
+        while len(self.revisit_heap) > 0 and self.revisit_heap[0][0] <= time.time():
+            _, ready_sequence, camera_uuid = heapq.heappop(self.revisit_heap)
+            frame_info = self.__take_ready_frame(camera_uuid = camera_uuid, ready_sequence = ready_sequence)
+            if frame_info is not None: frames_to_evaluate.append(frame_info)
+
+        # Then the fair share of the budget. The budget may go negative by the cost of the last frame, which is paid back before the next frame
+        while len(self.fair_queue_heap) > 0 and self.budget_tokens > 0:
+            finish_tag, ready_sequence, camera_uuid = heapq.heappop(self.fair_queue_heap)
+            frame_info = self.__take_ready_frame(camera_uuid = camera_uuid, ready_sequence = ready_sequence)
+            if frame_info is None: continue
+            self.virtual_time = max(self.virtual_time, finish_tag)
+            frames_to_evaluate.append(frame_info)
+
+        return frames_to_evaluate
+
+    def return_next_decision_delay(self) -> float:
+        # Seconds until pop_frames_to_evaluate may return a frame without new frames arriving. None if no frame is waiting
+        if len(self.ready_frames) == 0: return None
+        budget_delay = 0 if self.budget_tokens > 0 else -self.budget_tokens/self.budget_per_second
+        revisit_delay = max(0, self.revisit_heap[0][0] - time.time()) if len(self.revisit_heap) > 0 else budget_delay
+        return min(budget_delay, revisit_delay)
+
+    def return_camera_shares(self) -> Dict[str, float]:
+        # Expected fraction of the budget allocated to each camera if all cameras had a ready frame
+        total_weight = sum(self.camera_weights.values())
+        if total_weight == 0: return {}
+        return {camera_uuid: weight/total_weight for camera_uuid, weight in self.camera_weights.items()}
+
+    def remove_camera(self, camera_uuid:str = None) -> None:
+        # Heap entries of the camera become stale and are skipped lazily
+        self.ready_frames.pop(camera_uuid, None)
+        self.camera_finish_tags.pop(camera_uuid, None)
+        self.camera_last_evaluation_times.pop(camera_uuid, None)
+        self.camera_weights.pop(camera_uuid, None)
+
+    def __take_ready_frame(self, camera_uuid:str = None, ready_sequence:int = None) -> Dict:
+        ready_frame = self.ready_frames.get(camera_uuid)
+        if ready_frame is None or ready_frame["ready_sequence"] != ready_sequence:
+            return None # Stale heap entry
+        del self.ready_frames[camera_uuid]
+
+        if time.time() - ready_frame["frame_info"]["frame_timestamp"] > self.max_frame_age_seconds:
+            return None # Too old to be worth evaluating, wait for a fresher frame of the camera
+
+        self.budget_tokens -= ready_frame["cost"]
+        self.camera_last_evaluation_times[camera_uuid] = time.time()
+        return ready_frame["frame_info"]
+
+    def __refill_budget(self) -> None:
+        now = time.time()
+        self.budget_tokens = min(self.budget_capacity, self.budget_tokens + (now - self.last_refill_time)*self.budget_per_second)
+        self.last_refill_time = now
@@ -1,26 +1,164 @@
 # Camera Class Preferences:
 CAMERA_VERBOSE = False
 CAMERA_CONFIG_KEYS = ['camera_uuid', 'camera_region', 'camera_description', 'is_alive', 'NVR_ip', 'camera_ip_address', 'username', 'password', 'stream_path', 'active_rules']
-CAMERA_DEFAULT_FETCHING_DURATION_SECONDS = 0.1 # Used to calculate randomization range for fetching delay
-CAMERA_FETCH_DELAY_SAFETY_MARGIN = 2 # Used to increase the fetching delay to prevent bottlenecking. Basically the max delay is calculated by multiplying the default fetching duration by the number of cameras and this safety margin
+CAMERA_INITIAL_FETCHING_DELAY_SECONDS = 0.5 # Fetching delay of a camera until its evaluation rate is measured
+CAMERA_MIN_FETCHING_DELAY_SECONDS = 0.05 # Lower limit of the fetching delay calculated by the rate controller
+CAMERA_MAX_FETCHING_DELAY_SECONDS = 2 # Upper limit of the fetching delay calculated by the rate controller, so that the motion score of a rarely evaluated camera stays responsive
+CAMERA_FETCH_TO_EVALUATION_INTERVAL_RATIO = 0.5 # The fetching delay follows the measured interval between the evaluations of the camera multiplied by this ratio, so that a fresh frame is ready when the evaluator needs one
+CAMERA_MAX_DECODE_DUTY_CYCLE = 0.25 # The fetching delay is at least the measured decoding duration divided by this ratio, which limits the time a camera spends decoding
+CAMERA_FETCHING_DELAY_JITTER_RATIO = 0.1 # The fetching delay is randomly shortened by up to this ratio so that the cameras are not synchronized which may cause a bottleneck
+CAMERA_RATE_CONTROLLER_SMOOTHING = 0.2 # Weight of the newest measurement in the moving averages of the decoding duration and the evaluation interval
+CAMERA_MOTION_DOWNSCALED_WIDTH = 64 # Frames are downscaled to this width (keeping the aspect ratio) and converted to grayscale before calculating the motion score
+CAMERA_MOTION_PIXEL_DIFFERENCE_THRESHOLD = 15 # A downscaled pixel is considered as changed if its grayscale value differs from the background by more than this value
+CAMERA_MOTION_BACKGROUND_LEARNING_RATE = 0.05 # The background is updated by -> background = (1-LEARNING_RATE)*background + LEARNING_RATE*frame
+CAMERA_GRAB_TIMEOUT_SECONDS = 10 # If no frame is grabbed from a stream for this duration, the stream is considered stalled and reopened
+CAMERA_GRAB_RETRY_DELAY_SECONDS = 0.05 # Waiting time after a failed grab before trying again
+CAMERA_MAX_CONSECUTIVE_GRAB_FAILURES = 100 # The stream is reopened if grabbing fails this many times in a row
+CAMERA_RECONNECT_BASE_BACKOFF_SECONDS = 1 # Waiting time before the first reconnect attempt, doubled after each failed attempt
+CAMERA_RECONNECT_MAX_BACKOFF_SECONDS = 300 # Upper limit of the waiting time between reconnect attempts
+CAMERA_RECONNECT_BACKOFF_JITTER_RATIO = 0.5 # The waiting time is randomly shortened by up to this ratio so that the cameras do not reconnect at the same time
+CAMERA_MAX_RECONNECT_ATTEMPTS = None # After this many failed reconnect attempts the camera is marked as failed and not restarted anymore. None means retry forever
+CAMERA_SUPERVISOR_PERIOD_SECONDS = 1 # How often the supervisor checks the health of the streams
+CAMERA_DECODER_PROCESSES = 0 # If greater than 0, the cameras are sharded across this many decoder processes which hand the frames over through shared memory. 0 means all cameras are decoded by threads of the main process
+CAMERA_SHARED_MEMORY_SLOTS_PER_CAMERA = 3 # Number of frames kept in the shared memory ring of each camera. A frame read from shared memory stays valid until the decoder process writes this many newer frames
+CAMERA_EVIDENCE_FRAME_TIMEOUT_SECONDS = 5 # Maximum duration to open the high resolution stream and decode a single evidence frame
+CAMERA_CONFIG_CHECK_INTERVAL_SECONDS = 5 # How often the modification time of the camera configs file is checked. If it changed, the running cameras are reconciled with the new configs
+CAMERA_EVIDENCE_WORKERS = 4 # Number of threads fetching evidence frames from the high resolution streams
+CAMERA_PREPARE_MODEL_INPUTS = False # If True, the fetcher threads letterbox the frames (or their restricted area crops) to INFERENCE_IMAGE_SIZE, so that the evaluation thread only normalizes the batch and runs the model. Not available with CAMERA_DECODER_PROCESSES
 
-CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE = [0,10] # When a frame is fetched from a camera, the camera waits for a random time between 0 and 10 seconds before fetching the next frame. This is to prevent bottlenecking when multiple cameras are fetching frames at the same time. The range can be changed by the user using the set_camera_fetching_delay_randomization_range function
-def PREF_optimize_camera_fetching_delay_randomization_range(number_of_cameras:int):
-    global CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE
-    global CAMERA_FETCH_DELAY_SAFETY_MARGIN
+#Frame Source Module Preferences:
+SYNTHETIC_DEFAULT_FPS = 15 # Frame rate of the synthetic cameras if not set in their frame_source config
+SYNTHETIC_DEFAULT_FRAME_SIZE = (1280, 720) # (width, height) of the generated frames
+SYNTHETIC_DEFAULT_NUMBER_OF_PEOPLE = 3 # Number of simulated people walking in the generated frames
+SYNTHETIC_PERSON_HEIGHT_RATIO = 0.35 # Height of a simulated person at the bottom of the frame relative to the frame height, people farther away are drawn smaller
+SYNTHETIC_PERSON_SPEED_RANGE = (0.02, 0.1) # Walking speed of the simulated people in frame sizes per second
+SYNTHETIC_RESIZE_VIDEO_FRAMES = False # If True, replayed video frames are resized to the frame_size of the source
 
-    max_delay = max(CAMERA_DEFAULT_FETCHING_DURATION_SECONDS, CAMERA_FETCH_DELAY_SAFETY_MARGIN*CAMERA_DEFAULT_FETCHING_DURATION_SECONDS * number_of_cameras)
-    CAMERA_FETCHING_DELAY_RANDOMIZATION_RANGE = [CAMERA_DEFAULT_FETCHING_DURATION_SECONDS, max_delay]
+#Benchmark Module Preferences:
+BENCHMARK_WARMUP_SECONDS = 10 # Each benchmark run starts measuring after this duration, so that the models are warmed up and the rate controllers are settled
+BENCHMARK_DURATION_SECONDS = 30 # Measurement duration of each benchmark run
+BENCHMARK_YOLO_MODEL = "yolov8n-pose" # Model used by the rules of the synthetic cameras
 
 #Detector Module Preferences:
 POSE_DETECTION_VERBOSE = False
 
+#Inference Backend Module Preferences:
+INFERENCE_VERBOSE = False # Prints the ONNX export and quantization of the models
+INFERENCE_BACKENDS = {} # model_name -> "pytorch", "onnx", "onnx_static", "onnx_int8" or "onnx_static_int8". Models that are not listed use "pytorch". Compare a backend with ModelRegistry.compare_backend_to_pytorch before enabling it
+INFERENCE_IMAGE_SIZE = 640 # Input size of the exported ONNX models, frames are letterboxed to a square of this size
+INFERENCE_INTRA_OP_THREADS = 0 # Threads used by ONNX Runtime for a single inference, 0 lets ONNX Runtime decide (usually the number of physical cores)
+INFERENCE_EXECUTION_PROVIDERS = ["OpenVINOExecutionProvider", "CPUExecutionProvider"] # In order of preference, providers that are not installed are skipped. OpenVINO requires the onnxruntime-openvino package
+INFERENCE_MIN_CONFIDENCE = 0.25 # Person boxes below this score are dropped before NMS, same as the ultralytics default
+INFERENCE_NMS_IOU_THRESHOLD = 0.7 # Same as the ultralytics default
+INFERENCE_INT8_CALIBRATION_FRAMES_DIRECTORY = None # Folder of .jpg/.png frames saved from the cameras, used to calibrate the int8 models. None uses synthetic frames, which calibrate less accurately
+INFERENCE_INT8_CALIBRATION_NUMBER_OF_FRAMES = 64 # Frames used to calibrate the activation ranges of an int8 model
+
+#Model Registry Module Preferences:
+MODEL_REGISTRY_VERBOSE = False # Prints the loads and unloads of the models. Their load and warmup durations are exported as metrics
+MODEL_REGISTRY_WARMUP_FRAME_SIZE = (640, 480) # (width, height) of the blank frame used to warm up a model right after it is loaded
+MODEL_REGISTRY_IDLE_EVICTION_SECONDS = 600 # Models that are not used for this duration are released. None means never. Should be longer than EVALUATION_MAX_REVISIT_INTERVAL_SECONDS so that the models of the running cameras are kept
+MODEL_REGISTRY_EVICTION_CHECK_INTERVAL_SECONDS = 10 # How often the idle models are checked
+
 #Evaluation Module Preferences:
 NOT_USEFULL_DISCOUNT_FACTOR_FOR_EVALUATION_SCORE = 0.95 # Slowly decrease the camera's usefulness score if the frame is evaluated as not useful
 USEFUL_DISCOUNT_FACTOR_FOR_EVALUATION_SCORE = 0.90 # If a frame is evaluated as useful, the camera's score is 1. If it is evaluated as not useful, the camera's usefulness score is 0. The usefulness score is updated by -> usefulness_score = usefulness_score * DISCOUNT_FACTOR_FOR_EVALUATION_SCORE + evaluation_score
 
 MINIMUM_USEFULNESS_SCORE_TO_CONSIDER = 0.1 # The minimum usefulness score that a camera can have. If the camera's usefulness score is less than this value, it is set to this value
-MINIMUM_EVALUATION_PROBABILITY = 0.025 # The minimum probability that a camera will be evaluated. If the camera's calculated evaluation probability is less than this value, it is set to this value
-GEOMETRIC_R = 0.75 # The evaluation probability of a camera is calculated as a geometric series. The first term is 1, and the common ratio is this value. The probability is calculated as 1 + 1*EVALUATION_PROBABILITY_GEOMETRIC_SERIES_MULTIPLIER + 1*EVALUATION_PROBABILITY_GEOMETRIC_SERIES_MULTIPLIER^2 + ...
+EVALUATION_MINIMUM_CAMERA_WEIGHT = 0.1 # The share of the inference budget of a camera is proportional to this value plus its usefulness score, so that cameras with zero usefulness are still evaluated
+EVALUATION_BUDGET_MODE = "frames" # 'frames': the budget is EVALUATION_BUDGET_FRAMES_PER_SECOND, 'model_time': the budget is EVALUATION_BUDGET_MODEL_MS_PER_SECOND and each frame costs its measured inference duration
+EVALUATION_BUDGET_FRAMES_PER_SECOND = 10 # Maximum number of frames evaluated per second in 'frames' budget mode (overdue cameras are not limited by the budget)
+EVALUATION_BUDGET_MODEL_MS_PER_SECOND = 800 # Milliseconds of model inference allowed per second in 'model_time' budget mode
+EVALUATION_DEFAULT_INFERENCE_MS_PER_FRAME = 100 # Assumed inference duration of a model until it is measured, in 'model_time' budget mode
+EVALUATION_BUDGET_BURST_SECONDS = 1 # Unused budget is accumulated up to this many seconds worth of budget
+EVALUATION_MAX_FRAME_AGE_SECONDS = 5 # Frames older than this are not evaluated, the camera waits for a fresher frame instead
 EVALUATION_VERBOSE = False
+EVALUATION_MAX_BATCH_SIZE = 16 # Maximum number of frames that are evaluated in a single forward pass of a yolo model
+EVALUATION_BATCH_COLLECTION_TIMEOUT_SECONDS = 0.05 # Frames requiring the same yolo model are collected until the batch is full or this timeout is exceeded, then evaluated together
+
+EVALUATION_ROI_MODE = False # If True, inference runs only on the padded bounding box of the restricted areas of a camera instead of the full frame
+EVALUATION_ROI_PADDING_RATIO = 0.15 # The bounding box of the restricted areas is enlarged by this ratio of its width and height on each side so that people at the zone borders are not cropped
+EVALUATION_MOTION_SCORE_THRESHOLD = 0.002 # Frames whose motion score (ratio of changed pixels) is less than this value are not evaluated
+EVALUATION_MAX_REVISIT_INTERVAL_SECONDS = 60 # A camera is evaluated regardless of its motion score and the inference budget if it is not evaluated for this duration
+EVALUATION_REPORT_EACH_PERSON_ONCE = True # If True, a tracked person violating a rule is reported only in the first evaluation result, not in every evaluated frame
+
+#Tracker Module Preferences:
+TRACKER_MIN_IOU = 0.3 # A detection is associated with a track if the IoU of the detection and the predicted track box is at least this value
+TRACKER_MAX_RELATIVE_CENTROID_DISTANCE = 0.5 # Detections left unmatched by IoU are associated with a track if their centroid distance divided by the mean box diagonal is at most this value (for slowly evaluated cameras)
+TRACKER_VELOCITY_SMOOTHING = 0.5 # Weight of the newest measurement in the moving average of the track velocities
+TRACKER_MAX_TRACK_AGE_SECONDS = 10 # A track that is not matched for this duration is dropped. Its person gets a new track id if it is detected again
+TRACKER_MIN_HITS_TO_CONFIRM = 2 # A track needs this many matched detections before its prediction is trusted
+TRACKER_OUTSIDE_ZONES_MARGIN_RATIO = 0.5 # Predicted boxes are enlarged by this ratio of their width and height before checking that they are outside the restricted areas
+TRACKER_OUTSIDE_ZONES_WEIGHT_MULTIPLIER = 0.25 # The inference budget share of a camera is multiplied by this value while all of its people are confidently outside the restricted areas
+
+#Pipeline Module Preferences:
+PIPELINE_VERBOSE = False
+PIPELINE_CAMERA_QUEUE_SIZE = 1 # Number of not evaluated frames kept for each camera. When the queue is full, the oldest frame is dropped (latest frame wins)
+PIPELINE_RESULT_QUEUE_SIZE = 256 # Maximum number of evaluation results waiting to be processed by the result sinks
+PIPELINE_RESULT_QUEUE_PUT_TIMEOUT_SECONDS = 0.5 # If the result queue is full, the evaluation worker waits this long for the sinks to catch up before dropping the result
+PIPELINE_LATENCY_WINDOW_SIZE = 1000 # Number of most recent capture to evaluation latencies kept for the latency statistics
+PIPELINE_EVALUATION_ERROR_BACKOFF_SECONDS = 0.1 # Pause of the evaluation worker after an evaluation error, so that a frame that keeps failing does not spin the CPU
+
+#Event Store Module Preferences:
+EVENT_STORE_VERBOSE = False
+EVENT_STORE_QUEUE_SIZE = 10000 # Maximum number of violation events waiting to be written. When the queue is full, new events are dropped instead of blocking the caller
+EVENT_STORE_MAX_BATCH_SIZE = 500 # Maximum number of violation events written in a single transaction
+EVENT_STORE_BATCH_TIMEOUT_SECONDS = 1 # Events are collected until the batch is full or this timeout is exceeded, then written in a single transaction
+
+#Event Stream Module Preferences:
+EVENT_STREAM_SUBSCRIBER_QUEUE_SIZE = 100 # Maximum number of events waiting to be sent to a streaming client. When the queue is full, the oldest event is dropped
+EVENT_STREAM_KEEPALIVE_SECONDS = 15 # An idle Server-Sent Events connection receives a comment this often so that proxies do not close it
+
+#Snapshot Module Preferences:
+SNAPSHOT_JPEG_QUALITY = 80 # 0 to 100
+SNAPSHOT_WIDTHS = [320, 640, 1280] # Requested snapshot widths are rounded up to one of these values, wider requests get the original frame size
+SNAPSHOT_CACHE_MAX_BYTES = 64*1024*1024 # Total size of the encoded snapshots kept in the LRU cache
+SNAPSHOT_MAX_ENCODING_ATTEMPTS = 3 # In decoder process mode a frame can be overwritten while it is encoded, then the newer frame is encoded
+SNAPSHOT_MJPEG_POLL_INTERVAL_SECONDS = 0.1 # How often an MJPEG stream checks whether the camera has a new frame
+
+#Clip Recorder Module Preferences:
+CLIP_RECORDER_ENABLED = False # If True, safety_ai_main.py buffers the recent frames of the cameras and writes a clip around each violation. Not available in decoder process mode
+CLIP_RECORDER_VERBOSE = False
+CLIP_RECORDER_FPS = 5 # Frames per second added to the buffers, independently of the evaluation rate. Each added frame is decoded and encoded by the fetcher thread
+CLIP_RECORDER_FRAME_WIDTH = 640 # Wider frames are downscaled before encoding, None keeps the original size
+CLIP_RECORDER_JPEG_QUALITY = 70 # 0 to 100
+CLIP_RECORDER_PRE_EVENT_SECONDS = 5 # Seconds before the violation included in the clip
+CLIP_RECORDER_POST_EVENT_SECONDS = 5 # Seconds after the (last) violation included in the clip
+CLIP_RECORDER_MAX_CLIP_SECONDS = 60 # Violations keep extending the open clip of a camera up to this duration
+CLIP_RECORDER_MAX_BYTES_PER_CAMERA = 16*1024*1024 # Buffered JPEG bytes of a single camera
+CLIP_RECORDER_MAX_TOTAL_BYTES = 512*1024*1024 # Buffered JPEG bytes of all cameras, the oldest frames of any camera are evicted first when it is exceeded
+CLIP_RECORDER_WRITE_CHECK_INTERVAL_SECONDS = 0.5 # How often the writer thread checks for clips whose last frame is buffered
+CLIP_RECORDER_FOURCC = "mp4v" # Codec of the written .mp4 clips
+
+#Mosaic Module Preferences:
+MOSAIC_WINDOW_SIZE = (1280, 720) # (width, height) of the mosaic of all cameras in pixels
+MOSAIC_HEADLESS = False # If True, the mosaic is published as a JPEG buffer instead of being shown with cv2.imshow (required on servers without a display)
+MOSAIC_JPEG_QUALITY = 70 # 0 to 100, quality of the published mosaic in headless mode
+MOSAIC_RENDER_INTERVAL_SECONDS = 0.5 # How often the background renderer checks the cameras for new frames
+MOSAIC_RENDER_WITH_API = False # If True, safety_ai_main.py renders a headless mosaic in the background and the API serves it at /mosaic.jpg
+
+#Metrics Module Preferences:
+METRICS_VERBOSE = False # Prints the errors of the metrics collectors
+METRICS_DEFAULT_SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # Upper bounds of the duration histograms in seconds
+METRICS_BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32] # Upper bounds of the inference batch size histogram
+
+#Cluster Module Preferences:
+CLUSTER_VERBOSE = False
+CLUSTER_HEARTBEAT_INTERVAL_SECONDS = 2 # How often a worker sends its heartbeat, and receives its camera assignment if it changed
+CLUSTER_WORKER_TIMEOUT_SECONDS = 10 # A worker without a heartbeat for this long is removed and its cameras are reassigned. A worker that can not reach the coordinator for this long releases its cameras
+CLUSTER_REBALANCE_CHECK_INTERVAL_SECONDS = 1 # How often the coordinator checks the worker timeouts, the saturation of the workers and the static database
+CLUSTER_VIRTUAL_NODES_PER_CAPACITY = 8 # Virtual nodes on the hash ring per camera a worker can handle, more nodes spread the cameras more evenly
+CLUSTER_SATURATION_LATENCY_SECONDS = 1.0 # A worker whose p95 capture to evaluation latency exceeds this is saturated, the coordinator moves its cameras to the other workers one at a time
+CLUSTER_SATURATION_COOLDOWN_SECONDS = 30 # Minimum time between two capacity changes of a worker, so that the latency can settle after a camera is moved
+CLUSTER_SHARED_SECRET = None # Sent by the workers in the X-Cluster-Secret header. If None, the coordinator accepts the cluster requests from localhost only
+CLUSTER_REQUEST_TIMEOUT_SECONDS = 5 # Timeout of the HTTP requests of the workers
+CLUSTER_RESULT_QUEUE_SIZE = 1000 # Evaluation results waiting to be forwarded by a worker, new results are dropped when it is full
+CLUSTER_RESULT_MAX_BATCH_SIZE = 50 # Maximum number of evaluation results forwarded in one request
+CLUSTER_RESULT_BATCH_TIMEOUT_SECONDS = 0.2 # Maximum time a result waits for the batch to fill
 
+#API Module Preferences:
+API_RUN_WITH_EVALUATION = True # If True, safety_ai_main.py serves the API from the evaluation process, which is required for the live event streams
+API_HOST = "0.0.0.0"
+API_PORT = 8000
+API_TOKEN_CACHE_MAX_SIZE = 10000 # Maximum number of verified tokens kept in memory, each entry is dropped when its token expires
+API_USER_STORE_CHECK_INTERVAL_SECONDS = 2 # How often the modification time of static_database.json is checked, the users are reloaded if it changed
+API_METRICS_REQUIRE_TOKEN = True # If True, /metrics requires a bearer token like the other endpoints (set it in the scraper's authorization config)
@@ -0,0 +1,87 @@
+import threading, collections, concurrent.futures
+from typing import Dict, Tuple
+import cv2
+
+import server_preferences
+
+class JPEGSnapshotCache:
+    # JPEG snapshots of the latest frame of each camera, shared by all viewers
+    # - A frame is encoded at most once per size variant: concurrent requests for the same (camera, frame, width) wait for the encoding in progress
+    # - Encoded snapshots are kept in an LRU cache bounded by their total size in bytes
+    def __init__(self, stream_manager = None, max_cache_bytes:int = None) -> None:
+        self.stream_manager = stream_manager
+        self.max_cache_bytes = max_cache_bytes if max_cache_bytes is not None else server_preferences.SNAPSHOT_CACHE_MAX_BYTES
+        self.cache:collections.OrderedDict = collections.OrderedDict() # (camera_uuid, frame_uuid, width) -> jpeg bytes, least recently used first
+        self.cache_bytes = 0
+        self.encodings_in_progress:Dict[Tuple, concurrent.futures.Future] = {}
+        self.cache_lock = threading.Lock()
+        self.number_of_encodings = 0
+        self.number_of_cache_hits = 0
+
+    def attach_stream_manager(self, stream_manager = None) -> None:
+        self.stream_manager = stream_manager
+
+    def return_snapshot_width(self, requested_width:int = None) -> int:
+        # Requested widths are rounded up to one of the SNAPSHOT_WIDTHS so that the number of size variants per frame is bounded. None means the original size
+        if requested_width is None: return None
+        for snapshot_width in sorted(server_preferences.SNAPSHOT_WIDTHS):
+            if snapshot_width >= requested_width: return snapshot_width
+        return None
+
+    def return_latest_frame_uuid(self, camera_uuid:str = None) -> str:
+        # Cheap check for a new frame, does not encode
+        frame_info = self.stream_manager.return_last_frame_info(camera_uuid = camera_uuid) if self.stream_manager is not None else None
+        return frame_info["frame_uuid"] if frame_info is not None else None
+
+    def return_latest_jpeg(self, camera_uuid:str = None, requested_width:int = None) -> Tuple[str, bytes]:
+        # Returns (frame_uuid, jpeg bytes) of the latest frame of the camera, or (None, None) if the camera has no frame. Blocks while encoding, call it off the event loop
+        width = self.return_snapshot_width(requested_width = requested_width)
+        for _ in range(server_preferences.SNAPSHOT_MAX_ENCODING_ATTEMPTS):
+            frame_info = self.stream_manager.return_last_frame_info(camera_uuid = camera_uuid) if self.stream_manager is not None else None
+            if frame_info is None: return None, None
+
+            cache_key = (camera_uuid, frame_info["frame_uuid"], width)
+            with self.cache_lock:
+                if cache_key in self.cache:
+                    self.cache.move_to_end(cache_key)
+                    self.number_of_cache_hits += 1
+                    return frame_info["frame_uuid"], self.cache[cache_key]
+                encoding_future = self.encodings_in_progress.get(cache_key)
+                is_encoder = encoding_future is None
+                if is_encoder:
+                    encoding_future = concurrent.futures.Future()
+                    self.encodings_in_progress[cache_key] = encoding_future
+
+            if not is_encoder:
+                jpeg_bytes = encoding_future.result()
+                if jpeg_bytes is not None: return frame_info["frame_uuid"], jpeg_bytes
+                continue # The frame was overwritten while it was encoded, try the newer frame
+
+            jpeg_bytes = None
+            try:
+                jpeg_bytes = self.__encode_frame(frame = frame_info["frame"], width = width)
+                if not self.stream_manager.is_frame_valid(frame_info = frame_info): jpeg_bytes = None # Shared memory slot reused during encoding
+            finally:
+                with self.cache_lock:
+                    del self.encodings_in_progress[cache_key]
+                    if jpeg_bytes is not None: self.__add_to_cache(cache_key = cache_key, jpeg_bytes = jpeg_bytes)
+                encoding_future.set_result(jpeg_bytes)
+            if jpeg_bytes is not None: return frame_info["frame_uuid"], jpeg_bytes
+        return None, None
+
+    def __encode_frame(self, frame = None, width:int = None) -> bytes:
+        frame_height, frame_width = frame.shape[:2]
+        if width is not None and width < frame_width:
+            frame = cv2.resize(frame, (width, max(1, round(frame_height*width/frame_width))), interpolation=cv2.INTER_AREA)
+        is_success, jpeg_buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, server_preferences.SNAPSHOT_JPEG_QUALITY])
+        if not is_success: raise ValueError("JPEG encoding failed")
+        self.number_of_encodings += 1
+        return jpeg_buffer.tobytes()
+
+    def __add_to_cache(self, cache_key:Tuple = None, jpeg_bytes:bytes = None) -> None:
+        # Must be called with cache_lock held
+        self.cache[cache_key] = jpeg_bytes
+        self.cache_bytes += len(jpeg_bytes)
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+            _, evicted_jpeg_bytes = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted_jpeg_bytes)
@@ -0,0 +1,108 @@
+import time
+from typing import Tuple
+import numpy as np
+
+import server_preferences
+
+class MultiPersonTracker:
+    # Tracks the people of a single camera between inference passes. All tracks are stored as arrays and updated together
+    # - Association: greedy matching on IoU of the predicted boxes, then on centroid distance (relative to the box size) for the remaining ones
+    # - Prediction: constant velocity of the box corners, in pixels per second
+    def __init__(self) -> None:
+        self.track_ids = np.zeros((0,), dtype=np.int64)
+        self.boxes_xyxy = np.zeros((0, 4), dtype=np.float32)
+        self.velocities_xyxy = np.zeros((0, 4), dtype=np.float32) # pixels per second
+        self.last_update_times = np.zeros((0,), dtype=np.float64)
+        self.number_of_hits = np.zeros((0,), dtype=np.int32)
+        self.next_track_id = 0
+
+    def __len__(self) -> int:
+        return len(self.track_ids)
+
+    def predict(self, timestamp:float = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the track ids and their predicted [x1,y1,x2,y2] boxes at the given timestamp
+        timestamp = timestamp if timestamp is not None else time.time()
+        elapsed_seconds = (timestamp - self.last_update_times).astype(np.float32)[:, np.newaxis]
+        return self.track_ids.copy(), self.boxes_xyxy + self.velocities_xyxy*elapsed_seconds
+
+    def update(self, bboxes_xyxy:np.ndarray = None, timestamp:float = None) -> np.ndarray:
+        # Associates the detections of a frame with the tracks and returns the track id of each detection
+        _, predicted_boxes = self.predict(timestamp = timestamp)
+        detection_track_indexes = np.full((len(bboxes_xyxy),), -1, dtype=np.int64)
+
+        if len(self) > 0 and len(bboxes_xyxy) > 0:
+            iou_scores = self.__return_iou_matrix(predicted_boxes, bboxes_xyxy)
+            self.__match_greedily(scores = iou_scores, min_score = server_preferences.TRACKER_MIN_IOU, detection_track_indexes = detection_track_indexes)
+
+            centroid_scores = -self.__return_relative_centroid_distances(predicted_boxes, bboxes_xyxy) # higher is better
+            self.__match_greedily(scores = centroid_scores, min_score = -server_preferences.TRACKER_MAX_RELATIVE_CENTROID_DISTANCE, detection_track_indexes = detection_track_indexes)
+
+        # Update the matched tracks
+        is_matched = detection_track_indexes >= 0
+        matched_track_indexes = detection_track_indexes[is_matched]
+        if len(matched_track_indexes) > 0:
+            elapsed_seconds = np.maximum(timestamp - self.last_update_times[matched_track_indexes], 1e-3).astype(np.float32)[:, np.newaxis]
+            measured_velocities = (bboxes_xyxy[is_matched] - self.boxes_xyxy[matched_track_indexes]) / elapsed_seconds
+            smoothing = server_preferences.TRACKER_VELOCITY_SMOOTHING
+            # The first match of a track gives its first velocity measurement, the next ones are smoothed
+            self.velocities_xyxy[matched_track_indexes] = np.where(self.number_of_hits[matched_track_indexes, np.newaxis] > 1, (1-smoothing)*self.velocities_xyxy[matched_track_indexes] + smoothing*measured_velocities, measured_velocities)
+            self.boxes_xyxy[matched_track_indexes] = bboxes_xyxy[is_matched]
+            self.last_update_times[matched_track_indexes] = timestamp
+            self.number_of_hits[matched_track_indexes] += 1
+
+        # Drop the tracks that are not seen for a while
+        is_track_expired = (timestamp - self.last_update_times) > server_preferences.TRACKER_MAX_TRACK_AGE_SECONDS
+        detection_track_ids = np.full((len(bboxes_xyxy),), -1, dtype=np.int64)
+        detection_track_ids[is_matched] = self.track_ids[matched_track_indexes]
+        self.__keep_tracks(~is_track_expired)
+
+        # Start new tracks for the unmatched detections
+        number_of_new_tracks = int(np.count_nonzero(~is_matched))
+        if number_of_new_tracks > 0:
+            new_track_ids = np.arange(self.next_track_id, self.next_track_id+number_of_new_tracks, dtype=np.int64)
+            self.next_track_id += number_of_new_tracks
+            detection_track_ids[~is_matched] = new_track_ids
+
+            self.track_ids = np.concatenate([self.track_ids, new_track_ids])
+            self.boxes_xyxy = np.concatenate([self.boxes_xyxy, bboxes_xyxy[~is_matched].astype(np.float32)])
+            self.velocities_xyxy = np.concatenate([self.velocities_xyxy, np.zeros((number_of_new_tracks, 4), dtype=np.float32)])
+            self.last_update_times = np.concatenate([self.last_update_times, np.full((number_of_new_tracks,), timestamp, dtype=np.float64)])
+            self.number_of_hits = np.concatenate([self.number_of_hits, np.ones((number_of_new_tracks,), dtype=np.int32)])
+
+        return detection_track_ids
+
+    def __keep_tracks(self, is_kept:np.ndarray = None) -> None:
+        self.track_ids = self.track_ids[is_kept]
+        self.boxes_xyxy = self.boxes_xyxy[is_kept]
+        self.velocities_xyxy = self.velocities_xyxy[is_kept]
+        self.last_update_times = self.last_update_times[is_kept]
+        self.number_of_hits = self.number_of_hits[is_kept]
+
+    def __match_greedily(self, scores:np.ndarray = None, min_score:float = None, detection_track_indexes:np.ndarray = None) -> None:
+        # Repeatedly takes the best (track, detection) pair among the unmatched ones. Each step is a single argmax over the score matrix
+        scores = scores.astype(np.float32, copy=True)
+        scores[np.isin(np.arange(scores.shape[0]), detection_track_indexes[detection_track_indexes >= 0])] = -np.inf
+        scores[:, detection_track_indexes >= 0] = -np.inf
+        for _ in range(min(scores.shape)):
+            track_index, detection_index = np.unravel_index(np.argmax(scores), scores.shape)
+            if scores[track_index, detection_index] < min_score: break
+            detection_track_indexes[detection_index] = track_index
+            scores[track_index, :] = -np.inf
+            scores[:, detection_index] = -np.inf
+
+    def __return_iou_matrix(self, boxes_a:np.ndarray = None, boxes_b:np.ndarray = None) -> np.ndarray:
+        top_left = np.maximum(boxes_a[:, np.newaxis, 0:2], boxes_b[np.newaxis, :, 0:2])
+        bottom_right = np.minimum(boxes_a[:, np.newaxis, 2:4], boxes_b[np.newaxis, :, 2:4])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+        area_a = np.prod(boxes_a[:, 2:4] - boxes_a[:, 0:2], axis=1)
+        area_b = np.prod(boxes_b[:, 2:4] - boxes_b[:, 0:2], axis=1)
+        return intersection / np.maximum(area_a[:, np.newaxis] + area_b[np.newaxis, :] - intersection, 1e-6)
+
+    def __return_relative_centroid_distances(self, boxes_a:np.ndarray = None, boxes_b:np.ndarray = None) -> np.ndarray:
+        # Centroid distance divided by the mean diagonal of the two boxes, so that the threshold does not depend on the distance of the person to the camera
+        centroids_a = (boxes_a[:, 0:2] + boxes_a[:, 2:4]) / 2
+        centroids_b = (boxes_b[:, 0:2] + boxes_b[:, 2:4]) / 2
+        diagonals_a = np.linalg.norm(boxes_a[:, 2:4] - boxes_a[:, 0:2], axis=1)
+        diagonals_b = np.linalg.norm(boxes_b[:, 2:4] - boxes_b[:, 0:2], axis=1)
+        distances = np.linalg.norm(centroids_a[:, np.newaxis] - centroids_b[np.newaxis, :], axis=2)
+        return distances / np.maximum((diagonals_a[:, np.newaxis] + diagonals_b[np.newaxis, :]) / 2, 1e-6)
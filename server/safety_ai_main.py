@@ -1,5 +1,5 @@
 # Built-in imports
-import pprint, time, sys, os
+import pprint, time, sys, os, threading, argparse, socket
 
 # Local imports
 project_directory = os.path.dirname(os.path.abspath(__file__))
@@ -8,16 +8,162 @@ sys.path.append(modules_directory) # Add the modules directory to the system pat
 
 import camera_module
 import evaluation_module
+import pipeline_module
+import event_store_module
+import cluster_module
+import clip_recorder_module
+import server_preferences
 
-stream_manager = camera_module.StreamManager()
-stream_manager.start_cameras_by_uuid(camera_uuids = []) # Start all cameras
+def run_cluster_coordinator(camera_configs_json_path:str = None, api_port:int = None):
+    # The coordinator does not fetch or evaluate any camera: it assigns the cameras to the workers, persists their results and serves the API
+    # The live frames of the cameras (snapshots, MJPEG streams, mosaic) are served by the workers, see run_cluster_worker
+    import uvicorn
+    import API_module
+    def on_camera_configs_reloaded(camera_configs):
+        API_module.EVENT_BROADCASTER.set_camera_regions(camera_regions = {camera_uuid: camera_config["camera_region"] for camera_uuid, camera_config in camera_configs.items()})
+    cluster_coordinator = cluster_module.ClusterCoordinator(camera_configs_json_path = camera_configs_json_path, on_camera_configs_reloaded = on_camera_configs_reloaded)
+    violation_event_store = event_store_module.ViolationEventStore()
+    cluster_coordinator.add_result_sink(result_sink = violation_event_store.add_evaluation_result)
+    cluster_coordinator.add_result_sink(result_sink = API_module.EVENT_BROADCASTER.publish_evaluation_result)
+    API_module.CLUSTER_COORDINATOR = cluster_coordinator
+    cluster_coordinator.start()
 
-evaluation_manager = evaluation_module.EvaluationManager(yolo_models_to_be_used = stream_manager.return_yolo_models_to_use())
+    api_server = uvicorn.Server(uvicorn.Config(API_module.app, host = server_preferences.API_HOST, port = api_port))
+    api_thread = threading.Thread(target=api_server.run)
+    api_thread.daemon = True
+    api_thread.start()
 
-while True:
-    stream_manager.optimize_camera_fetching_delays()        
-    stream_manager.test_show_all_frames(window_size=(1280, 720))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        api_server.should_exit = True
+        cluster_coordinator.stop()
+        violation_event_store.close()
 
-    evaluated_uuids, evaluation_results = evaluation_manager.evaluate_frames_info(frames_info = stream_manager.return_all_not_evaluated_frames_info())
-    stream_manager.update_frame_evaluations(evaluated_frame_uuids = evaluated_uuids)
-    
\ No newline at end of file
+def run_cluster_worker(worker_id:str = None, coordinator_url:str = None, capacity:int = None, api_port:int = None, api_url:str = None):
+    # The worker starts without cameras, they are assigned by the coordinator. Its results are forwarded to the coordinator instead of being persisted here
+    # If API_RUN_WITH_EVALUATION is set, the worker serves the snapshots, MJPEG streams, mosaic and events of its own cameras on api_port, and advertises api_url to the coordinator
+    # Tokens are signed with a key of each server, so clients log in to the worker API separately
+    stream_manager = camera_module.StreamManager(camera_configs = [])
+    evaluation_manager = evaluation_module.EvaluationManager(yolo_models_to_be_used = [])
+    evaluation_pipeline = pipeline_module.EvaluationPipeline(stream_manager = stream_manager, evaluation_manager = evaluation_manager)
+
+    def on_camera_configs_reconciled(changes):
+        evaluation_manager.forget_cameras(camera_uuids = changes["removed"] + changes["restarted"])
+        evaluation_manager.forget_cameras(camera_uuids = changes["updated"], is_rule_state_only = True)
+        evaluation_manager.update_models(yolo_models_to_use = stream_manager.return_yolo_models_to_use())
+        if server_preferences.API_RUN_WITH_EVALUATION:
+            API_module.EVENT_BROADCASTER.set_camera_regions(camera_regions = {camera.camera_uuid: camera.camera_region for camera in stream_manager.cameras})
+    cluster_worker = cluster_module.ClusterWorker(worker_id = worker_id, coordinator_url = coordinator_url, capacity = capacity, api_url = api_url if server_preferences.API_RUN_WITH_EVALUATION else None, stream_manager = stream_manager, evaluation_pipeline = evaluation_pipeline, on_camera_configs_reconciled = on_camera_configs_reconciled)
+    evaluation_pipeline.add_result_sink(result_sink = cluster_worker.add_evaluation_result)
+
+    clip_recorder = None
+    if server_preferences.CLIP_RECORDER_ENABLED: # Clips are written to the disk of the worker
+        clip_recorder = clip_recorder_module.ClipRecorder()
+        stream_manager.attach_clip_recorder(clip_recorder = clip_recorder)
+        evaluation_pipeline.add_result_sink(result_sink = clip_recorder.add_evaluation_result)
+
+    if server_preferences.API_RUN_WITH_EVALUATION:
+        import uvicorn
+        import API_module
+        evaluation_pipeline.add_result_sink(result_sink = API_module.EVENT_BROADCASTER.publish_evaluation_result)
+        API_module.JPEG_SNAPSHOT_CACHE.attach_stream_manager(stream_manager = stream_manager)
+        if server_preferences.MOSAIC_RENDER_WITH_API: API_module.MOSAIC_RENDERER.start_rendering(stream_manager = stream_manager)
+
+        api_server = uvicorn.Server(uvicorn.Config(API_module.app, host = server_preferences.API_HOST, port = api_port))
+        api_thread = threading.Thread(target=api_server.run)
+        api_thread.daemon = True
+        api_thread.start()
+
+    evaluation_pipeline.start()
+    stream_manager.start_cameras_by_uuid(camera_uuids = []) # Starts the supervisor, the cameras are started as they are assigned
+    cluster_worker.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        cluster_worker.stop() # Leaves the cluster so that the cameras are reassigned right away
+        if server_preferences.API_RUN_WITH_EVALUATION:
+            API_module.MOSAIC_RENDERER.stop_rendering()
+            api_server.should_exit = True
+        evaluation_pipeline.stop()
+        if clip_recorder is not None: clip_recorder.close()
+        stream_manager.stop_supervisor()
+        stream_manager.stop_cameras_by_uuid(camera_uuids = []) # Stop all cameras
+
+if __name__ == "__main__": # Required since the decoder processes are spawned, which imports this module again
+    parser = argparse.ArgumentParser(description = "Runs the safety AI server. By default a single server fetches and evaluates all cameras")
+    parser.add_argument("--cluster-role", choices = ["standalone", "coordinator", "worker"], default = "standalone", help = "coordinator: assigns the cameras to the workers and serves the API, worker: evaluates the cameras assigned by the coordinator")
+    parser.add_argument("--worker-id", default = None, help = "Unique name of the worker, defaults to <hostname>-<pid>")
+    parser.add_argument("--coordinator-url", default = f"http://127.0.0.1:{server_preferences.API_PORT}", help = "API address of the coordinator")
+    parser.add_argument("--capacity", type = int, default = 4, help = "Maximum number of cameras the worker evaluates")
+    parser.add_argument("--api-port", type = int, default = server_preferences.API_PORT, help = "Port of the API of the coordinator or the worker, workers on the same machine need different ports")
+    parser.add_argument("--api-url", default = None, help = "Address of the worker API advertised to the coordinator, defaults to http://<hostname>:<api-port>")
+    parser.add_argument("--camera-configs-json", default = None, help = "Camera configs of the coordinator, defaults to the static database")
+    args = parser.parse_args()
+
+    if args.cluster_role == "coordinator":
+        run_cluster_coordinator(camera_configs_json_path = args.camera_configs_json if args.camera_configs_json is not None else camera_module.return_camera_configs_json_path(), api_port = args.api_port)
+        sys.exit(0)
+    if args.cluster_role == "worker":
+        run_cluster_worker(worker_id = args.worker_id if args.worker_id is not None else f"{socket.gethostname()}-{os.getpid()}", coordinator_url = args.coordinator_url, capacity = args.capacity, api_port = args.api_port, api_url = args.api_url if args.api_url is not None else f"http://{socket.gethostname()}:{args.api_port}")
+        sys.exit(0)
+
+    stream_manager = camera_module.StreamManager()
+    stream_manager.start_cameras_by_uuid(camera_uuids = []) # Start all cameras
+
+    evaluation_manager = evaluation_module.EvaluationManager(yolo_models_to_be_used = stream_manager.return_yolo_models_to_use())
+
+    # Fetcher threads push new frames to the pipeline, which evaluates them as soon as they arrive
+    evaluation_pipeline = pipeline_module.EvaluationPipeline(stream_manager = stream_manager, evaluation_manager = evaluation_manager)
+
+    # Violations are persisted in batches by the event store's writer thread
+    violation_event_store = event_store_module.ViolationEventStore()
+    evaluation_pipeline.add_result_sink(result_sink = violation_event_store.add_evaluation_result)
+
+    # Clips around the violations are written by the clip recorder's writer thread
+    clip_recorder = None
+    if server_preferences.CLIP_RECORDER_ENABLED:
+        clip_recorder = clip_recorder_module.ClipRecorder()
+        stream_manager.attach_clip_recorder(clip_recorder = clip_recorder)
+        evaluation_pipeline.add_result_sink(result_sink = clip_recorder.add_evaluation_result)
+
+    # The API runs in this process so that the evaluation results can be streamed to its clients without polling
+    if server_preferences.API_RUN_WITH_EVALUATION:
+        import uvicorn
+        import API_module
+        API_module.EVENT_BROADCASTER.set_camera_regions(camera_regions = {camera.camera_uuid: camera.camera_region for camera in stream_manager.cameras})
+        evaluation_pipeline.add_result_sink(result_sink = API_module.EVENT_BROADCASTER.publish_evaluation_result)
+        API_module.JPEG_SNAPSHOT_CACHE.attach_stream_manager(stream_manager = stream_manager)
+        if server_preferences.MOSAIC_RENDER_WITH_API: API_module.MOSAIC_RENDERER.start_rendering(stream_manager = stream_manager)
+
+        api_server = uvicorn.Server(uvicorn.Config(API_module.app, host = server_preferences.API_HOST, port = server_preferences.API_PORT))
+        api_thread = threading.Thread(target=api_server.run)
+        api_thread.daemon = True
+        api_thread.start()
+
+    evaluation_pipeline.start()
+
+    # Camera and rule changes in the static database are applied without a restart
+    def on_camera_configs_reconciled(changes):
+        evaluation_manager.forget_cameras(camera_uuids = changes["removed"] + changes["restarted"])
+        evaluation_manager.forget_cameras(camera_uuids = changes["updated"], is_rule_state_only = True)
+        evaluation_manager.update_models(yolo_models_to_use = stream_manager.return_yolo_models_to_use())
+        if server_preferences.API_RUN_WITH_EVALUATION:
+            API_module.EVENT_BROADCASTER.set_camera_regions(camera_regions = {camera.camera_uuid: camera.camera_region for camera in stream_manager.cameras})
+    stream_manager.start_config_watcher(on_camera_configs_reconciled = on_camera_configs_reconciled)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stream_manager.stop_config_watcher()
+        if server_preferences.API_RUN_WITH_EVALUATION:
+            API_module.MOSAIC_RENDERER.stop_rendering()
+            api_server.should_exit = True
+        evaluation_pipeline.stop()
+        violation_event_store.close()
+        if clip_recorder is not None: clip_recorder.close()
+        stream_manager.stop_supervisor()
+        stream_manager.stop_cameras_by_uuid(camera_uuids = []) # Stop all cameras
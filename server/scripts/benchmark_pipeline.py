@@ -0,0 +1,27 @@
+import sys, os, json, argparse
+
+project_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_directory)
+sys.path.append(os.path.join(project_directory, "modules")) # Add the modules directory to the system path so that imports work
+import benchmark_module
+
+# Example: python scripts/benchmark_pipeline.py --cameras 1 2 4 8 --output benchmark.json
+argument_parser = argparse.ArgumentParser(description="End-to-end throughput benchmark on synthetic cameras")
+argument_parser.add_argument("--cameras", type=int, nargs="+", default=[1, 2, 4], help="Numbers of simulated cameras, one run for each")
+argument_parser.add_argument("--fps", type=float, default=None)
+argument_parser.add_argument("--frame-size", type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"))
+argument_parser.add_argument("--people", type=int, default=None, help="Number of simulated people per camera")
+argument_parser.add_argument("--video", default=None, help="Replay this video file instead of generating frames")
+argument_parser.add_argument("--model", default=None)
+argument_parser.add_argument("--warmup", type=float, default=None, help="Seconds")
+argument_parser.add_argument("--duration", type=float, default=None, help="Seconds")
+argument_parser.add_argument("--output", default=None, help="JSON file to write the results to, printed if not set")
+arguments = argument_parser.parse_args()
+
+pipeline_benchmark = benchmark_module.PipelineBenchmark(fps = arguments.fps, frame_size = arguments.frame_size, number_of_people = arguments.people, video_path = arguments.video, yolo_model_to_use = arguments.model)
+benchmark_results = pipeline_benchmark.run_camera_sweep(camera_counts = arguments.cameras, warmup_seconds = arguments.warmup, duration_seconds = arguments.duration)
+if arguments.output is None:
+    print(json.dumps(benchmark_results, indent=4))
+else:
+    with open(arguments.output, "w") as f:
+        json.dump(benchmark_results, f, indent=4)
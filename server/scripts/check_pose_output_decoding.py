@@ -0,0 +1,32 @@
+import sys, os
+import numpy as np
+
+project_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_directory)
+sys.path.append(os.path.join(project_directory, "modules")) # Add the modules directory to the system path so that imports work
+import inference_backend_module
+
+# Checks the decoding of the raw YOLOv8 pose outputs used by the ONNX backends, without onnxruntime or a model file
+# Run it after changing inference_backend_module.decode_pose_output: python scripts/check_pose_output_decoding.py
+NUMBER_OF_KEYPOINTS = 17
+NUMBER_OF_ANCHORS = 8400
+letterbox_transform = (0.5, 0, 80) # A 1280x960 frame letterboxed to 640x640
+
+# A blank frame (e.g. the warmup of the backends): no anchor is above the confidence threshold
+output = np.zeros((5 + NUMBER_OF_KEYPOINTS*3, NUMBER_OF_ANCHORS), dtype=np.float32)
+boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = inference_backend_module.decode_pose_output(output = output, letterbox_transform = letterbox_transform)
+assert boxes_cls.shape == (0,) and boxes_conf.shape == (0,), (boxes_cls.shape, boxes_conf.shape)
+assert boxes_xyxy.shape == (0, 4), boxes_xyxy.shape
+assert keypoints_xy.shape == (0, NUMBER_OF_KEYPOINTS, 2) and keypoints_conf.shape == (0, NUMBER_OF_KEYPOINTS), (keypoints_xy.shape, keypoints_conf.shape)
+print("Empty output: OK")
+
+# A single person centered at (320, 320) of the model input, twice on neighbouring anchors so that NMS keeps one of them
+for anchor_index in [100, 101]:
+    output[0:5, anchor_index] = [320, 320, 100, 200, 0.9]
+    output[5:, anchor_index] = np.tile([320, 320, 0.9], NUMBER_OF_KEYPOINTS)
+output[5 + 3*0 + 2, 100:102] = 0.1 # The first keypoint is not visible
+boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = inference_backend_module.decode_pose_output(output = output, letterbox_transform = letterbox_transform)
+assert boxes_xyxy.shape == (1, 4) and keypoints_xy.shape == (1, NUMBER_OF_KEYPOINTS, 2), (boxes_xyxy.shape, keypoints_xy.shape)
+assert np.allclose(boxes_xyxy[0], [540, 280, 740, 680]), boxes_xyxy[0]
+assert np.allclose(keypoints_xy[0, 0], [0, 0]) and np.allclose(keypoints_xy[0, 1], [640, 480]), keypoints_xy[0, :2]
+print("Single person output: OK")
@@ -0,0 +1,21 @@
+import sys, os, glob, pprint, time, uuid
+import cv2
+
+project_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_directory)
+sys.path.append(os.path.join(project_directory, "modules")) # Add the modules directory to the system path so that imports work
+import model_registry_module
+
+model_name = input(f"Enter the model name {model_registry_module.ModelRegistry.AVAILABLE_MODELS}: ")
+backend = input("Enter the backend to compare with pytorch (onnx, onnx_static, onnx_int8, onnx_static_int8): ")
+images_folder = input("Enter the folder of the test images (.jpg/.png): ")
+
+frames_info = []
+for image_path in sorted(glob.glob(os.path.join(images_folder, "*.jpg")) + glob.glob(os.path.join(images_folder, "*.png"))):
+    frame = cv2.imread(image_path)
+    if frame is None: continue
+    frames_info.append({"frame": frame, "camera_uuid": "comparison", "frame_uuid": str(uuid.uuid4()), "frame_timestamp": time.time()})
+print(f"{len(frames_info)} images are loaded")
+
+model_registry = model_registry_module.ModelRegistry()
+pprint.pprint(model_registry.compare_backend_to_pytorch(model_name = model_name, backend = backend, frames_info = frames_info))
@@ -0,0 +1,82 @@
+import sys, os, json, argparse, time, signal, subprocess, tempfile, urllib.request, urllib.error
+
+project_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_directory)
+sys.path.append(os.path.join(project_directory, "modules")) # Add the modules directory to the system path so that imports work
+import frame_source_module
+import server_preferences
+
+# Starts a coordinator and two workers on this machine with synthetic cameras, checks that all cameras are assigned and that each worker serves an API,
+# then stops one worker and checks that its cameras move to the other one. The cluster requests come from localhost, so no CLUSTER_SHARED_SECRET is needed
+# Example: python scripts/run_local_cluster.py --cameras 4 --capacity 4
+argument_parser = argparse.ArgumentParser(description="Runs a coordinator and two workers on localhost")
+argument_parser.add_argument("--cameras", type=int, default=4, help="Number of synthetic cameras")
+argument_parser.add_argument("--capacity", type=int, default=4, help="Capacity of each worker, use at least --cameras so that one worker can take all cameras")
+argument_parser.add_argument("--model", default=server_preferences.BENCHMARK_YOLO_MODEL)
+argument_parser.add_argument("--coordinator-port", type=int, default=8100)
+argument_parser.add_argument("--worker-ports", type=int, nargs=2, default=[8101, 8102])
+argument_parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for each cluster state")
+arguments = argument_parser.parse_args()
+
+coordinator_url = f"http://127.0.0.1:{arguments.coordinator_port}"
+main_path = os.path.join(project_directory, "safety_ai_main.py")
+
+def return_cluster_status():
+    headers = {"X-Cluster-Secret": server_preferences.CLUSTER_SHARED_SECRET} if server_preferences.CLUSTER_SHARED_SECRET is not None else {}
+    with urllib.request.urlopen(urllib.request.Request(coordinator_url + "/cluster/status", headers=headers), timeout=5) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+def wait_for_cluster_status(description:str = None, condition = None):
+    deadline = time.time() + arguments.timeout
+    while time.time() < deadline:
+        try:
+            cluster_status = return_cluster_status()
+            if condition(cluster_status):
+                print(f"{description}: {json.dumps({worker_id: worker['camera_uuids'] for worker_id, worker in cluster_status['workers'].items()})}")
+                return cluster_status
+        except OSError: # The coordinator is not listening yet
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"Timed out while waiting for: {description}")
+
+def is_worker_api_up(api_url:str = None) -> bool:
+    # Any HTTP response (e.g. 401 without a token) means the API is listening
+    try:
+        urllib.request.urlopen(api_url + "/users/me/", timeout=5)
+    except urllib.error.HTTPError:
+        return True
+    except OSError:
+        return False
+    return True
+
+camera_configs = frame_source_module.return_synthetic_camera_configs(number_of_cameras = arguments.cameras, yolo_model_to_use = arguments.model)
+camera_configs_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+json.dump({"cameras": camera_configs}, camera_configs_file)
+camera_configs_file.close()
+
+processes = {}
+try:
+    processes["coordinator"] = subprocess.Popen([sys.executable, main_path, "--cluster-role", "coordinator", "--api-port", str(arguments.coordinator_port), "--camera-configs-json", camera_configs_file.name])
+    for worker_index, worker_port in enumerate(arguments.worker_ports):
+        worker_id = f"local-worker-{worker_index}"
+        processes[worker_id] = subprocess.Popen([sys.executable, main_path, "--cluster-role", "worker", "--worker-id", worker_id, "--coordinator-url", coordinator_url, "--capacity", str(arguments.capacity), "--api-port", str(worker_port), "--api-url", f"http://127.0.0.1:{worker_port}"])
+
+    cluster_status = wait_for_cluster_status(description = "All cameras are assigned to the two workers", condition = lambda cluster_status: len(cluster_status["workers"]) == 2 and len(cluster_status["camera_api_urls"]) == cluster_status["number_of_cameras"] == arguments.cameras)
+    for worker_id, worker in cluster_status["workers"].items():
+        if not is_worker_api_up(api_url = worker["api_url"]): raise RuntimeError(f"The API of {worker_id} does not answer at {worker['api_url']}")
+        print(f"{worker_id} serves the frames of its {len(worker['camera_uuids'])} cameras at {worker['api_url']}")
+
+    processes["local-worker-0"].send_signal(signal.SIGINT) # The worker leaves the cluster on its way out
+    processes["local-worker-0"].wait(timeout=arguments.timeout)
+    wait_for_cluster_status(description = "The cameras of local-worker-0 are reassigned", condition = lambda cluster_status: list(cluster_status["workers"].keys()) == ["local-worker-1"] and len(cluster_status["camera_api_urls"]) == min(arguments.cameras, arguments.capacity))
+    print(f"Violation results received by the coordinator: {return_cluster_status()['number_of_results_received']}")
+    print("Local cluster: OK")
+finally:
+    for process in processes.values():
+        if process.poll() is None: process.send_signal(signal.SIGINT)
+    for process in processes.values():
+        try:
+            process.wait(timeout=arguments.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    os.remove(camera_configs_file.name)
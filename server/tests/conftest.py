@@ -0,0 +1,5 @@
+import sys, os
+
+project_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_directory)
+sys.path.append(os.path.join(project_directory, "modules")) # Add the modules directory to the system path so that imports work
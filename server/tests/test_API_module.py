@@ -0,0 +1,43 @@
+import json, os
+from pathlib import Path
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("jwt")
+if not (Path(__file__).resolve().parent.parent / "configs" / "static_database.json").exists(): # Read by encryption_module when it is imported
+    pytest.skip("configs/static_database.json is required to import API_module", allow_module_level=True)
+import API_module
+
+def write_user_database(database_json_path:Path = None, user_dicts:dict = None, mtime_ns:int = None) -> None:
+    with open(database_json_path, "w") as f:
+        json.dump({"user_db": user_dicts}, f)
+    if mtime_ns is not None: os.utime(database_json_path, ns=(mtime_ns, mtime_ns)) # The mtime may not change between two writes in the same clock tick
+
+def test_missing_user_database_keeps_the_current_users(tmp_path):
+    database_json_path = tmp_path / "static_database.json"
+    user_store = API_module.UserStore(database_json_path) # The file is being replaced when the server starts
+    assert user_store.users == {}
+
+    write_user_database(database_json_path = database_json_path, user_dicts = {"alice": {"username": "alice", "allowed_tos": ["read"]}})
+    user_store.reload_if_changed(force=True)
+    assert user_store.users["alice"].allowed_tos == ["read"]
+
+    os.remove(database_json_path)
+    user_store.reload_if_changed(force=True)
+    assert user_store.users["alice"].allowed_tos == ["read"]
+
+def test_changed_user_is_checked_before_the_token_issue_time(tmp_path, monkeypatch):
+    database_json_path = tmp_path / "static_database.json"
+    write_user_database(database_json_path = database_json_path, user_dicts = {"alice": {"username": "alice", "allowed_tos": ["read"]}}, mtime_ns = 1_000_000_000)
+    user_store = API_module.UserStore(database_json_path)
+    monkeypatch.setattr(API_module, "USER_STORE", user_store)
+
+    token = API_module.create_access_token(data = {"sub": "alice"})
+    assert API_module.get_user_from_token(token).allowed_tos == ["read"]
+
+    # The permissions of the user change: the next request with the old token is rejected, not the one after it
+    write_user_database(database_json_path = database_json_path, user_dicts = {"alice": {"username": "alice", "allowed_tos": []}}, mtime_ns = 2_000_000_000)
+    user_store.last_check_time = 0
+    with pytest.raises(API_module.HTTPException) as exception_info:
+        API_module.get_user_from_token(token)
+    assert exception_info.value.status_code == 401
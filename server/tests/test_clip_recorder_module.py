@@ -0,0 +1,78 @@
+import json, time
+import numpy as np
+import pytest
+
+import clip_recorder_module
+
+class EvaluationResult:
+    # The attributes of a PoseDetectionsRecord that the clip recorder reads
+    def __init__(self, camera_uuid:str = None, frame_timestamp:float = None, rule_name:str = None) -> None:
+        self.camera_uuid = camera_uuid
+        self.frame_uuid = f"{camera_uuid}-{frame_timestamp}"
+        self.frame_timestamp = frame_timestamp
+        self.rule_name = rule_name
+
+    def __len__(self) -> int:
+        return 1
+
+@pytest.fixture
+def return_clip_recorder(tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_recorder_module.server_preferences, "CLIP_RECORDER_WRITE_CHECK_INTERVAL_SECONDS", 0.02)
+    clip_recorders = []
+    def return_clip_recorder(max_total_bytes:int = None) -> clip_recorder_module.ClipRecorder:
+        clip_recorders.append(clip_recorder_module.ClipRecorder(clip_directory = tmp_path / "clips", max_total_bytes = max_total_bytes))
+        return clip_recorders[-1]
+    yield return_clip_recorder
+    for clip_recorder in clip_recorders:
+        if clip_recorder.writer_thread.is_alive(): clip_recorder.close()
+
+def return_frame(seed:int = None) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+
+def assert_byte_accounting_is_exact(clip_recorder:clip_recorder_module.ClipRecorder = None) -> None:
+    for camera_uuid, camera_buffer in clip_recorder.camera_buffers.items():
+        assert clip_recorder.camera_buffer_bytes[camera_uuid] == sum(len(jpeg_bytes) for _, jpeg_bytes in camera_buffer)
+    assert clip_recorder.total_bytes == sum(clip_recorder.camera_buffer_bytes.values())
+
+def test_oldest_frames_of_all_cameras_are_evicted_under_the_total_cap(return_clip_recorder):
+    clip_recorder = return_clip_recorder(max_total_bytes = 20000)
+    frame_timestamps = []
+    for frame_index in range(30):
+        frame_timestamps.append(time.time() - 3 + frame_index*0.1)
+        clip_recorder.add_frame(camera_uuid = f"camera_{frame_index % 2}", frame = return_frame(seed = frame_index), frame_timestamp = frame_timestamps[-1])
+        assert clip_recorder.total_bytes <= 20000
+        assert_byte_accounting_is_exact(clip_recorder = clip_recorder)
+    buffered_timestamps = sorted(frame_timestamp for camera_buffer in clip_recorder.camera_buffers.values() for frame_timestamp, _ in camera_buffer)
+    assert clip_recorder.number_of_frames_evicted_under_pressure > 0
+    assert buffered_timestamps == frame_timestamps[-len(buffered_timestamps):]
+
+def test_buffer_of_a_stalled_camera_is_emptied(return_clip_recorder):
+    clip_recorder = return_clip_recorder()
+    for frame_index in range(5):
+        clip_recorder.add_frame(camera_uuid = "stalled_camera", frame = return_frame(seed = frame_index), frame_timestamp = time.time() - 100 + frame_index)
+    deadline = time.time() + 5
+    while len(clip_recorder.camera_buffers["stalled_camera"]) > 0 and time.time() < deadline:
+        clip_recorder.add_frame(camera_uuid = "live_camera", frame = return_frame(seed = 0), frame_timestamp = time.time())
+        time.sleep(0.01)
+    assert len(clip_recorder.camera_buffers["stalled_camera"]) == 0
+    assert clip_recorder.camera_buffer_bytes["stalled_camera"] == 0
+    assert_byte_accounting_is_exact(clip_recorder = clip_recorder)
+
+def test_clip_is_written_around_the_violation(return_clip_recorder, tmp_path):
+    clip_recorder = return_clip_recorder()
+    violation_timestamp = time.time()
+    frame_timestamps = [violation_timestamp - 1 + frame_index*0.2 for frame_index in range(10)]
+    for frame_index, frame_timestamp in enumerate(frame_timestamps[:5]):
+        clip_recorder.add_frame(camera_uuid = "camera", frame = return_frame(seed = frame_index), frame_timestamp = frame_timestamp)
+    clip_recorder.add_evaluation_result(EvaluationResult(camera_uuid = "camera", frame_timestamp = violation_timestamp, rule_name = "RESTRICTED_AREA"))
+    clip_recorder.add_evaluation_result(EvaluationResult(camera_uuid = "unknown_camera", frame_timestamp = violation_timestamp, rule_name = "RESTRICTED_AREA")) # No frame is buffered for it
+    for frame_index, frame_timestamp in enumerate(frame_timestamps[5:]):
+        clip_recorder.add_frame(camera_uuid = "camera", frame = return_frame(seed = frame_index), frame_timestamp = frame_timestamp)
+    clip_recorder.close() # Writes the open clip
+
+    clip_name = f"camera_{int(violation_timestamp*1000)}"
+    with open(tmp_path / "clips" / f"{clip_name}.json", "r") as f:
+        clip_info = json.load(f)
+    assert clip_info["rule_names"] == ["RESTRICTED_AREA"] and clip_info["frame_timestamps"] == frame_timestamps
+    assert (tmp_path / "clips" / f"{clip_name}.mp4").stat().st_size > 0
+    assert clip_recorder.number_of_clips_written == 1 and clip_recorder.number_of_clips_failed == 0
@@ -0,0 +1,91 @@
+import json, os
+import numpy as np
+import pytest
+
+pytest.importorskip("ultralytics") # cluster_module imports detectors_module for the records of the forwarded results
+import cluster_module
+
+CAMERA_UUIDS = [f"camera_{camera_index}" for camera_index in range(40)]
+
+def return_assignment(worker_capacities:dict = None, camera_uuids:list = None) -> tuple:
+    return cluster_module.ConsistentHashRing(worker_capacities = worker_capacities).assign(camera_uuids = camera_uuids if camera_uuids is not None else CAMERA_UUIDS, worker_capacities = worker_capacities)
+
+def test_cameras_are_assigned_within_the_worker_capacities():
+    assignment, unassigned_camera_uuids = return_assignment(worker_capacities = {"worker_a": 10, "worker_b": 20, "worker_c": 20})
+    assert unassigned_camera_uuids == []
+    assert sorted(camera_uuid for camera_uuids in assignment.values() for camera_uuid in camera_uuids) == sorted(CAMERA_UUIDS)
+    assert len(assignment["worker_a"]) <= 10 and len(assignment["worker_b"]) <= 20 and len(assignment["worker_c"]) <= 20
+
+    assignment, unassigned_camera_uuids = return_assignment(worker_capacities = {"worker_a": 15, "worker_b": 15})
+    assert len(unassigned_camera_uuids) == 10 and len(assignment["worker_a"]) == len(assignment["worker_b"]) == 15
+
+    assignment, unassigned_camera_uuids = return_assignment(worker_capacities = {})
+    assert assignment == {} and sorted(unassigned_camera_uuids) == sorted(CAMERA_UUIDS)
+
+def test_adding_a_worker_only_moves_cameras_to_it():
+    assignment, _ = return_assignment(worker_capacities = {"worker_a": 40, "worker_b": 40})
+    new_assignment, _ = return_assignment(worker_capacities = {"worker_a": 40, "worker_b": 40, "worker_c": 40})
+    assert 0 < len(new_assignment["worker_c"]) < len(CAMERA_UUIDS)
+    for worker_id in ["worker_a", "worker_b"]:
+        assert set(new_assignment[worker_id]) <= set(assignment[worker_id])
+
+def test_assignment_does_not_depend_on_the_camera_order():
+    worker_capacities = {"worker_a": 25, "worker_b": 25}
+    assert return_assignment(worker_capacities = worker_capacities) == return_assignment(worker_capacities = worker_capacities, camera_uuids = CAMERA_UUIDS[::-1])
+
+def test_prometheus_texts_of_the_nodes_are_merged_by_family():
+    prometheus_texts = {
+        None: "# HELP frames_total Frames\n# TYPE frames_total counter\nframes_total 1\n",
+        "worker_a": '# HELP frames_total Frames\n# TYPE frames_total counter\nframes_total 2\n# HELP cameras Cameras\n# TYPE cameras gauge\ncameras{region="a b"} 3\n',
+        "worker_b": "# HELP frames_total Frames\n# TYPE frames_total counter\nframes_total 4\n",
+    }
+    assert cluster_module.merge_prometheus_texts(prometheus_texts = prometheus_texts).splitlines() == [
+        "# HELP frames_total Frames",
+        "# TYPE frames_total counter",
+        "frames_total 1",
+        'frames_total{worker_id="worker_a"} 2',
+        'frames_total{worker_id="worker_b"} 4',
+        "# HELP cameras Cameras",
+        "# TYPE cameras gauge",
+        'cameras{worker_id="worker_a",region="a b"} 3',
+    ]
+
+def test_results_are_transferred_without_their_frame():
+    evaluation_result = cluster_module.detectors_module.PoseDetectionsRecord(
+        frame_info = {"frame": np.zeros((10, 20, 3), dtype=np.uint8), "camera_uuid": "camera_a", "frame_uuid": "frame", "frame_timestamp": 12.5},
+        frame_shape = [10, 20],
+        class_names = ["person"],
+        bbox_confidences = np.array([0.75], dtype=np.float32),
+        bbox_xyxy_px = np.array([[1, 2, 3, 4]], dtype=np.float32),
+        keypoints_xy = np.arange(34, dtype=np.float32).reshape(1, 17, 2),
+        keypoints_conf = np.full((1, 17), 0.5, dtype=np.float32),
+        track_ids = np.array([7], dtype=np.int64),
+        rule_name = "RESTRICTED_AREA",
+    )
+    transferred_result = cluster_module.return_result_from_transfer_dict(transfer_dict = json.loads(json.dumps(cluster_module.return_result_transfer_dict(evaluation_result = evaluation_result))))
+    assert transferred_result.frame is None and transferred_result.camera_uuid == "camera_a" and transferred_result.rule_name == "RESTRICTED_AREA"
+    for attribute_name in ["bbox_confidences", "bbox_xyxy_px", "keypoints_xy", "keypoints_conf", "track_ids"]:
+        assert np.array_equal(getattr(transferred_result, attribute_name), getattr(evaluation_result, attribute_name))
+
+def write_camera_configs(camera_configs_json_path:str = None, camera_regions:dict = None) -> None:
+    with open(camera_configs_json_path, "w") as f:
+        json.dump({"cameras": [{"camera_uuid": camera_uuid, "camera_region": camera_region, "is_alive": True} for camera_uuid, camera_region in camera_regions.items()]}, f)
+
+def test_coordinator_keeps_the_last_good_camera_configs(tmp_path):
+    camera_configs_json_path = str(tmp_path / "camera_configs.json")
+    reloaded_camera_configs = []
+    cluster_coordinator = cluster_module.ClusterCoordinator(camera_configs_json_path = camera_configs_json_path, on_camera_configs_reloaded = reloaded_camera_configs.append) # The file does not exist yet
+    assert cluster_coordinator.return_camera_regions() == {} and reloaded_camera_configs == []
+
+    reload_camera_configs_if_changed = cluster_coordinator._ClusterCoordinator__reload_camera_configs_if_changed
+    write_camera_configs(camera_configs_json_path = camera_configs_json_path, camera_regions = {"camera_a": "region_a"})
+    reload_camera_configs_if_changed()
+    assert cluster_coordinator.return_camera_regions() == {"camera_a": "region_a"}
+    assert [list(camera_configs.keys()) for camera_configs in reloaded_camera_configs] == [["camera_a"]]
+
+    os.remove(camera_configs_json_path) # e.g. replaced atomically by another file
+    reload_camera_configs_if_changed()
+    with open(camera_configs_json_path, "w") as f:
+        f.write('{"cameras": [') # Being written
+    reload_camera_configs_if_changed()
+    assert cluster_coordinator.return_camera_regions() == {"camera_a": "region_a"} and len(reloaded_camera_configs) == 1
@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+
+pytest.importorskip("ultralytics") # evaluation_module imports detectors_module, which loads the pytorch models with ultralytics
+import evaluation_module
+
+# The helpers only read the caches below, so the manager is built without loading any model
+def return_evaluation_manager() -> evaluation_module.EvaluationManager:
+    evaluation_manager = evaluation_module.EvaluationManager.__new__(evaluation_module.EvaluationManager)
+    evaluation_manager.zone_masks = {}
+    evaluation_manager.camera_rois = {}
+    evaluation_manager.trackers = {}
+    evaluation_manager.reported_track_ids = {}
+    return evaluation_manager
+
+SQUARE_POLYGON = [[0.25, 0.25], [0.75, 0.25], [0.75, 0.75], [0.25, 0.75]]
+
+def test_zone_mask_covers_the_polygon_in_pixels():
+    zone_mask = return_evaluation_manager()._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = SQUARE_POLYGON, frame_shape = (101, 201, 3))
+    assert zone_mask.shape == (101, 201) and zone_mask.dtype == bool
+    assert zone_mask[50, 100] and zone_mask[25, 50] and zone_mask[75, 150] # Polygon points are scaled by (width-1, height-1), the borders are inside
+    assert not zone_mask[24, 100] and not zone_mask[50, 49] and not zone_mask[76, 100] and not zone_mask[50, 151]
+
+def test_zone_mask_is_cached_until_the_polygon_or_the_frame_shape_changes():
+    evaluation_manager = return_evaluation_manager()
+    zone_mask = evaluation_manager._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = SQUARE_POLYGON, frame_shape = (100, 200, 3))
+    assert evaluation_manager._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = [list(point) for point in SQUARE_POLYGON], frame_shape = (100, 200, 3)) is zone_mask
+    assert evaluation_manager._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = SQUARE_POLYGON, frame_shape = (50, 100, 3)).shape == (50, 100)
+    assert evaluation_manager._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = [[0, 0], [0.1, 0], [0.1, 0.1]], frame_shape = (50, 100, 3))[40, 80] == False
+
+def return_detections(bboxes_xyxy:list = None, track_ids:list = None, frame_shape:tuple = (100, 200)) -> evaluation_module.detectors_module.PoseDetectionsRecord:
+    # Keypoints are not detected, so only the bottom center of the boxes is checked against the zones
+    number_of_detections = len(bboxes_xyxy)
+    return evaluation_module.detectors_module.PoseDetectionsRecord(
+        frame_info = {"frame": np.zeros((*frame_shape, 3), dtype=np.uint8), "camera_uuid": "camera", "frame_uuid": "frame", "frame_timestamp": 0.0},
+        frame_shape = list(frame_shape),
+        class_names = ["person"]*number_of_detections,
+        bbox_confidences = np.full((number_of_detections,), 0.9, dtype=np.float32),
+        bbox_xyxy_px = np.array(bboxes_xyxy, dtype=np.float32).reshape(-1, 4),
+        keypoints_xy = np.zeros((number_of_detections, 17, 2), dtype=np.float32),
+        keypoints_conf = np.full((number_of_detections, 17), -1, dtype=np.float32),
+        track_ids = np.array(track_ids, dtype=np.int64) if track_ids is not None else None,
+    )
+
+def test_restricted_area_rule_keeps_the_detections_in_the_zone():
+    detections = return_detections(bboxes_xyxy = [[90, 20, 110, 50], [10, 20, 30, 90]]) # Footpoints at (100, 50) inside and (20, 90) outside
+    frame_info = {"camera_uuid": "camera", "frame": detections.frame}
+    active_rule = {"yolo_model_to_use": "yolov8n-pose", "rule_polygon": SQUARE_POLYGON}
+    evaluation_result, was_usefull_to_evaluate = return_evaluation_manager()._EvaluationManager__restricted_area_rule(frame_info = frame_info, active_rule = active_rule, rule_index = 0, detections = detections)
+    assert was_usefull_to_evaluate
+    assert evaluation_result.bbox_xyxy_px.tolist() == [[90, 20, 110, 50]]
+
+def test_roi_contains_the_zone_mask_and_is_cached(monkeypatch):
+    monkeypatch.setattr(evaluation_module.server_preferences, "EVALUATION_ROI_PADDING_RATIO", 0)
+    evaluation_manager = return_evaluation_manager()
+    for rule_polygon in [SQUARE_POLYGON, [[0, 0], [1, 0], [1, 1], [0, 1]], [[0.1, 0.9], [0.33, 0.05], [0.99, 0.51]]]:
+        frame_info = {"camera_uuid": "camera", "frame": np.zeros((100, 200, 3), dtype=np.uint8), "active_rules": [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": rule_polygon}]}
+        x1, y1, x2, y2 = evaluation_manager._EvaluationManager__return_roi_xyxy(frame_info = frame_info, yolo_model_to_use = "yolov8n-pose")
+        zone_mask = evaluation_manager._EvaluationManager__return_zone_mask(camera_uuid = "camera", rule_index = 0, rule_polygon = rule_polygon, frame_shape = (100, 200))
+        assert np.count_nonzero(zone_mask[y1:y2, x1:x2]) == np.count_nonzero(zone_mask)
+        assert evaluation_manager._EvaluationManager__return_roi_xyxy(frame_info = frame_info, yolo_model_to_use = "yolov8n-pose") is evaluation_manager.camera_rois[("camera", "yolov8n-pose")]["roi_xyxy"]
+
+def test_reported_track_ids_are_kept_per_model():
+    # Each model of a camera numbers its tracks from 0, a person reported through one model must not hide the track 0 of another model
+    evaluation_manager = return_evaluation_manager()
+    for yolo_model_to_use in ["yolov8n-pose", "yolov8x-pose"]:
+        evaluation_manager.trackers[("camera", yolo_model_to_use)] = evaluation_module.tracker_module.MultiPersonTracker()
+        evaluation_manager.trackers[("camera", yolo_model_to_use)].update(bboxes_xyxy = np.array([[0, 0, 10, 20]], dtype=np.float32), timestamp = 0)
+    return_is_track_not_reported = evaluation_manager._EvaluationManager__return_is_track_not_reported
+    track_ids, is_violating = np.array([0], dtype=np.int64), np.array([True])
+    assert return_is_track_not_reported(camera_uuid = "camera", rule_index = 0, yolo_model_to_use = "yolov8n-pose", track_ids = track_ids, is_violating = is_violating).tolist() == [True]
+    assert return_is_track_not_reported(camera_uuid = "camera", rule_index = 0, yolo_model_to_use = "yolov8n-pose", track_ids = track_ids, is_violating = is_violating).tolist() == [False]
+    assert return_is_track_not_reported(camera_uuid = "camera", rule_index = 0, yolo_model_to_use = "yolov8x-pose", track_ids = track_ids, is_violating = is_violating).tolist() == [True]
+
+    # The reported id of a dropped track is forgotten, so the person is reported again when it comes back
+    del evaluation_manager.trackers[("camera", "yolov8n-pose")]
+    assert return_is_track_not_reported(camera_uuid = "camera", rule_index = 0, yolo_model_to_use = "yolov8x-pose", track_ids = track_ids, is_violating = is_violating).tolist() == [False]
+    assert evaluation_manager.reported_track_ids[("camera", 0)] == {("yolov8x-pose", 0)}
+
+def test_rule_without_detections_returns_a_new_empty_record():
+    # The caller sets the rule name on the returned record, the detections of the frame are shared by all of its rules
+    detections = return_detections(bboxes_xyxy = [])
+    frame_info = {"camera_uuid": "camera", "frame": detections.frame}
+    active_rule = {"yolo_model_to_use": "yolov8n-pose", "rule_polygon": SQUARE_POLYGON}
+    evaluation_result, was_usefull_to_evaluate = return_evaluation_manager()._EvaluationManager__restricted_area_rule(frame_info = frame_info, active_rule = active_rule, rule_index = 0, detections = detections)
+    assert not was_usefull_to_evaluate
+    assert len(evaluation_result) == 0 and evaluation_result is not detections
+    evaluation_result.rule_name = "RESTRICTED_AREA"
+    assert detections.rule_name is None
@@ -0,0 +1,70 @@
+import sqlite3, time
+import numpy as np
+import pytest
+
+import event_store_module
+
+class EvaluationResult:
+    # The attributes of a PoseDetectionsRecord that the event store reads
+    def __init__(self, camera_uuid:str = None, frame_timestamp:float = None, rule_name:str = None, bbox_xyxy_px:list = None, keypoints_xy:np.ndarray = None, track_ids:list = None) -> None:
+        self.camera_uuid = camera_uuid
+        self.frame_uuid = f"{camera_uuid}-{frame_timestamp}"
+        self.frame_timestamp = frame_timestamp
+        self.rule_name = rule_name
+        self.bbox_xyxy_px = np.array(bbox_xyxy_px, dtype=np.float32).reshape(-1, 4)
+        self.bbox_confidences = np.full((len(self.bbox_xyxy_px),), 0.75, dtype=np.float32)
+        self.keypoints_xy = keypoints_xy if keypoints_xy is not None else np.zeros((len(self.bbox_xyxy_px), 17, 2), dtype=np.float32)
+        self.keypoints_conf = np.full((len(self.bbox_xyxy_px), 17), 0.5, dtype=np.float32)
+        self.track_ids = np.array(track_ids, dtype=np.int64) if track_ids is not None else None
+
+    def __len__(self) -> int:
+        return len(self.bbox_xyxy_px)
+
+@pytest.fixture
+def violation_event_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_store_module.server_preferences, "EVENT_STORE_BATCH_TIMEOUT_SECONDS", 0.05)
+    violation_event_store = event_store_module.ViolationEventStore(database_path = tmp_path / "violation_events.db")
+    yield violation_event_store
+    if violation_event_store.writer_thread.is_alive(): violation_event_store.close()
+
+def wait_for_events_written(violation_event_store:event_store_module.ViolationEventStore = None, number_of_events:int = None) -> None:
+    deadline = time.time() + 10
+    while violation_event_store.number_of_events_written < number_of_events and time.time() < deadline:
+        time.sleep(0.01)
+    assert violation_event_store.number_of_events_written == number_of_events
+
+def test_events_are_written_and_queried_with_filters(violation_event_store):
+    violation_event_store.add_evaluation_result(EvaluationResult(camera_uuid = "camera_a", frame_timestamp = 10, rule_name = "RESTRICTED_AREA", bbox_xyxy_px = [[1, 2, 3, 4], [5, 6, 7, 8]], track_ids = [3, 4]))
+    violation_event_store.add_evaluation_result(EvaluationResult(camera_uuid = "camera_b", frame_timestamp = 20, rule_name = "RESTRICTED_AREA", bbox_xyxy_px = [[0, 0, 1, 1]]))
+    violation_event_store.add_evaluation_result(EvaluationResult(camera_uuid = "camera_a", frame_timestamp = 30, rule_name = "OTHER_RULE", bbox_xyxy_px = [[0, 0, 1, 1]]))
+    wait_for_events_written(violation_event_store = violation_event_store, number_of_events = 4)
+
+    assert [event["frame_timestamp"] for event in violation_event_store.query_events()] == [30, 20, 10, 10] # Most recent first
+    assert [event["frame_timestamp"] for event in violation_event_store.query_events(camera_uuid = "camera_a", rule_name = "RESTRICTED_AREA")] == [10, 10]
+    assert [event["frame_timestamp"] for event in violation_event_store.query_events(start_timestamp = 20, end_timestamp = 30)] == [20]
+    assert len(violation_event_store.query_events(limit = 2)) == 2
+
+    events = violation_event_store.query_events(camera_uuid = "camera_a", rule_name = "RESTRICTED_AREA")
+    assert sorted(event["track_id"] for event in events) == [3, 4]
+    assert sorted(event["bbox_xyxy_px"] for event in events) == [[1, 2, 3, 4], [5, 6, 7, 8]]
+    assert events[0]["bbox_confidence"] == 0.75 and len(events[0]["keypoints"]) == 17
+    assert violation_event_store.query_events(camera_uuid = "camera_b")[0]["track_id"] is None
+
+def test_close_writes_the_queued_events(violation_event_store, tmp_path):
+    violation_event_store.add_evaluation_result(EvaluationResult(camera_uuid = "camera_a", frame_timestamp = 10, rule_name = "RESTRICTED_AREA", bbox_xyxy_px = [[1, 2, 3, 4]]))
+    violation_event_store.close()
+    with sqlite3.connect(tmp_path / "violation_events.db") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM violation_events").fetchone()[0] == 1
+
+def test_keypoints_keep_their_sub_pixel_coordinates(violation_event_store):
+    keypoints_xy = np.full((1, 17, 2), 1234.5678, dtype=np.float32) # float16 would round them to 1235
+    violation_event_store.add_evaluation_result(EvaluationResult(camera_uuid = "camera_a", frame_timestamp = 10, rule_name = "RESTRICTED_AREA", bbox_xyxy_px = [[1, 2, 3, 4]], keypoints_xy = keypoints_xy))
+    wait_for_events_written(violation_event_store = violation_event_store, number_of_events = 1)
+    keypoints = np.array(violation_event_store.query_events()[0]["keypoints"])
+    assert np.array_equal(keypoints[:, 0:2], keypoints_xy[0]) and np.all(keypoints[:, 2] == 0.5)
+
+def test_events_written_with_float16_keypoints_are_still_read(violation_event_store, tmp_path):
+    keypoints = np.tile(np.array([[100.5, 200.25, 0.5]], dtype=np.float16), (17, 1))
+    with sqlite3.connect(tmp_path / "violation_events.db") as connection:
+        connection.execute("INSERT INTO violation_events (frame_timestamp, camera_uuid, rule_name, frame_uuid, track_id, bbox_confidence, bbox_xyxy, keypoints) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (10, "camera_a", "RESTRICTED_AREA", "frame", None, 0.75, np.zeros((4,), dtype=np.float32).tobytes(), keypoints.tobytes()))
+    assert violation_event_store.query_events()[0]["keypoints"] == [[100.5, 200.25, 0.5]]*17
@@ -0,0 +1,112 @@
+import pytest
+import numpy as np
+
+import inference_backend_module
+import server_preferences
+
+SQUARE_POLYGON = [[0.25, 0.25], [0.75, 0.25], [0.75, 0.75], [0.25, 0.75]]
+
+def return_frame_info(frame_shape:tuple = (100, 200), active_rules:list = None) -> dict:
+    return {"frame": np.zeros((*frame_shape, 3), dtype=np.uint8), "camera_uuid": "camera", "frame_uuid": "frame", "frame_timestamp": 0.0, "active_rules": active_rules}
+
+def test_rules_roi_uses_the_zone_mask_pixel_convention(monkeypatch):
+    # Normalized points are scaled by (width-1, height-1) like the zone masks, and x2, y2 are exclusive
+    monkeypatch.setattr(server_preferences, "EVALUATION_ROI_PADDING_RATIO", 0)
+    active_rules = [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": SQUARE_POLYGON}]
+    assert inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8n-pose", frame_shape = (100, 200, 3)) == [49, 24, 151, 76]
+
+    active_rules = [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": [[0, 0], [1, 0], [1, 1], [0, 1]]}]
+    assert inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8n-pose", frame_shape = (100, 200, 3)) == [0, 0, 200, 100]
+
+def test_rules_roi_is_padded_and_merged_per_model(monkeypatch):
+    monkeypatch.setattr(server_preferences, "EVALUATION_ROI_PADDING_RATIO", 0.25)
+    active_rules = [
+        {"yolo_model_to_use": "yolov8n-pose", "rule_polygon": [[0.25, 0.25], [0.5, 0.25], [0.5, 0.5]]},
+        {"yolo_model_to_use": "yolov8n-pose", "rule_polygon": [[0.5, 0.5], [0.75, 0.5], [0.75, 0.75]]},
+        {"yolo_model_to_use": "yolov8x-pose", "rule_polygon": [[0, 0], [0.1, 0], [0.1, 0.1]]},
+    ]
+    x1, y1, x2, y2 = inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8n-pose", frame_shape = (101, 201, 3))
+    assert (x1, y1, x2, y2) == (25, 12, 176, 89) # [50, 25] to [150, 75] in pixels, padded by 25 and 12.5 pixels
+
+def test_rules_roi_falls_back_to_the_full_frame():
+    active_rules = [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": SQUARE_POLYGON}, {"yolo_model_to_use": "yolov8n-pose", "rule_polygon": None}]
+    assert inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8n-pose", frame_shape = (100, 200, 3)) is None # A rule without a polygon covers the whole frame
+    assert inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8x-pose", frame_shape = (100, 200, 3)) is None # No rule uses the model
+    active_rules = [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": [[0, 0], [0, 0], [0, 0]]}]
+    assert inference_backend_module.return_rules_roi_xyxy(active_rules = active_rules, yolo_model_to_use = "yolov8n-pose", frame_shape = (100, 200, 3)) is None # Degenerate zone
+
+def test_model_inputs_are_prepared_for_the_full_frame_unless_roi_mode_is_enabled(monkeypatch):
+    frame_info = return_frame_info(active_rules = [{"yolo_model_to_use": "yolov8n-pose", "rule_polygon": SQUARE_POLYGON}])
+    assert list(inference_backend_module.return_model_inputs(frame_info = frame_info, image_size = 64).keys()) == [None]
+    monkeypatch.setattr(server_preferences, "EVALUATION_ROI_MODE", True)
+    monkeypatch.setattr(server_preferences, "EVALUATION_ROI_PADDING_RATIO", 0)
+    assert list(inference_backend_module.return_model_inputs(frame_info = frame_info, image_size = 64).keys()) == [(49, 24, 151, 76)]
+
+NUMBER_OF_KEYPOINTS = 17
+LETTERBOX_TRANSFORM = (0.5, 0, 80) # A 1280x960 frame letterboxed to 640x640
+
+def test_pose_output_without_any_kept_prediction_is_decoded():
+    # e.g. the warmup of the backends on a blank frame
+    output = np.zeros((5 + NUMBER_OF_KEYPOINTS*3, 8400), dtype=np.float32)
+    boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = inference_backend_module.decode_pose_output(output = output, letterbox_transform = LETTERBOX_TRANSFORM)
+    assert boxes_cls.shape == (0,) and boxes_conf.shape == (0,) and boxes_xyxy.shape == (0, 4)
+    assert keypoints_xy.shape == (0, NUMBER_OF_KEYPOINTS, 2) and keypoints_conf.shape == (0, NUMBER_OF_KEYPOINTS)
+
+def test_pose_output_is_decoded_in_frame_pixels():
+    # A single person centered at (320, 320) of the model input, twice on neighbouring anchors so that NMS keeps one of them
+    output = np.zeros((5 + NUMBER_OF_KEYPOINTS*3, 8400), dtype=np.float32)
+    for anchor_index in [100, 101]:
+        output[0:5, anchor_index] = [320, 320, 100, 200, 0.9]
+        output[5:, anchor_index] = np.tile([320, 320, 0.9], NUMBER_OF_KEYPOINTS)
+    output[5 + 2, 100:102] = 0.1 # The first keypoint is not visible
+    boxes_cls, boxes_conf, boxes_xyxy, keypoints_xy, keypoints_conf = inference_backend_module.decode_pose_output(output = output, letterbox_transform = LETTERBOX_TRANSFORM)
+    assert boxes_cls.tolist() == [0] and np.allclose(boxes_conf, [0.9])
+    assert np.allclose(boxes_xyxy, [[540, 280, 740, 680]])
+    assert np.allclose(keypoints_xy[0, 0], [0, 0]) and np.allclose(keypoints_xy[0, 1:], [640, 480])
+
+def return_onnx_pose_like_model(image_size:int = None):
+    # A convolution module followed by a head module, named like the nodes of an exported ultralytics model
+    import onnx
+    from onnx import helper, TensorProto
+    rng = np.random.default_rng(0)
+    conv_weights = helper.make_tensor("conv_weights", TensorProto.FLOAT, [8, 3, 3, 3], rng.normal(size=(8, 3, 3, 3)).astype(np.float32).flatten().tolist())
+    head_scale = helper.make_tensor("head_scale", TensorProto.FLOAT, [1], [640.0])
+    graph = helper.make_graph(
+        [helper.make_node("Conv", ["images", "conv_weights"], ["features"], name="/model.0/conv/Conv", pads=[1, 1, 1, 1]),
+         helper.make_node("Relu", ["features"], ["activations"], name="/model.0/act/Relu"),
+         helper.make_node("Mul", ["activations", "head_scale"], ["output0"], name="/model.1/Mul")],
+        "pose_like", [helper.make_tensor_value_info("images", TensorProto.FLOAT, [1, 3, image_size, image_size])], [helper.make_tensor_value_info("output0", TensorProto.FLOAT, [1, 8, image_size, image_size])], [conv_weights, head_scale])
+    onnx_model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    onnx_model.ir_version = 9
+    return onnx_model
+
+def test_output_head_nodes_are_the_nodes_of_the_last_module():
+    pytest.importorskip("onnx")
+    assert inference_backend_module.return_output_head_node_names(onnx_model = return_onnx_pose_like_model(image_size = 32)) == ["/model.1/Mul"]
+
+def test_int8_model_is_statically_quantized_except_its_head(tmp_path, monkeypatch):
+    onnx = pytest.importorskip("onnx")
+    onnxruntime = pytest.importorskip("onnxruntime")
+    monkeypatch.setattr(server_preferences, "INFERENCE_INT8_CALIBRATION_NUMBER_OF_FRAMES", 2)
+    onnx.save(return_onnx_pose_like_model(image_size = 32), str(tmp_path / "model.onnx"))
+    inference_backend_module.quantize_onnx_model_to_int8(onnx_model_path = str(tmp_path / "model.onnx"), int8_model_path = str(tmp_path / "model_int8_qdq.onnx"), image_size = 32)
+
+    int8_model = onnx.load(str(tmp_path / "model_int8_qdq.onnx"))
+    quantized_tensor_names = set(node.input[0] for node in int8_model.graph.node if node.op_type == "QuantizeLinear")
+    assert "images" in quantized_tensor_names # The activations are quantized with the calibrated ranges, not only the weights
+    head_node = next(node for node in int8_model.graph.node if node.name == "/model.1/Mul")
+    assert head_node.input[1] == "head_scale" and "output0" not in quantized_tensor_names # The head stays in float
+    onnxruntime.InferenceSession(str(tmp_path / "model_int8_qdq.onnx"), providers=["CPUExecutionProvider"]).run(None, {"images": np.zeros((1, 3, 32, 32), dtype=np.float32)})
+
+def test_model_inputs_stay_uint8_until_they_are_batched():
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, size=(48, 64, 3), dtype=np.uint8), rng.integers(0, 256, size=(64, 32, 3), dtype=np.uint8)]
+    model_inputs = [inference_backend_module.return_model_input(frame = frame, image_size = 32) for frame in frames]
+    assert all(model_input[0].dtype == np.uint8 and model_input[0].shape == (32, 32, 3) for model_input in model_inputs)
+    assert model_inputs[0][1] == (0.5, 0, 4) and model_inputs[1][1] == (0.5, 8, 0)
+    assert np.all(model_inputs[0][0][:4] == 114) # Letterbox padding
+
+    input_batch = inference_backend_module.return_input_batch(model_inputs = model_inputs)
+    expected_input_batch = np.stack([model_input[0][..., ::-1].transpose(2, 0, 1) for model_input in model_inputs]).astype(np.float32) / 255 # RGB, channels first, in [0, 1]
+    assert input_batch.dtype == np.float32 and input_batch.shape == (2, 3, 32, 32)
+    assert np.allclose(input_batch, expected_input_batch, atol=1e-6)
@@ -0,0 +1,49 @@
+import pytest
+
+import metrics_module
+
+def test_counters_and_histograms_are_rendered_in_the_prometheus_format():
+    metrics_registry = metrics_module.MetricsRegistry()
+    metrics_registry.counter(name = "frames_total", help_text = "Frames", labels = {"camera_uuid": "camera_a"}).increment()
+    metrics_registry.counter(name = "frames_total", help_text = "Frames", labels = {"camera_uuid": "camera_a"}).increment(amount = 2) # The same label set returns the same counter
+    histogram = metrics_registry.histogram(name = "call_seconds", help_text = "Calls", bucket_bounds = [0.1, 1])
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value = value)
+
+    assert metrics_registry.return_prometheus_text().splitlines() == [
+        "# HELP frames_total Frames",
+        "# TYPE frames_total counter",
+        'frames_total{camera_uuid="camera_a"} 3',
+        "# HELP call_seconds Calls",
+        "# TYPE call_seconds histogram",
+        'call_seconds_bucket{le="0.1"} 2',
+        'call_seconds_bucket{le="1.0"} 3',
+        'call_seconds_bucket{le="+Inf"} 4',
+        "call_seconds_sum 3.65",
+        "call_seconds_count 4",
+    ]
+
+def test_metric_type_can_not_change():
+    metrics_registry = metrics_module.MetricsRegistry()
+    metrics_registry.counter(name = "frames", help_text = "Frames")
+    with pytest.raises(ValueError):
+        metrics_registry.histogram(name = "frames", help_text = "Frames")
+
+def test_metrics_of_a_label_are_removed():
+    metrics_registry = metrics_module.MetricsRegistry()
+    metrics_registry.counter(name = "frames_total", help_text = "Frames", labels = {"camera_uuid": "camera_a", "stage": "fetch"}).increment()
+    metrics_registry.counter(name = "frames_total", help_text = "Frames", labels = {"camera_uuid": "camera_b", "stage": "fetch"}).increment()
+    metrics_registry.remove_metrics(labels = {"camera_uuid": "camera_a"})
+    prometheus_text = metrics_registry.return_prometheus_text()
+    assert "camera_a" not in prometheus_text and 'frames_total{camera_uuid="camera_b",stage="fetch"} 1' in prometheus_text
+
+def test_collectors_are_read_at_scrape_time():
+    metrics_registry = metrics_module.MetricsRegistry()
+    number_of_cameras = [2]
+    metrics_registry.register_collector(collector_name = "cameras", collector = lambda: [("cameras", "gauge", "Cameras", {"region": 'a "quoted"\nregion'}, number_of_cameras[0])])
+    metrics_registry.register_collector(collector_name = "broken", collector = lambda: 1/0) # A failing collector does not break the others
+    number_of_cameras[0] = 3
+    assert metrics_registry.return_prometheus_text().splitlines() == ["# HELP cameras Cameras", "# TYPE cameras gauge", 'cameras{region="a \\"quoted\\"\\nregion"} 3']
+
+    metrics_registry.unregister_collector(collector_name = "cameras")
+    assert metrics_registry.return_prometheus_text() == "\n"
@@ -0,0 +1,60 @@
+import types
+from multiprocessing import shared_memory
+import numpy as np
+import pytest
+
+import camera_module
+import decoder_process_module
+import pipeline_module
+
+NUMBER_OF_SLOTS = 2
+FRAME_SHAPE = (4, 6, 3)
+
+@pytest.fixture
+def shared_frames():
+    # A shared memory block laid out like the ones of the decoder processes: the sequence of each slot, then the frames of the slots
+    frame_bytes = int(np.prod(FRAME_SHAPE))
+    shared_block = shared_memory.SharedMemory(create=True, size=8*NUMBER_OF_SLOTS + NUMBER_OF_SLOTS*frame_bytes)
+    sequences = np.ndarray((NUMBER_OF_SLOTS,), dtype=np.int64, buffer=shared_block.buf)
+    frames = [np.ndarray(FRAME_SHAPE, dtype=np.uint8, buffer=shared_block.buf, offset=8*NUMBER_OF_SLOTS + slot_index*frame_bytes) for slot_index in range(NUMBER_OF_SLOTS)]
+    yield shared_block, sequences, frames
+    del sequences, frames
+    shared_block.close()
+    shared_block.unlink()
+
+def return_stream_manager(shared_block:shared_memory.SharedMemory = None, camera_uuids:list = None) -> camera_module.StreamManager:
+    decoder_process_pool = decoder_process_module.DecoderProcessPool.__new__(decoder_process_module.DecoderProcessPool)
+    decoder_process_pool.attached_shared_memories = {shared_block.name: shared_block} if shared_block is not None else {}
+    decoder_process_pool.cameras_by_uuid = {camera_uuid: None for camera_uuid in (camera_uuids if camera_uuids is not None else [])}
+    stream_manager = camera_module.StreamManager(camera_configs = [])
+    stream_manager.decoder_process_pool = decoder_process_pool
+    return stream_manager
+
+def test_results_of_overwritten_shared_frames_are_dropped(shared_frames):
+    shared_block, sequences, frames = shared_frames
+    frames[0][:] = 1
+    frames[1][:] = 2
+    sequences[:] = [10, 11]
+    frames_info = {
+        "fresh": {"frame": frames[0], "frame_uuid": "fresh", "shared_memory_name": shared_block.name, "number_of_slots": NUMBER_OF_SLOTS, "slot_index": 0, "sequence": 10},
+        "stale": {"frame": frames[1], "frame_uuid": "stale", "shared_memory_name": shared_block.name, "number_of_slots": NUMBER_OF_SLOTS, "slot_index": 1, "sequence": 9}, # The decoder process wrote a newer frame in the slot during the evaluation
+    }
+    evaluation_pipeline = pipeline_module.EvaluationPipeline.__new__(pipeline_module.EvaluationPipeline)
+    evaluation_pipeline.stream_manager = return_stream_manager(shared_block = shared_block)
+    evaluation_pipeline.number_of_results_dropped_stale_frame = 0
+
+    evaluation_results = [types.SimpleNamespace(camera_uuid = "camera", frame_uuid = frame_uuid, frame = frames_info[frame_uuid]["frame"]) for frame_uuid in ["fresh", "stale", "fresh"]]
+    kept_evaluation_results = evaluation_pipeline._EvaluationPipeline__return_results_with_copied_frames(evaluation_results = evaluation_results, shared_frames_info = frames_info)
+    assert [evaluation_result.frame_uuid for evaluation_result in kept_evaluation_results] == ["fresh", "fresh"]
+    assert evaluation_pipeline.number_of_results_dropped_stale_frame == 1
+
+    # The kept results own a single copy of their frame, which is not changed when the slot is reused
+    assert kept_evaluation_results[0].frame is kept_evaluation_results[1].frame
+    frames[0][:] = 3
+    assert not np.shares_memory(kept_evaluation_results[0].frame, frames[0]) and np.all(kept_evaluation_results[0].frame == 1)
+
+def test_cameras_of_the_decoder_processes_can_not_be_stopped_alone():
+    stream_manager = return_stream_manager(camera_uuids = ["camera_a", "camera_b"])
+    with pytest.raises(ValueError):
+        stream_manager.stop_cameras_by_uuid(camera_uuids = ["camera_a"])
+    assert stream_manager.decoder_process_pool is not None
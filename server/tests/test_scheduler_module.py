@@ -0,0 +1,70 @@
+import types
+import pytest
+
+import scheduler_module
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler_module, "time", types.SimpleNamespace(time = clock.time))
+    return clock
+
+def return_frame_info(camera_uuid:str = None, frame_timestamp:float = None, frame_uuid:str = None) -> dict:
+    return {"camera_uuid": camera_uuid, "frame_uuid": frame_uuid if frame_uuid is not None else f"{camera_uuid}-{frame_timestamp}", "frame_timestamp": frame_timestamp}
+
+def return_scheduler(budget_per_second:float = 10) -> scheduler_module.EvaluationScheduler:
+    return scheduler_module.EvaluationScheduler(budget_per_second = budget_per_second, max_revisit_interval_seconds = 60, max_frame_age_seconds = 5, burst_seconds = 1)
+
+def test_budget_is_shared_in_proportion_to_the_weights(clock):
+    evaluation_scheduler = return_scheduler(budget_per_second = 10)
+    camera_weights = {"camera_a": 3, "camera_b": 1}
+    number_of_evaluations = {camera_uuid: 0 for camera_uuid in camera_weights}
+    for step_index in range(2200):
+        clock.now += 0.01
+        for camera_uuid, weight in camera_weights.items():
+            evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = camera_uuid, frame_timestamp = clock.now), weight = weight, cost = 1)
+        for frame_info in evaluation_scheduler.pop_frames_to_evaluate():
+            if step_index >= 200: number_of_evaluations[frame_info["camera_uuid"]] += 1 # The initial burst is spent in the first two seconds
+
+    assert 199 <= sum(number_of_evaluations.values()) <= 201 # 20 seconds at 10 frames per second
+    assert number_of_evaluations["camera_a"] / number_of_evaluations["camera_b"] == pytest.approx(3, rel=0.05)
+    assert evaluation_scheduler.return_camera_shares() == {"camera_a": 0.75, "camera_b": 0.25}
+
+def test_newer_frame_replaces_the_ready_frame(clock):
+    evaluation_scheduler = return_scheduler()
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now, frame_uuid = "old"), weight = 1, cost = 1)
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now, frame_uuid = "new"), weight = 1, cost = 1)
+    assert [frame_info["frame_uuid"] for frame_info in evaluation_scheduler.pop_frames_to_evaluate()] == ["new"]
+    assert evaluation_scheduler.pop_frames_to_evaluate() == []
+    assert evaluation_scheduler.return_next_decision_delay() is None
+
+def test_overdue_camera_is_evaluated_without_budget(clock):
+    evaluation_scheduler = return_scheduler(budget_per_second = 1)
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now), weight = 1, cost = 100) # Overdrafts the budget for 99 seconds
+    assert len(evaluation_scheduler.pop_frames_to_evaluate()) == 1
+    assert evaluation_scheduler.budget_tokens < 0
+
+    clock.now += 30
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now), weight = 1, cost = 1)
+    assert evaluation_scheduler.pop_frames_to_evaluate() == []
+    assert evaluation_scheduler.return_next_decision_delay() == pytest.approx(30)
+
+    clock.now += 30
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now), weight = 1, cost = 1)
+    assert len(evaluation_scheduler.pop_frames_to_evaluate()) == 1
+
+def test_old_frames_and_removed_cameras_are_skipped(clock):
+    evaluation_scheduler = return_scheduler()
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_a", frame_timestamp = clock.now - 10), weight = 1, cost = 1)
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_b", frame_timestamp = clock.now), weight = 1, cost = 1)
+    evaluation_scheduler.add_frame(frame_info = return_frame_info(camera_uuid = "camera_c", frame_timestamp = clock.now), weight = 1, cost = 1)
+    evaluation_scheduler.remove_camera(camera_uuid = "camera_c")
+    assert [frame_info["camera_uuid"] for frame_info in evaluation_scheduler.pop_frames_to_evaluate()] == ["camera_b"]
+    assert evaluation_scheduler.budget_tokens == 9 # Skipped frames do not use the budget
@@ -0,0 +1,39 @@
+import numpy as np
+
+import tracker_module
+import server_preferences
+
+def return_boxes(boxes_xyxy:list = None) -> np.ndarray:
+    return np.array(boxes_xyxy, dtype=np.float32).reshape(-1, 4)
+
+def test_new_detections_get_new_track_ids():
+    multi_person_tracker = tracker_module.MultiPersonTracker()
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([]), timestamp = 0).tolist() == []
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[0, 0, 10, 20], [100, 0, 110, 20]]), timestamp = 0).tolist() == [0, 1]
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[300, 0, 310, 20]]), timestamp = 0.1).tolist() == [2]
+    assert len(multi_person_tracker) == 3
+
+def test_tracks_follow_the_people_whatever_the_detection_order():
+    multi_person_tracker = tracker_module.MultiPersonTracker()
+    multi_person_tracker.update(bboxes_xyxy = return_boxes([[0, 0, 10, 20], [100, 0, 110, 20]]), timestamp = 0)
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[102, 0, 112, 20], [2, 0, 12, 20]]), timestamp = 0.1).tolist() == [1, 0]
+
+def test_slowly_evaluated_person_is_matched_with_its_predicted_box():
+    # Between the last two evaluations the person moves by more than its width, so only the constant velocity prediction is close to the new detection
+    multi_person_tracker = tracker_module.MultiPersonTracker()
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[0, 0, 10, 20]]), timestamp = 0).tolist() == [0]
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[8, 0, 18, 20]]), timestamp = 1).tolist() == [0]
+    _, predicted_boxes = multi_person_tracker.predict(timestamp = 3)
+    assert np.allclose(predicted_boxes, [[24, 0, 34, 20]])
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[24, 0, 34, 20]]), timestamp = 3).tolist() == [0]
+
+    other_tracker = tracker_module.MultiPersonTracker() # Without the velocity, the same detection starts a new track
+    other_tracker.update(bboxes_xyxy = return_boxes([[8, 0, 18, 20]]), timestamp = 1)
+    assert other_tracker.update(bboxes_xyxy = return_boxes([[24, 0, 34, 20]]), timestamp = 3).tolist() == [1]
+
+def test_unmatched_tracks_expire():
+    multi_person_tracker = tracker_module.MultiPersonTracker()
+    multi_person_tracker.update(bboxes_xyxy = return_boxes([[0, 0, 10, 20]]), timestamp = 0)
+    multi_person_tracker.update(bboxes_xyxy = return_boxes([]), timestamp = server_preferences.TRACKER_MAX_TRACK_AGE_SECONDS + 1)
+    assert len(multi_person_tracker) == 0
+    assert multi_person_tracker.update(bboxes_xyxy = return_boxes([[0, 0, 10, 20]]), timestamp = server_preferences.TRACKER_MAX_TRACK_AGE_SECONDS + 2).tolist() == [1]